@@ -14,40 +14,190 @@
 # mypy: no-strict-optional
 
 import os
+import pickle
 import re
-from typing import cast, Dict, Iterator, List, Tuple, NewType
+from typing import cast, Dict, Iterator, List, Optional, Tuple, NewType
 from collections import defaultdict
 
 Guid = NewType("Guid", str)
 
+BRUSH_DIRS = ("Assets/Resources/Brushes", "Assets/Resources/X/Brushes")
+MANIFEST = "Assets/Manifest.asset"
+# Bump this whenever the format of the index changes
+INDEX_VERSION = 2
+INDEX_FILE = "Library/brush_lookup.cache"
 
-class BrushLookup:
-    """Helper for doing name <-> guid conversions for brushes."""
 
-    def iter_standard_brush_guids(self) -> Iterator[Guid]:
-        """Yields all the standard (non-experimental) brush guids"""
-        with open(os.path.join(self.dir, "Assets/Manifest.asset")) as inf:
-            data = inf.read().replace("\r", "")
-        brush_chunk = re.search(r"Brushes:\n(  -.*\n)*", data).group(0)
-        for match in re.finditer(r"guid: ([0-9a-f]{32})", brush_chunk):
-            yield cast(Guid, match.group(1))
+class BrushIndex:
+    """On-disk index of brush descriptors, so that BrushLookup does not have to
+    walk and read the brush tree on every process start.
+    .entries      list of (guid, name, path, is_standard, mtime_ns, meta_mtime_ns);
+                  meta_mtime_ns is None if the asset has no .meta file
+    .dir_mtimes   dict mapping directory -> mtime_ns, for every directory walked
+    .manifest_mtime
 
-    @staticmethod
-    def iter_brush_guid_and_name(tilt_brush_dir: str) -> Iterator[Tuple[Guid, str]]:
-        """Yields (guid, name) tuples."""
-        for brush_dir in ("Assets/Resources/Brushes", "Assets/Resources/X/Brushes"):
+    The index is valid while no directory, brush asset, .meta file, or the
+    manifest has changed mtime. Adding, removing or renaming an asset changes
+    the mtime of its directory; editing one changes its own mtime. is_standard
+    comes from the .meta file's guid, so it is only as fresh as the .meta."""
+
+    def __init__(self, entries, dir_mtimes, manifest_mtime):
+        self.entries = entries
+        self.dir_mtimes = dir_mtimes
+        self.manifest_mtime = manifest_mtime
+
+    def is_valid(self, tilt_brush_dir: str) -> bool:
+        try:
+            if _mtime(tilt_brush_dir, MANIFEST) != self.manifest_mtime:
+                return False
+            for path, mtime in self.dir_mtimes.items():
+                if _mtime(tilt_brush_dir, path) != mtime:
+                    return False
+            for _, _, path, _, mtime, meta_mtime in self.entries:
+                if _mtime(tilt_brush_dir, path) != mtime:
+                    return False
+                if _meta_mtime(os.path.join(tilt_brush_dir, path)) != meta_mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls, tilt_brush_dir: str) -> Optional["BrushIndex"]:
+        """Returns the stored index, which may be stale; or None."""
+        try:
+            with open(os.path.join(tilt_brush_dir, INDEX_FILE), "rb") as inf:
+                data = pickle.load(inf)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return cls(data["entries"], data["dir_mtimes"], data["manifest_mtime"])
+
+    def save(self, tilt_brush_dir: str):
+        """Writes the index, atomically. Failure to write is not an error."""
+        filename = os.path.join(tilt_brush_dir, INDEX_FILE)
+        # Parallel workers may race to write; give each its own temp file
+        tmpf = "%s_part%d" % (filename, os.getpid())
+        data = {
+            "version": INDEX_VERSION,
+            "entries": self.entries,
+            "dir_mtimes": self.dir_mtimes,
+            "manifest_mtime": self.manifest_mtime,
+        }
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmpf, "wb") as outf:
+                pickle.dump(data, outf, -1)
+            os.replace(tmpf, filename)
+        except OSError:
+            pass
+
+    @classmethod
+    def build(
+        cls, tilt_brush_dir: str, old: Optional["BrushIndex"] = None
+    ) -> "BrushIndex":
+        """Scans the brush tree. Assets whose mtime matches an entry in old
+        are not re-read, nor are .meta files if neither they nor the manifest
+        have changed."""
+        reuse = {}
+        manifest_mtime = _mtime(tilt_brush_dir, MANIFEST)
+        same_manifest = False
+        if old is not None:
+            reuse = {e[2]: e for e in old.entries}
+            same_manifest = old.manifest_mtime == manifest_mtime
+        standard_assets = set(_iter_manifest_brush_asset_guids(tilt_brush_dir))
+        dir_mtimes = {}
+        entries = []
+        chop = len(tilt_brush_dir) + 1
+        for brush_dir in BRUSH_DIRS:
             for r, _, fs in os.walk(os.path.join(tilt_brush_dir, brush_dir)):
+                dir_mtimes[r[chop:]] = os.stat(r).st_mtime_ns
                 for f in fs:
-                    if f.lower().endswith(".asset"):
-                        fullf = os.path.join(r, f)
+                    if not f.lower().endswith(".asset"):
+                        continue
+                    fullf = os.path.join(r, f)
+                    path = fullf[chop:]
+                    mtime = os.stat(fullf).st_mtime_ns
+                    prev = reuse.get(path)
+                    if prev is not None and prev[4] == mtime:
+                        guid = prev[0]
+                    else:
                         with open(fullf) as inf:
                             data = inf.read()
                         guid = cast(
                             Guid, re.search("m_storage: (.*)$", data, re.M).group(1)
                         )
-                        # name = re.search('m_Name: (.*)$', data, re.M).group(1)
-                        name = f[:-6]
-                        yield guid, name
+                    # name = re.search('m_Name: (.*)$', data, re.M).group(1)
+                    name = f[:-6]
+                    meta_mtime = _meta_mtime(fullf)
+                    if (
+                        prev is not None
+                        and same_manifest
+                        and meta_mtime is not None
+                        and prev[5] == meta_mtime
+                    ):
+                        is_standard = prev[3]
+                    else:
+                        is_standard = _get_asset_guid(fullf) in standard_assets
+                    entries.append((guid, name, path, is_standard, mtime, meta_mtime))
+        return cls(entries, dir_mtimes, manifest_mtime)
+
+
+def _mtime(tilt_brush_dir: str, path: str) -> int:
+    return os.stat(os.path.join(tilt_brush_dir, path)).st_mtime_ns
+
+
+def _meta_mtime(asset_file: str) -> Optional[int]:
+    try:
+        return os.stat(asset_file + ".meta").st_mtime_ns
+    except OSError:
+        return None
+
+
+def _get_asset_guid(asset_file: str) -> Optional[str]:
+    """Returns the Unity guid from an asset's .meta file."""
+    try:
+        with open(asset_file + ".meta") as inf:
+            m = re.search(r"^guid: ([0-9a-f]{32})", inf.read(), re.M)
+    except IOError:
+        return None
+    return m and m.group(1)
+
+
+def _iter_manifest_brush_asset_guids(tilt_brush_dir: str) -> Iterator[str]:
+    """Yields the Unity asset guids of the brushes in the manifest."""
+    with open(os.path.join(tilt_brush_dir, MANIFEST)) as inf:
+        data = inf.read().replace("\r", "")
+    brush_chunk = re.search(r"Brushes:\n(  -.*\n)*", data).group(0)
+    for match in re.finditer(r"guid: ([0-9a-f]{32})", brush_chunk):
+        yield match.group(1)
+
+
+class BrushLookup:
+    """Helper for doing name <-> guid conversions for brushes."""
+
+    def iter_standard_brush_guids(self) -> Iterator[Guid]:
+        """Yields all the standard (non-experimental) brush guids, ie those of
+        the brushes listed in the manifest"""
+        for guid, _, _, is_standard, _, _ in self.index.entries:
+            if is_standard:
+                yield guid
+
+    @staticmethod
+    def iter_brush_guid_and_name(tilt_brush_dir: str) -> Iterator[Tuple[Guid, str]]:
+        """Yields (guid, name) tuples."""
+        for guid, name, _, _, _, _ in BrushLookup.get_index(tilt_brush_dir).entries:
+            yield guid, name
+
+    @staticmethod
+    def get_index(tilt_brush_dir: str) -> BrushIndex:
+        """Returns the on-disk BrushIndex, rebuilding it if it is stale."""
+        index = BrushIndex.load(tilt_brush_dir)
+        if index is None or not index.is_valid(tilt_brush_dir):
+            index = BrushIndex.build(tilt_brush_dir, index)
+            index.save(tilt_brush_dir)
+        return index
 
     _instances: Dict[str, "BrushLookup"] = {}
 
@@ -68,7 +218,8 @@ class BrushLookup:
     def __init__(self, tilt_brush_dir: str):
         self.dir = tilt_brush_dir
         self.initialized = True
-        self.guid_to_name = dict(self.iter_brush_guid_and_name(self.dir))
+        self.index = self.get_index(self.dir)
+        self.guid_to_name = {e[0]: e[1] for e in self.index.entries}
         self.standard_brushes = set(self.iter_standard_brush_guids())
         name_to_guids: Dict[str, List[Guid]] = defaultdict(list)
         for guid, name in self.guid_to_name.items():
@@ -0,0 +1,110 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Texture downsampling via mip chains.
+
+A MipChain is built once per source image; any number of smaller sizes can
+then be served from it. Each size is taken from the smallest mip level that is
+at least as large, and finished with a Lanczos resample, which never has to
+reduce by 2x or more and so does not alias.
+
+RGBA images are filtered with premultiplied alpha, so fully transparent texels
+don't bleed their (meaningless) color into their neighbors."""
+
+import numpy as np  # pylint: disable=import-error
+from PIL import Image  # pylint: disable=import-error
+
+FILTERS = ("box", "lanczos")
+
+
+def _halve(a, axis):
+    """Averages pairs of samples along axis. Odd sizes repeat the last sample."""
+    n = a.shape[axis]
+    if n == 1:
+        return a
+    if n % 2:
+        a = np.concatenate([a, np.take(a, [-1], axis=axis)], axis=axis)
+    shape = a.shape[:axis] + (a.shape[axis] // 2, 2) + a.shape[axis + 1 :]
+    return a.reshape(shape).mean(axis=axis + 1)
+
+
+def _box_reduce(a):
+    """Returns the next mip level of a (height, width, channels) array."""
+    return _halve(_halve(a, 0), 1)
+
+
+def _lanczos_resize(a, size):
+    """Resizes a float (height, width, channels) array to size=(width, height)."""
+    channels = [
+        np.asarray(Image.fromarray(a[:, :, c], "F").resize(size, Image.LANCZOS))
+        for c in range(a.shape[2])
+    ]
+    return np.stack(channels, axis=2)
+
+
+class MipChain:
+    """All mip levels of an image, as premultiplied float32 arrays.
+    .mode     the PIL mode of the source: "L", "RGB" or "RGBA"
+    .levels   list of (height, width, channels) arrays; levels[0] is the source"""
+
+    def __init__(self, image, mip_filter="box"):
+        if image.mode not in ("L", "RGB", "RGBA"):
+            raise ValueError("Unsupported image mode %s" % image.mode)
+        if mip_filter not in FILTERS:
+            raise ValueError("Unknown filter %s" % mip_filter)
+        self.mode = image.mode
+        level = np.asarray(image, dtype=np.float32).reshape(
+            image.height, image.width, -1
+        )
+        if self.mode == "RGBA":
+            level = level.copy()
+            level[:, :, :3] *= level[:, :, 3:] / 255.0
+        self.levels = [level]
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            if mip_filter == "box":
+                level = _box_reduce(level)
+            else:
+                size = ((level.shape[1] + 1) // 2, (level.shape[0] + 1) // 2)
+                level = _lanczos_resize(level, size)
+            self.levels.append(level)
+
+    @property
+    def size(self):
+        return self.levels[0].shape[1], self.levels[0].shape[0]
+
+    def _level_for(self, size):
+        """Returns the smallest level at least as large as size=(width, height)."""
+        for level in reversed(self.levels):
+            if level.shape[1] >= size[0] and level.shape[0] >= size[1]:
+                return level
+        raise ValueError("Can't upsample %s to %s" % (self.size, size))
+
+    def get_image(self, size):
+        """Returns a PIL image of the source, downsampled to size=(width, height)."""
+        level = self._level_for(size)
+        if (level.shape[1], level.shape[0]) != tuple(size):
+            level = _lanczos_resize(level, tuple(size))
+        if self.mode == "RGBA":
+            level = level.copy()
+            alpha = level[:, :, 3:]
+            np.divide(
+                level[:, :, :3] * 255.0,
+                alpha,
+                out=level[:, :, :3],
+                where=alpha > 0,
+            )
+        pixels = np.clip(np.rint(level), 0, 255).astype(np.uint8)
+        if self.mode == "L":
+            pixels = pixels[:, :, 0]
+        return Image.fromarray(pixels, self.mode)
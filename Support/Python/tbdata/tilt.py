@@ -0,0 +1,651 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and writing of .tilt files, without the Tilt Brush Toolkit.
+
+A .tilt is either a directory or a zip archive with a 16-byte header
+prepended (see TiltFile.cs). It contains metadata.json, data.sketch and
+thumbnail.png. The binary data.sketch format is documented at the top of
+SketchWriter.cs.
+
+Strokes are decoded into a columnar layout: one numpy array per stroke
+attribute, and one numpy array per control point attribute covering the
+control points of every stroke. The control points of stroke i are rows
+cp_offsets[i] : cp_offsets[i + 1] of the control point arrays.
+
+Usage:
+  tilt = Tilt(filename)
+  tilt.sketch.position[:, 1] += 1
+  tilt.write_sketch()
+"""
+
+import contextlib
+import json
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+import numpy as np  # pylint: disable=import-error
+
+FN_METADATA = "metadata.json"
+FN_SKETCH = "data.sketch"
+FN_THUMBNAIL = "thumbnail.png"
+
+TILT_SENTINEL = 0x546C6974  # 'tilT'
+TILT_HEADER_SIZE = 16
+TILT_HEADER_VERSION = 1
+# sentinel, header size, header version, unused, unused
+TILT_HEADER_FORMAT = "<IHHII"
+
+SKETCH_SENTINEL = 0xC576A5CD
+SKETCH_VERSION_MIN = 5
+SKETCH_VERSION_MAX = 6
+
+# SketchWriter.StrokeExtension
+STROKE_EXT_MASK_SINGLE_WORD = 0xFFFF
+STROKE_EXT_FLAGS = 1 << 0
+STROKE_EXT_SCALE = 1 << 1
+STROKE_EXT_GROUP = 1 << 2
+STROKE_EXT_SEED = 1 << 3
+STROKE_EXT_LAYER = 1 << 4
+
+# SketchWriter.ControlPointExtension
+CP_EXT_PRESSURE = 1 << 0
+CP_EXT_TIMESTAMP = 1 << 1
+
+# Known single-word stroke extensions: bit -> (column name, dtype, default)
+STROKE_EXTENSIONS = {
+    STROKE_EXT_FLAGS: ("flags", np.uint32, 0),
+    STROKE_EXT_SCALE: ("scale", np.float32, 1.0),
+    STROKE_EXT_GROUP: ("group", np.uint32, 0),
+    STROKE_EXT_SEED: ("seed", np.int32, 0),
+    STROKE_EXT_LAYER: ("layer", np.uint32, 0),
+}
+
+# Known control point extensions: bit -> (column name, dtype, default)
+CP_EXTENSIONS = {
+    CP_EXT_PRESSURE: ("pressure", np.float32, 1.0),
+    CP_EXT_TIMESTAMP: ("timestamp", np.uint32, 0),
+}
+
+# Zip record layouts; same as the ones in zipfile.py
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_CENTRAL_DIR = struct.Struct("<4s4B4HL2L5H2L")
+ZIP_END_ARCHIVE = struct.Struct("<4s4H2LH")
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+# int32 brush_index, float32x4 color, float32 size, uint32 stroke mask, uint32 cp mask
+STROKE_HEADER = struct.Struct("<i4ffII")
+
+
+def iter_bits(mask):
+    """Yields the set bits of mask, from least to most significant."""
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask &= mask - 1
+
+
+def controlpoint_dtype(cp_mask):
+    """Returns the numpy structured dtype of one control point record."""
+    fields = [("position", "<f4", (3,)), ("orientation", "<f4", (4,))]
+    for bit in iter_bits(cp_mask):
+        name, dtype, _ = CP_EXTENSIONS.get(bit, ("ext_%08x" % bit, np.uint32, 0))
+        fields.append((name, np.dtype(dtype).newbyteorder("<")))
+    return np.dtype(fields)
+
+
+class Sketch:
+    """The contents of data.sketch, in columnar form.
+
+    Per-stroke arrays (length num_strokes):
+      brush_idx, brush_color (n, 4), brush_size, stroke_mask, cp_mask,
+      flags, scale, group, seed, layer, cp_offsets (length num_strokes + 1)
+    Per-control-point arrays (length num_controlpoints):
+      position (n, 3), orientation (n, 4), pressure, timestamp
+
+    Extension columns hold their defaults where the stroke's mask does not
+    contain them; the masks determine what gets written back out.
+    """
+
+    def __init__(self):
+        self.version = SKETCH_VERSION_MIN
+        self.additional_header = b""
+
+        self.brush_idx = np.zeros(0, np.int32)
+        self.brush_color = np.zeros((0, 4), np.float32)
+        self.brush_size = np.zeros(0, np.float32)
+        self.stroke_mask = np.zeros(0, np.uint32)
+        self.cp_mask = np.zeros(0, np.uint32)
+        for name, dtype, _ in STROKE_EXTENSIONS.values():
+            setattr(self, name, np.zeros(0, dtype))
+        self.cp_offsets = np.zeros(1, np.int64)
+
+        self.position = np.zeros((0, 3), np.float32)
+        self.orientation = np.zeros((0, 4), np.float32)
+        for name, dtype, _ in CP_EXTENSIONS.values():
+            setattr(self, name, np.zeros(0, dtype))
+
+        # Extensions that this module does not know about; preserved verbatim.
+        # stroke index -> {bit: bytes}
+        self.unknown_stroke_extensions = {}
+        # bit -> uint32 array covering all control points
+        self.unknown_cp_extensions = {}
+
+    @property
+    def num_strokes(self):
+        return len(self.brush_idx)
+
+    @property
+    def num_controlpoints(self):
+        return len(self.position)
+
+    def controlpoint_slice(self, stroke_index):
+        """Returns the slice of control point rows belonging to a stroke."""
+        return slice(
+            int(self.cp_offsets[stroke_index]), int(self.cp_offsets[stroke_index + 1])
+        )
+
+    def controlpoint_counts(self):
+        return np.diff(self.cp_offsets)
+
+    def stroke_index_per_controlpoint(self):
+        """Returns an array mapping each control point to its stroke."""
+        return np.repeat(
+            np.arange(self.num_strokes, dtype=np.int64), self.controlpoint_counts()
+        )
+
+    def select_strokes(self, keep):
+        """Returns a new Sketch with only the strokes selected by keep.
+        keep is a boolean mask or an array of stroke indices."""
+        keep = np.asarray(keep)
+        if keep.dtype == np.bool_:
+            keep = np.flatnonzero(keep)
+        keep = keep.astype(np.int64)
+        ret = Sketch()
+        ret.version = self.version
+        ret.additional_header = self.additional_header
+        for name in self._stroke_columns():
+            setattr(ret, name, getattr(self, name)[keep])
+        counts = self.controlpoint_counts()[keep]
+        ret.cp_offsets = np.zeros(len(keep) + 1, np.int64)
+        np.cumsum(counts, out=ret.cp_offsets[1:])
+        # Row i of the new control point arrays comes from row cp_keep[i]
+        cp_keep = np.arange(ret.cp_offsets[-1], dtype=np.int64) + np.repeat(
+            self.cp_offsets[keep] - ret.cp_offsets[:-1], counts
+        )
+        for name in self._cp_columns():
+            setattr(ret, name, getattr(self, name)[cp_keep])
+        ret.unknown_stroke_extensions = {
+            new_i: self.unknown_stroke_extensions[old_i]
+            for new_i, old_i in enumerate(keep.tolist())
+            if old_i in self.unknown_stroke_extensions
+        }
+        ret.unknown_cp_extensions = {
+            bit: arr[cp_keep] for bit, arr in self.unknown_cp_extensions.items()
+        }
+        return ret
+
+    @staticmethod
+    def _stroke_columns():
+        names = ["brush_idx", "brush_color", "brush_size", "stroke_mask", "cp_mask"]
+        names.extend(name for name, _, _ in STROKE_EXTENSIONS.values())
+        return names
+
+    @staticmethod
+    def _cp_columns():
+        names = ["position", "orientation"]
+        names.extend(name for name, _, _ in CP_EXTENSIONS.values())
+        return names
+
+    # ------------------------------------------------------------------
+    # Parsing
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def from_bytes(cls, data):  # pylint: disable=too-many-locals,too-many-statements
+        """Parses the contents of a data.sketch file."""
+        data = memoryview(data)
+        sentinel, version, _, more_header = struct.unpack_from("<IiiI", data, 0)
+        if sentinel != SKETCH_SENTINEL:
+            raise Exception("Invalid .sketch: bad sentinel 0x%08x" % sentinel)
+        if not SKETCH_VERSION_MIN <= version <= SKETCH_VERSION_MAX:
+            raise Exception("Invalid .sketch: unsupported version %d" % version)
+        self = cls()
+        self.version = version
+        pos = 16
+        self.additional_header = bytes(data[pos : pos + more_header])
+        pos += more_header
+        (num_strokes,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+
+        # First pass: walk the stroke headers, which are variable-length, and
+        # remember where each stroke's block of control point records lives.
+        brush_idx = np.empty(num_strokes, np.int32)
+        brush_color = np.empty((num_strokes, 4), np.float32)
+        brush_size = np.empty(num_strokes, np.float32)
+        stroke_mask = np.empty(num_strokes, np.uint32)
+        cp_mask = np.empty(num_strokes, np.uint32)
+        ext_columns = {
+            bit: np.full(num_strokes, default, dtype)
+            for bit, (_, dtype, default) in STROKE_EXTENSIONS.items()
+        }
+        ext_words = {
+            bit: struct.Struct("<" + np.dtype(dtype).char)
+            for bit, (_, dtype, _) in STROKE_EXTENSIONS.items()
+        }
+        cp_starts = [0] * num_strokes
+        cp_counts = np.empty(num_strokes, np.int64)
+        cp_strides = {}
+
+        unpack_header = STROKE_HEADER.unpack_from
+        header_size = STROKE_HEADER.size
+        for i in range(num_strokes):
+            idx, r, g, b, a, size, smask, cmask = unpack_header(data, pos)
+            pos += header_size
+            brush_idx[i] = idx
+            brush_color[i] = (r, g, b, a)
+            brush_size[i] = size
+            stroke_mask[i] = smask
+            cp_mask[i] = cmask
+            for bit in iter_bits(smask):
+                if bit in ext_columns:
+                    ext_columns[bit][i] = ext_words[bit].unpack_from(data, pos)[0]
+                    pos += 4
+                elif bit & STROKE_EXT_MASK_SINGLE_WORD:
+                    self.unknown_stroke_extensions.setdefault(i, {})[bit] = bytes(
+                        data[pos : pos + 4]
+                    )
+                    pos += 4
+                else:
+                    (n,) = struct.unpack_from("<I", data, pos)
+                    self.unknown_stroke_extensions.setdefault(i, {})[bit] = bytes(
+                        data[pos + 4 : pos + 4 + n]
+                    )
+                    pos += 4 + n
+            (n,) = struct.unpack_from("<i", data, pos)
+            pos += 4
+            try:
+                stride = cp_strides[cmask]
+            except KeyError:
+                stride = cp_strides[cmask] = controlpoint_dtype(cmask).itemsize
+            cp_starts[i] = pos
+            cp_counts[i] = n
+            pos += n * stride
+        if pos > len(data):
+            raise Exception("Invalid .sketch: truncated")
+
+        self.brush_idx = brush_idx
+        self.brush_color = brush_color
+        self.brush_size = brush_size
+        self.stroke_mask = stroke_mask
+        self.cp_mask = cp_mask
+        for bit, (name, _, _) in STROKE_EXTENSIONS.items():
+            setattr(self, name, ext_columns[bit])
+        self.cp_offsets = np.zeros(num_strokes + 1, np.int64)
+        np.cumsum(cp_counts, out=self.cp_offsets[1:])
+        self._decode_controlpoints(data, cp_starts, cp_counts)
+        return self
+
+    def _decode_controlpoints(self, data, cp_starts, cp_counts):
+        """Second pass: decode every stroke's control point records straight
+        out of the buffer, one np.frombuffer per stroke, grouped by mask."""
+        total = int(self.cp_offsets[-1])
+        self.position = np.empty((total, 3), np.float32)
+        self.orientation = np.empty((total, 4), np.float32)
+        for name, dtype, default in CP_EXTENSIONS.values():
+            setattr(self, name, np.full(total, default, dtype))
+
+        masks = np.unique(self.cp_mask)
+        for mask in masks.tolist():
+            dtype = controlpoint_dtype(mask)
+            if len(masks) == 1:
+                strokes = range(self.num_strokes)
+                rows = slice(None)
+            else:
+                strokes = np.flatnonzero(self.cp_mask == mask).tolist()
+                rows = np.concatenate(
+                    [
+                        np.arange(self.cp_offsets[i], self.cp_offsets[i + 1])
+                        for i in strokes
+                    ]
+                    or [np.zeros(0, np.int64)]
+                )
+            chunks = [
+                np.frombuffer(data, dtype, int(cp_counts[i]), cp_starts[i])
+                for i in strokes
+            ]
+            records = np.concatenate(chunks) if chunks else np.zeros(0, dtype)
+            for name in dtype.names:
+                if name.startswith("ext_"):
+                    bit = int(name[4:], 16)
+                    if bit not in self.unknown_cp_extensions:
+                        self.unknown_cp_extensions[bit] = np.zeros(total, np.uint32)
+                    self.unknown_cp_extensions[bit][rows] = records[name]
+                else:
+                    getattr(self, name)[rows] = records[name]
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def to_bytes(self):
+        """Returns the contents of a data.sketch file."""
+        parts = [
+            struct.pack(
+                "<IiiI",
+                SKETCH_SENTINEL,
+                self.version,
+                0,
+                len(self.additional_header),
+            ),
+            self.additional_header,
+            struct.pack("<i", self.num_strokes),
+        ]
+
+        # Encode the control point records of all strokes that share a mask
+        # in one go, then slice the bytes per stroke.
+        encoded = {}
+        for mask in np.unique(self.cp_mask).tolist():
+            dtype = controlpoint_dtype(mask)
+            rows = np.repeat(self.cp_mask == mask, self.controlpoint_counts())
+            records = np.empty(int(rows.sum()), dtype)
+            for name in dtype.names:
+                if name.startswith("ext_"):
+                    records[name] = self.unknown_cp_extensions[int(name[4:], 16)][rows]
+                else:
+                    records[name] = getattr(self, name)[rows]
+            encoded[mask] = (memoryview(records.tobytes()), dtype.itemsize, [0])
+
+        ext_words = {
+            bit: struct.Struct("<" + np.dtype(dtype).char)
+            for bit, (_, dtype, _) in STROKE_EXTENSIONS.items()
+        }
+        ext_columns = {
+            bit: getattr(self, name).tolist()
+            for bit, (name, _, _) in STROKE_EXTENSIONS.items()
+        }
+        pack_header = STROKE_HEADER.pack
+        counts = self.controlpoint_counts().tolist()
+        colors = self.brush_color.tolist()
+        for i, (idx, size, smask, cmask) in enumerate(
+            zip(
+                self.brush_idx.tolist(),
+                self.brush_size.tolist(),
+                self.stroke_mask.tolist(),
+                self.cp_mask.tolist(),
+            )
+        ):
+            parts.append(pack_header(idx, *colors[i], size, smask, cmask))
+            unknown = self.unknown_stroke_extensions.get(i, {})
+            for bit in iter_bits(smask):
+                if bit in ext_words:
+                    parts.append(ext_words[bit].pack(ext_columns[bit][i]))
+                elif bit & STROKE_EXT_MASK_SINGLE_WORD:
+                    parts.append(unknown[bit])
+                else:
+                    parts.append(struct.pack("<I", len(unknown[bit])))
+                    parts.append(unknown[bit])
+            parts.append(struct.pack("<i", counts[i]))
+            buf, stride, cursor = encoded[cmask]
+            end = cursor[0] + counts[i] * stride
+            parts.append(buf[cursor[0] : end])
+            cursor[0] = end
+        return b"".join(parts)
+
+
+class Tilt:
+    """A .tilt file or directory.
+
+    metadata and sketch are loaded lazily. Modify them in place, then call
+    write_sketch() to save."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._metadata = None
+        self._sketch = None
+
+    @staticmethod
+    def is_tilt_zip(filename):
+        """Returns True if filename is a zip-format .tilt with a valid header."""
+        with open(filename, "rb") as inf:
+            header = inf.read(TILT_HEADER_SIZE)
+        if len(header) < TILT_HEADER_SIZE:
+            return False
+        sentinel, header_size, header_version, _, _ = struct.unpack(
+            TILT_HEADER_FORMAT, header
+        )
+        return (
+            sentinel == TILT_SENTINEL
+            and header_version == TILT_HEADER_VERSION
+            and header_size >= TILT_HEADER_SIZE
+        )
+
+    def read_subfile(self, name):
+        """Returns the raw contents of one of the files inside the .tilt."""
+        if os.path.isdir(self.filename):
+            with open(os.path.join(self.filename, name), "rb") as inf:
+                return inf.read()
+        if not self.is_tilt_zip(self.filename):
+            raise Exception("Not a .tilt: %s" % self.filename)
+        with zipfile.ZipFile(self.filename) as zf:
+            return zf.read(name)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = json.loads(self.read_subfile(FN_METADATA))
+        return self._metadata
+
+    @property
+    def sketch(self):
+        if self._sketch is None:
+            self._sketch = Sketch.from_bytes(self.read_subfile(FN_SKETCH))
+        return self._sketch
+
+    @contextlib.contextmanager
+    def mutable_metadata(self):
+        """Context manager. Yields the metadata dict, and saves the .tilt
+        when the block exits without an exception."""
+        yield self.metadata
+        self.write_sketch()
+
+    def write_sketch(self):
+        """Writes metadata and sketch back out. Subfiles that were never
+        loaded are copied through unchanged."""
+        replacements = {}
+        if self._metadata is not None:
+            replacements[FN_METADATA] = json.dumps(self._metadata, indent=2).encode(
+                "utf-8"
+            )
+        if self._sketch is not None:
+            replacements[FN_SKETCH] = self._sketch.to_bytes()
+        if not replacements:
+            return
+
+        if os.path.isdir(self.filename):
+            for name, data in replacements.items():
+                tmpf = os.path.join(self.filename, name + "_part")
+                with open(tmpf, "wb") as outf:
+                    outf.write(data)
+                os.replace(tmpf, os.path.join(self.filename, name))
+            return
+
+        rewrite_tilt_zip(self.filename, replacements)
+
+
+# ----------------------------------------------------------------------
+# Raw zip rewriting
+# ----------------------------------------------------------------------
+
+
+def _copy_raw_member(inf, info, outf):
+    """Copies a member's local header, compressed data and data descriptor
+    from inf to outf, byte for byte."""
+    inf.seek(info.header_offset)
+    local_header = inf.read(ZIP_LOCAL_HEADER.size)
+    fields = ZIP_LOCAL_HEADER.unpack(local_header)
+    if fields[0] != b"PK\x03\x04":
+        raise Exception("Bad zip local header for %s" % info.filename)
+    length = fields[-2] + fields[-1] + info.compress_size
+    outf.write(local_header)
+    while length > 0:
+        data = inf.read(min(length, 1 << 20))
+        if not data:
+            raise Exception("Short read copying %s" % info.filename)
+        outf.write(data)
+        length -= len(data)
+    if info.flag_bits & ZIP_FLAG_DATA_DESCRIPTOR:
+        descriptor = inf.read(16)
+        if descriptor[:4] != ZIP_DATA_DESCRIPTOR_SIGNATURE:
+            descriptor = descriptor[:12]
+        outf.write(descriptor)
+
+
+def _write_stored_member(outf, info, data):
+    """Writes a new uncompressed member; fills in info's size fields."""
+    info.compress_type = zipfile.ZIP_STORED
+    info.flag_bits = 0
+    info.CRC = zlib.crc32(data)
+    info.compress_size = info.file_size = len(data)
+    info.extra = b""
+    name = info.filename.encode("utf-8")
+    if not info.filename.isascii():
+        info.flag_bits |= ZIP_FLAG_UTF8
+    dostime, dosdate = _dos_date_time(info.date_time)
+    outf.write(
+        ZIP_LOCAL_HEADER.pack(
+            b"PK\x03\x04",
+            info.extract_version,
+            info.reserved,
+            info.flag_bits,
+            info.compress_type,
+            dostime,
+            dosdate,
+            info.CRC,
+            info.compress_size,
+            info.file_size,
+            len(name),
+            0,
+        )
+    )
+    outf.write(name)
+    outf.write(data)
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (
+        hour << 11 | minute << 5 | second // 2,
+        (year - 1980) << 9 | month << 5 | day,
+    )
+
+
+def _central_dir_record(info, offset):
+    if info.flag_bits & ZIP_FLAG_UTF8:
+        name = info.filename.encode("utf-8")
+    else:
+        name = info.filename.encode("cp437")
+    dostime, dosdate = _dos_date_time(info.date_time)
+    return (
+        ZIP_CENTRAL_DIR.pack(
+            b"PK\x01\x02",
+            info.create_version,
+            info.create_system,
+            info.extract_version,
+            info.reserved,
+            info.flag_bits,
+            info.compress_type,
+            dostime,
+            dosdate,
+            info.CRC,
+            info.compress_size,
+            info.file_size,
+            len(name),
+            len(info.extra),
+            len(info.comment),
+            0,
+            info.internal_attr,
+            info.external_attr,
+            offset,
+        )
+        + name
+        + info.extra
+        + info.comment
+    )
+
+
+def rewrite_tilt_zip(filename, replacements):
+    """Rewrites a zip-format .tilt, replacing the contents of the members
+    named in replacements (name -> bytes), and adding any that are missing.
+
+    Other members (data.sketch, thumbnail.png, ...) are copied without being
+    decompressed or recompressed. The new file is written next to the old one
+    and renamed over it, as TiltFile.AtomicWriter does."""
+    replacements = dict(replacements)
+    tmpf = filename + "_part"
+    try:
+        with open(filename, "rb") as inf, open(tmpf, "wb") as outf:
+            infos = zipfile.ZipFile(inf).infolist()
+            outf.write(
+                struct.pack(
+                    TILT_HEADER_FORMAT,
+                    TILT_SENTINEL,
+                    TILT_HEADER_SIZE,
+                    TILT_HEADER_VERSION,
+                    0,
+                    0,
+                )
+            )
+            now = time.localtime(time.time())[:6]
+            central_dir = []
+            for info in infos:
+                # Like Unity, offsets are relative to the start of the zip
+                offset = outf.tell() - TILT_HEADER_SIZE
+                if info.filename in replacements:
+                    info.date_time = now
+                    _write_stored_member(outf, info, replacements.pop(info.filename))
+                else:
+                    _copy_raw_member(inf, info, outf)
+                central_dir.append(_central_dir_record(info, offset))
+            for name, data in replacements.items():
+                info = zipfile.ZipInfo(name, now)
+                offset = outf.tell() - TILT_HEADER_SIZE
+                _write_stored_member(outf, info, data)
+                central_dir.append(_central_dir_record(info, offset))
+
+            num_entries = len(central_dir)
+            central_dir_offset = outf.tell() - TILT_HEADER_SIZE
+            central_dir = b"".join(central_dir)
+            outf.write(central_dir)
+            outf.write(
+                ZIP_END_ARCHIVE.pack(
+                    b"PK\x05\x06",
+                    0,
+                    0,
+                    num_entries,
+                    num_entries,
+                    len(central_dir),
+                    central_dir_offset,
+                    0,
+                )
+            )
+        os.replace(tmpf, filename)
+    finally:
+        if os.path.exists(tmpf):
+            os.unlink(tmpf)
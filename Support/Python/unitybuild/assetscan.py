@@ -0,0 +1,223 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single-pass, incremental scan of a Unity project's Assets/ tree.
+
+Assets/ is walked once, and every file that can contain references is read
+once. Per-file results are cached on disk, keyed by path and validated by
+(mtime, size, content hash), so a rescan after a small change only re-reads
+and re-parses the files that changed. Cache misses are parsed in a process
+pool."""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import mmap
+import os
+import pickle
+import re
+
+import unitybuild.tb_refgraph as tb
+
+# Bump this whenever the contents of a per-file result change
+SCANNER_VERSION = 3
+# Kept with Unity's own per-checkout state, out of version control
+CACHE_FILE = "Library/refgraph_scan.cache"
+
+META_GUID_PAT = re.compile(rb"^guid: ([a-f0-9]{32})\s*$", re.M)
+GUID_PAT = re.compile(rb"(?<!Hash: )\b([a-f0-9]{32})\b")
+CONTAINS_NO_GUIDS = frozenset("""
+  fbx obj dae wav txt pdf
+  tga png psd tif jpg jpeg
+  shader cginc cs cpp c h
+  dll so jar""".split())
+
+# Files at least this big are mmapped rather than read; scenes can be
+# hundreds of MB, and this keeps them out of the Python heap.
+MIN_SIZE_FOR_MMAP = 1 << 16
+
+# Below this many cache misses, a process pool costs more than it saves
+MIN_FILES_FOR_POOL = 64
+
+
+class AssetScan:
+    """The result of scanning a project.
+    .results  dict mapping relative path (forward slashes) -> per-file result
+
+    The per-file result for a .meta file is (own_guid, referenced_guids).
+    The per-file result for an asset body is (referenced_guids, command_refs);
+    see tb_refgraph.find_command_refs for the latter."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def iter_guid_names(self):
+        """Find all file guids and their corresponding filename (without the ".meta")
+        Yields (guid, filename)"""
+        for name, result in self.results.items():
+            if name.endswith(".meta"):
+                yield result[0], name[:-5]
+        # 0000000000000000e000000000000000 and 0000000000000000f000000000000000
+        # are some sort of hardcoded guid?
+        yield ("0000000000000000e000000000000000", "?Unity hardcoded 0e?")
+        yield ("0000000000000000f000000000000000", "?Unity hardcoded 0f?")
+
+    def iter_refs(self):
+        """Yields (src_guid, dst_guid)"""
+        for name, result in self.results.items():
+            if name.endswith(".meta"):
+                # A .meta file contains its own guid, but sometimes it contains
+                # others (eg, MonoBehaviour may have default asset references)
+                src_guid, dst_guids = result
+            else:
+                src_guid = self.results[name + ".meta"][0]
+                dst_guids = result[0]
+            for dst_guid in dst_guids:
+                if dst_guid != src_guid:
+                    yield src_guid, dst_guid
+
+    def iter_command_refs(self):
+        """Yields (filename, command_refs) for files that refer to GlobalCommands."""
+        for name, result in self.results.items():
+            if not name.endswith(".meta") and result[1]:
+                yield name, result[1]
+
+
+def _find_guids(data):
+    """Returns the sorted, unique guids in data, as strings."""
+    guids = {match.group(1) for match in GUID_PAT.finditer(data)}
+    return tuple(sorted(guid.decode("ascii") for guid in guids))
+
+
+def _scan_contents(name, data):
+    """Returns the per-file result for a file's contents.
+    data is bytes or an mmap."""
+    if name.endswith(".meta"):
+        m = META_GUID_PAT.search(data)
+        if m is None:
+            raise LookupError("No guid in %s" % (name,))
+        return m.group(1).decode("ascii"), _find_guids(data)
+    guids = _find_guids(data) if _may_contain_guids(name) else ()
+    return guids, tb.find_command_refs(name, data)
+
+
+@contextlib.contextmanager
+def _open_contents(fullpath):
+    """Yields the contents of fullpath, as bytes or a read-only mmap."""
+    with open(fullpath, "rb") as inf:
+        size = os.fstat(inf.fileno()).st_size
+        if size < MIN_SIZE_FOR_MMAP:
+            yield inf.read()
+        else:
+            with mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def _scan_file(job):
+    """Reads and parses a single file; runs in a worker process.
+    job is (fullpath, name, cached_digest, cached_result).
+    Returns (name, digest, result)."""
+    fullpath, name, cached_digest, cached_result = job
+    with _open_contents(fullpath) as data:
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == cached_digest:
+            # Touched but not modified
+            return name, digest, cached_result
+        return name, digest, _scan_contents(name, data)
+
+
+def _may_contain_guids(filename):
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return ext not in CONTAINS_NO_GUIDS
+
+
+def _iter_scannable_files(project_dir):
+    """Yields (fullpath, name) for every file that should be scanned: all .meta
+    files, and the bodies of the assets they describe unless the asset type
+    can contain neither guids nor command references. name is relative to
+    project_dir, with forward slashes."""
+    chop = len(project_dir) + 1
+    for r, _, fs in os.walk(os.path.join(project_dir, "Assets")):
+        fs_set = set(fs)
+        for f in fs:
+            if not f.endswith(".meta") and (
+                f + ".meta" not in fs_set
+                or not (_may_contain_guids(f) or tb.may_contain_command_refs(f))
+            ):
+                continue
+            fullf = os.path.join(r, f)
+            yield fullf, fullf[chop:].replace("\\", "/")
+
+
+def _load_cache(cache_name):
+    try:
+        with open(cache_name, "rb") as inf:
+            cache = pickle.load(inf)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return {}
+    if cache.get("version") != SCANNER_VERSION:
+        return {}
+    return cache["entries"]
+
+
+def _save_cache(cache_name, entries):
+    os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+    tmpf = cache_name + "_part"
+    with open(tmpf, "wb") as outf:
+        pickle.dump({"version": SCANNER_VERSION, "entries": entries}, outf, -1)
+    os.replace(tmpf, cache_name)
+
+
+def scan_project(project_dir, jobs=None, use_cache=True):
+    """Scans project_dir/Assets and returns an AssetScan.
+    jobs is the number of worker processes (default: one per cpu).
+    If use_cache is False, every file is re-read and re-parsed."""
+    project_dir = os.path.abspath(project_dir)
+    cache_name = os.path.join(project_dir, CACHE_FILE)
+    old_entries = _load_cache(cache_name) if use_cache else {}
+
+    # name -> (mtime_ns, size, digest, result)
+    entries = {}
+    misses = []
+    stats = {}
+    for fullpath, name in _iter_scannable_files(project_dir):
+        st = os.stat(fullpath)
+        old = old_entries.get(name)
+        if old is not None and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+            entries[name] = old
+            continue
+        stats[name] = (st.st_mtime_ns, st.st_size)
+        if old is None:
+            misses.append((fullpath, name, None, None))
+        else:
+            misses.append((fullpath, name, old[2], old[3]))
+
+    if misses:
+        print("Scanning %d of %d files" % (len(misses), len(entries) + len(misses)))
+        if jobs == 1 or len(misses) < MIN_FILES_FOR_POOL:
+            pool = None
+            scanned = map(_scan_file, misses)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(jobs)
+            scanned = pool.map(_scan_file, misses, chunksize=32)
+        try:
+            for name, digest, result in scanned:
+                entries[name] = stats[name] + (digest, result)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    if use_cache and (misses or len(entries) != len(old_entries)):
+        _save_cache(cache_name, entries)
+    return AssetScan({name: entry[3] for name, entry in entries.items()})
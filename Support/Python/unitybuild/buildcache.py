@@ -0,0 +1,117 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local store of finished builds, keyed by a digest of their inputs.
+
+The key covers everything that goes into a build: the git tree, the contents
+of ProjectSettings/ (which may legitimately differ from the tree; see
+GitVcs.get_build_stamp), the Unity executable, and the build flags, including
+the stamp that is embedded into the build. A build with the same key can be
+restored instead of running Unity again.
+
+Entries are stored as plain directories and restored with hard links, so a
+hit costs no copying."""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from unitybuild.workspace import mirror_tree
+
+# Bump this to invalidate all existing entries
+CACHE_VERSION = 1
+INFO_FILE = "cache_info.json"
+
+
+def _hash_tree(digest, directory):
+    """Adds the names and contents of all files under directory to digest."""
+    for r, ds, fs in os.walk(directory):
+        ds.sort()
+        for f in sorted(fs):
+            fullf = os.path.join(r, f)
+            digest.update(os.path.relpath(fullf, directory).replace("\\", "/").encode())
+            digest.update(b"\0")
+            with open(fullf, "rb") as inf:
+                digest.update(hashlib.blake2b(inf.read()).digest())
+
+
+class BuildCache:
+    """A directory of finished builds, one subdirectory per key.
+    Keeps at most max_entries builds, discarding the least recently used."""
+
+    def __init__(self, cache_dir, tree_hash, project_dir, max_entries=8):
+        self.cache_dir = cache_dir
+        self.tree_hash = tree_hash
+        self.project_dir = project_dir
+        self.max_entries = max_entries
+
+    def key(self, unity_exe, **flags):
+        """Returns the cache key for a build of the current tree.
+        flags are the build's options (platform, stamp, etc); values must be
+        json-serializable."""
+        digest = hashlib.blake2b(digest_size=20)
+        inputs = {
+            "version": CACHE_VERSION,
+            "tree": self.tree_hash,
+            "unity_exe": os.path.realpath(unity_exe),
+            "flags": flags,
+        }
+        digest.update(json.dumps(inputs, sort_keys=True).encode())
+        _hash_tree(digest, os.path.join(self.project_dir, "ProjectSettings"))
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, dst_dir):
+        """Makes dst_dir a copy of the cached build for key.
+        Returns False, leaving dst_dir alone, if there is no such build."""
+        entry = self._entry_dir(key)
+        if not os.path.isfile(os.path.join(entry, INFO_FILE)):
+            return False
+        mirror_tree(os.path.join(entry, "build"), dst_dir, link=True)
+        # Mark as recently used, for pruning
+        os.utime(os.path.join(entry, INFO_FILE))
+        return True
+
+    def store(self, key, src_dir, **info):
+        """Adds the finished build in src_dir to the cache under key.
+        info is recorded alongside, for humans."""
+        entry = self._entry_dir(key)
+        tmp_entry = entry + "_part"
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        mirror_tree(src_dir, os.path.join(tmp_entry, "build"), link=True)
+        info = dict(info, key=key, tree=self.tree_hash, time=time.time())
+        with open(os.path.join(tmp_entry, INFO_FILE), "w") as outf:
+            json.dump(info, outf, indent=2, sort_keys=True)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp_entry, entry)
+        self.prune()
+
+    def prune(self):
+        """Removes the least recently used entries beyond max_entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            info = os.path.join(self.cache_dir, name, INFO_FILE)
+            try:
+                entries.append((os.stat(info).st_mtime, name))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        for _, name in entries[self.max_entries :]:
+            shutil.rmtree(self._entry_dir(name), ignore_errors=True)
@@ -0,0 +1,395 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact, immutable directed graph stored as CSR arrays.
+
+Node keys (guids, or names like 'GlobalCommands.Foo') are interned to
+integer ids. Forward and reverse adjacency are kept in compressed sparse
+row form: the successors of node i are fwd_indices[fwd_indptr[i]:fwd_indptr[i+1]].
+
+The whole graph, including a string table of keys and display names, is
+saved to a single versioned binary file that is memory-mapped on load.
+
+File layout (little-endian; every section starts on an 8-byte boundary):
+  char[8]  magic
+  uint32   version
+  uint32   num_nodes
+  uint64   num_edges
+  int64    fwd_indptr[num_nodes + 1]
+  int32    fwd_indices[num_edges]
+  int64    rev_indptr[num_nodes + 1]
+  int32    rev_indices[num_edges]
+  int64    key_offsets[num_nodes + 1]
+  bytes    key_blob      (utf-8)
+  int64    name_offsets[num_nodes + 1]
+  bytes    name_blob     (utf-8; empty name means "no name")
+"""
+
+import mmap
+import os
+import struct
+
+import numpy as np  # pylint: disable=import-error
+
+MAGIC = b"TBREFGR\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+
+
+class NoPath(LookupError):
+    pass
+
+
+def _align8(n):
+    return (n + 7) & ~7
+
+
+def _build_csr(num_nodes, src, dst):
+    """Returns (indptr, indices) for edges src[i] -> dst[i]."""
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(num_nodes + 1, np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32)
+
+
+def _build_string_table(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, b"".join(encoded)
+
+
+def _gather_neighbors(indptr, indices, nodes):
+    """Returns (sources, neighbors) for all edges out of nodes."""
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    ends = np.cumsum(counts)
+    # Index of each edge within indices[], without a python-level loop
+    idx = np.arange(total, dtype=np.int64) + np.repeat(starts - (ends - counts), counts)
+    return np.repeat(nodes, counts), indices[idx]
+
+
+class CsrGraph:
+    """A directed graph over string keys.
+    .keys          list of node keys, indexed by id
+    .names         list of display names, indexed by id ("" if none)
+    .fwd_indptr, .fwd_indices, .rev_indptr, .rev_indices   CSR arrays"""
+
+    def __init__(self, keys, names, fwd, rev, backing=None):
+        self.keys = keys
+        self.names = names
+        self.fwd_indptr, self.fwd_indices = fwd
+        self.rev_indptr, self.rev_indices = rev
+        self.key_to_id = {k: i for i, k in enumerate(keys)}
+        # Keeps the mmap alive, if there is one
+        self._backing = backing
+
+    @classmethod
+    def from_edges(cls, node_names, edges):
+        """node_names: dict mapping key -> display name (or None)
+        edges: iterable of (src_key, dst_key). Keys that only appear in
+        edges become nameless nodes. Duplicate edges are dropped."""
+        edges = list(edges)
+        all_keys = set(node_names)
+        for src, dst in edges:
+            all_keys.add(src)
+            all_keys.add(dst)
+        keys = sorted(all_keys)
+        key_to_id = {k: i for i, k in enumerate(keys)}
+        names = [node_names.get(k) or "" for k in keys]
+
+        pairs = np.array(
+            [(key_to_id[s], key_to_id[d]) for s, d in edges], np.int64
+        ).reshape(-1, 2)
+        pairs = np.unique(pairs, axis=0)
+        src, dst = pairs[:, 0], pairs[:, 1]
+        return cls(
+            keys,
+            names,
+            _build_csr(len(keys), src, dst),
+            _build_csr(len(keys), dst, src),
+        )
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, filename):
+        """Writes the graph to filename, atomically."""
+        key_offsets, key_blob = _build_string_table(self.keys)
+        name_offsets, name_blob = _build_string_table(self.names)
+        sections = [
+            np.ascontiguousarray(self.fwd_indptr, "<i8").tobytes(),
+            np.ascontiguousarray(self.fwd_indices, "<i4").tobytes(),
+            np.ascontiguousarray(self.rev_indptr, "<i8").tobytes(),
+            np.ascontiguousarray(self.rev_indices, "<i4").tobytes(),
+            key_offsets.astype("<i8").tobytes(),
+            key_blob,
+            name_offsets.astype("<i8").tobytes(),
+            name_blob,
+        ]
+        tmpf = filename + "_part"
+        with open(tmpf, "wb") as outf:
+            outf.write(
+                HEADER.pack(MAGIC, VERSION, len(self.keys), len(self.fwd_indices))
+            )
+            for section in sections:
+                outf.write(section)
+                outf.write(b"\0" * (_align8(len(section)) - len(section)))
+        os.replace(tmpf, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Memory-maps a graph written by save().
+        Raises IOError if the file is missing or has the wrong version."""
+        with open(filename, "rb") as inf:
+            buf = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buf) < HEADER.size:
+            raise IOError("%s: truncated" % filename)
+        magic, version, num_nodes, num_edges = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise IOError("%s: not a version %d graph file" % (filename, VERSION))
+
+        pos = [HEADER.size]
+
+        def take(dtype, count):
+            arr = np.frombuffer(buf, dtype, count, pos[0])
+            pos[0] += _align8(arr.nbytes)
+            return arr
+
+        def take_strings():
+            offsets = take("<i8", num_nodes + 1)
+            blob = take("u1", int(offsets[-1])).tobytes()
+            offsets = offsets.tolist()
+            return [
+                blob[offsets[i] : offsets[i + 1]].decode("utf-8")
+                for i in range(num_nodes)
+            ]
+
+        fwd = (take("<i8", num_nodes + 1), take("<i4", num_edges))
+        rev = (take("<i8", num_nodes + 1), take("<i4", num_edges))
+        keys = take_strings()
+        names = take_strings()
+        return cls(keys, names, fwd, rev, backing=buf)
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def __contains__(self, key):
+        return key in self.key_to_id
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nodes(self):
+        return list(self.keys)
+
+    def num_edges(self):
+        return len(self.fwd_indices)
+
+    def successors(self, key):
+        i = self.key_to_id[key]
+        ids = self.fwd_indices[self.fwd_indptr[i] : self.fwd_indptr[i + 1]]
+        return [self.keys[j] for j in ids.tolist()]
+
+    def predecessors(self, key):
+        i = self.key_to_id[key]
+        ids = self.rev_indices[self.rev_indptr[i] : self.rev_indptr[i + 1]]
+        return [self.keys[j] for j in ids.tolist()]
+
+    def bfs(self, source_id, reverse=False, stop_at=None):
+        """Level-synchronous breadth-first search from source_id.
+        Returns (dist, parent): int32 arrays indexed by node id, -1 where
+        unreached. parent[] forms a shortest-path tree.
+        If stop_at is a node id, the search ends once it is reached."""
+        if reverse:
+            indptr, indices = self.rev_indptr, self.rev_indices
+        else:
+            indptr, indices = self.fwd_indptr, self.fwd_indices
+        n = len(self.keys)
+        dist = np.full(n, -1, np.int32)
+        parent = np.full(n, -1, np.int32)
+        dist[source_id] = 0
+        frontier = np.array([source_id], np.int64)
+        level = 0
+        while len(frontier) and (stop_at is None or dist[stop_at] < 0):
+            level += 1
+            sources, neighbors = _gather_neighbors(indptr, indices, frontier)
+            fresh = dist[neighbors] < 0
+            neighbors, first = np.unique(neighbors[fresh], return_index=True)
+            dist[neighbors] = level
+            parent[neighbors] = sources[fresh][first]
+            frontier = neighbors.astype(np.int64)
+        return dist, parent
+
+    def shortest_path(self, source, target):
+        """Returns a list of keys from source to target, inclusive.
+        Raises NoPath if target is unreachable."""
+        src = self.key_to_id[source]
+        dst = self.key_to_id[target]
+        _, parent = self.bfs(src, stop_at=dst)
+        if src != dst and parent[dst] < 0:
+            raise NoPath("No path from %s to %s" % (source, target))
+        path = [dst]
+        while path[-1] != src:
+            path.append(int(parent[path[-1]]))
+        path.reverse()
+        return [self.keys[i] for i in path]
+
+    def postorder(self, source_id):
+        """Returns the node ids reachable from source_id, in DFS postorder."""
+        indptr = self.fwd_indptr.tolist()
+        indices = self.fwd_indices.tolist()
+        visited = [False] * len(self.keys)
+        visited[source_id] = True
+        order = []
+        # Stack of (node, next edge index)
+        stack = [(source_id, indptr[source_id])]
+        while stack:
+            node, edge = stack[-1]
+            end = indptr[node + 1]
+            while edge < end and visited[indices[edge]]:
+                edge += 1
+            if edge < end:
+                child = indices[edge]
+                visited[child] = True
+                stack[-1] = (node, edge + 1)
+                stack.append((child, indptr[child]))
+            else:
+                stack.pop()
+                order.append(node)
+        return order
+
+    def immediate_dominators(self, source_id):
+        """Returns an int32 array mapping each node id to its immediate
+        dominator, -1 if unreachable from source_id. idom[source_id] is
+        source_id. Uses the iterative algorithm of Cooper, Harvey and Kennedy,
+        "A Simple, Fast Dominance Algorithm"."""
+        postorder = self.postorder(source_id)
+        po_number = np.full(len(self.keys), -1, np.int64)
+        po_number[postorder] = np.arange(len(postorder))
+        po_number = po_number.tolist()
+        idom = [-1] * len(self.keys)
+        idom[source_id] = source_id
+        rev_indptr = self.rev_indptr.tolist()
+        rev_indices = self.rev_indices.tolist()
+
+        def intersect(a, b):
+            while a != b:
+                while po_number[a] < po_number[b]:
+                    a = idom[a]
+                while po_number[b] < po_number[a]:
+                    b = idom[b]
+            return a
+
+        reverse_postorder = postorder[::-1][1:]
+        changed = True
+        while changed:
+            changed = False
+            for node in reverse_postorder:
+                new_idom = -1
+                for pred in rev_indices[rev_indptr[node] : rev_indptr[node + 1]]:
+                    if idom[pred] == -1:
+                        continue
+                    new_idom = pred if new_idom == -1 else intersect(pred, new_idom)
+                if idom[node] != new_idom:
+                    idom[node] = new_idom
+                    changed = True
+        return np.array(idom, np.int32)
+
+    def strongly_connected_components(self):
+        """Returns (component, num_components). component is an int32 array
+        mapping node id to component id. Component ids are in reverse
+        topological order: edges only go from higher to lower or equal ids.
+        Uses an iterative version of Tarjan's algorithm."""
+        indptr = self.fwd_indptr.tolist()
+        indices = self.fwd_indices.tolist()
+        n = len(self.keys)
+        index = [-1] * n
+        lowlink = [0] * n
+        on_stack = [False] * n
+        component = [-1] * n
+        scc_stack = []
+        num_components = 0
+        counter = 0
+        for root in range(n):
+            if index[root] >= 0:
+                continue
+            index[root] = lowlink[root] = counter
+            counter += 1
+            scc_stack.append(root)
+            on_stack[root] = True
+            # Stack of (node, next edge index)
+            stack = [(root, indptr[root])]
+            while stack:
+                node, edge = stack[-1]
+                end = indptr[node + 1]
+                while edge < end:
+                    child = indices[edge]
+                    edge += 1
+                    if index[child] < 0:
+                        break
+                    if on_stack[child] and index[child] < lowlink[node]:
+                        lowlink[node] = index[child]
+                else:
+                    child = None
+                if child is not None:
+                    stack[-1] = (node, edge)
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    scc_stack.append(child)
+                    on_stack[child] = True
+                    stack.append((child, indptr[child]))
+                    continue
+                stack.pop()
+                if stack and lowlink[node] < lowlink[stack[-1][0]]:
+                    lowlink[stack[-1][0]] = lowlink[node]
+                if lowlink[node] == index[node]:
+                    while True:
+                        member = scc_stack.pop()
+                        on_stack[member] = False
+                        component[member] = num_components
+                        if member == node:
+                            break
+                    num_components += 1
+        return np.array(component, np.int32), num_components
+
+    def reachable_targets(self, target_ids):
+        """For every node, computes which of target_ids it can reach (a node
+        reaches itself). Every node is visited once, in reverse topological
+        order over strongly connected components, and shares its result with
+        all of its predecessors.
+        Returns a list indexed by node id of int bitmasks; bit k is set if
+        target_ids[k] is reachable."""
+        component, num_components = self.strongly_connected_components()
+        component = component.tolist()
+        masks = [0] * num_components
+        for k, target in enumerate(target_ids):
+            masks[component[target]] |= 1 << k
+        # Group edges by source component; ids are already in reverse
+        # topological order, so successors are always finished first.
+        indptr = self.fwd_indptr.tolist()
+        indices = self.fwd_indices.tolist()
+        members = [[] for _ in range(num_components)]
+        for node, c in enumerate(component):
+            members[c].append(node)
+        for c in range(num_components):
+            mask = masks[c]
+            for node in members[c]:
+                for child in indices[indptr[node] : indptr[node + 1]]:
+                    mask |= masks[component[child]]
+            masks[c] = mask
+        return [masks[c] for c in component]
@@ -13,64 +13,154 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Generates Support/ThirdParty/GeneratedThirdPartyNotices.txt from the
+NOTICE files of the third-party code in Assets/ThirdParty.
+
+The contents of notice files are cached (keyed by size and mtime) in
+NOTICE_CACHE_FILE, and the output is only rewritten when it changes."""
+
+import codecs
+import concurrent.futures
+import hashlib
+import json
 import os
-import io
 import re
-import codecs
+import sys
+
+if __name__ == "__main__":
+    # Run as a script (eg by CI) rather than imported from the unitybuild package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unitybuild.constants import (  # pylint: disable=wrong-import-position
+    BuildFailed,
+)
 
+OUTPUT_FILE = "Support/ThirdParty/GeneratedThirdPartyNotices.txt"
+NOTICE_CACHE_FILE = "Library/notice.cache"
+NOTICE_CACHE_VERSION = 1
 
-class BuildFailed(Exception):
-    pass
-
-
-def create_notice_file(project_dir):
-    def iter_notice_files():
-        """Yields (library_name, notice_file_name) tuples."""
-        root = os.path.join(project_dir, "Assets/ThirdParty")
-        if not os.path.exists(root):
-            raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
-        for r, d, fs in os.walk(root):
-            d.sort()
-            for f in fs:
-                if f.lower() in (
-                    "notice",
-                    "notice.txt",
-                    "notice.tiltbrush",
-                    "notice.md",
-                ):
-                    yield (os.path.basename(r), os.path.join(r, f))
-        root = os.path.join(project_dir, "Assets/ThirdParty/NuGet/Packages")
-        if not os.path.exists(root):
-            raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
-        for r, d, fs in os.walk(root):
-            d.sort()
-            for f in sorted(fs):
-                if f.lower() in ("notice", "notice.md", "notice.txt"):
-                    m = re.match(r"\D+", os.path.basename(r))
-                    if m:
-                        name = m.group(0).rstrip(".")
-                        if name[-2:] == ".v" or name[-2:] == ".V":
-                            name = name[:-2]
-                        yield (name, os.path.join(r, f))
-
-    tmpf = io.StringIO()
-    tmpf.write("""This file is automatically generated.
+THIRD_PARTY_NOTICE_NAMES = ("notice", "notice.txt", "notice.tiltbrush", "notice.md")
+NUGET_NOTICE_NAMES = ("notice", "notice.md", "notice.txt")
+
+HEADER = """This file is automatically generated.
 This software makes use of third-party software with the following notices.
-""")
-    for library_name, notice_file in iter_notice_files():
-        tmpf.write("\n\n=== %s ===\n" % library_name)
-        with open(notice_file) as inf:
-            contents = inf.read()
-            if contents.startswith(str(codecs.BOM_UTF8)):
-                contents = contents[len(codecs.BOM_UTF8) :]
-        tmpf.write(contents)
-        tmpf.write("\n")
-
-    output_filename = os.path.join(
-        project_dir, "Support/ThirdParty/GeneratedThirdPartyNotices.txt"
-    )
-    with open(output_filename, "w") as outf:
-        outf.write(tmpf.getvalue())
+"""
+
+
+def _iter_files(root, names):
+    """Yields (directory, path) for files under root whose lowercased names are
+    in names. Directories and files are visited in sorted order."""
+    with os.scandir(root) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif entry.name.lower() in names:
+            yield root, entry.path
+    for subdir in subdirs:
+        yield from _iter_files(subdir, names)
+
+
+def iter_notice_files(project_dir):
+    """Yields (library_name, notice_file_name) tuples."""
+    root = os.path.join(project_dir, "Assets/ThirdParty")
+    if not os.path.exists(root):
+        raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
+    for r, f in _iter_files(root, THIRD_PARTY_NOTICE_NAMES):
+        yield (os.path.basename(r), f)
+    root = os.path.join(project_dir, "Assets/ThirdParty/NuGet/Packages")
+    if not os.path.exists(root):
+        raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
+    for r, f in _iter_files(root, NUGET_NOTICE_NAMES):
+        m = re.match(r"\D+", os.path.basename(r))
+        if m:
+            name = m.group(0).rstrip(".")
+            if name[-2:] == ".v" or name[-2:] == ".V":
+                name = name[:-2]
+            yield (name, f)
+
+
+def _read_notice(notice_file):
+    """Returns the text of a notice file, without any BOM, with \\n line endings."""
+    with open(notice_file, "rb") as inf:
+        data = inf.read()
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8) :]
+    text = data.decode("utf-8")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _load_cache(filename):
+    """Returns dict mapping path -> [size, mtime_ns, digest, text]."""
+    try:
+        with open(filename, encoding="utf-8") as inf:
+            data = json.load(inf)
+    except (IOError, ValueError):
+        return {}
+    if data.get("version") != NOTICE_CACHE_VERSION:
+        return {}
+    return data["files"]
+
+
+def _save_cache(filename, files):
+    tmpf = "%s_part%d" % (filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmpf, "w", encoding="utf-8") as outf:
+            json.dump({"version": NOTICE_CACHE_VERSION, "files": files}, outf)
+        os.replace(tmpf, filename)
+    except IOError as e:
+        print("WARN: could not write %s: %s" % (filename, e))
+
+
+def read_notices(notice_files, cache, jobs=None):
+    """Returns the text of each of notice_files, reading only those whose size or
+    mtime differ from their entry in cache. Updates cache in place."""
+    stats = [os.stat(f) for f in notice_files]
+
+    def read(notice_file, st):
+        entry = cache.get(notice_file)
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry
+        text = _read_notice(notice_file)
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        return [st.st_size, st.st_mtime_ns, digest, text]
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        entries = list(pool.map(read, notice_files, stats))
+    cache.clear()
+    cache.update(zip(notice_files, entries))
+    return [entry[3] for entry in entries]
+
+
+def create_notice_file(project_dir, jobs=None):
+    """Regenerates the NOTICE file. Returns True if its contents changed."""
+    notices = list(iter_notice_files(project_dir))
+    cache_file = os.path.join(project_dir, NOTICE_CACHE_FILE)
+    cache = _load_cache(cache_file)
+    old_cache = dict(cache)
+    texts = read_notices([f for _, f in notices], cache, jobs)
+    if cache != old_cache:
+        _save_cache(cache_file, cache)
+
+    parts = [HEADER]
+    for (library_name, _), text in zip(notices, texts):
+        parts.append("\n\f\n=== %s ===\n" % library_name)
+        parts.append(text)
+        parts.append("\n")
+    contents = "".join(parts)
+
+    output_filename = os.path.join(project_dir, OUTPUT_FILE)
+    try:
+        with open(output_filename, encoding="utf-8") as inf:
+            if inf.read() == contents:
+                return False
+    except (IOError, UnicodeDecodeError):
+        pass
+    with open(output_filename, "w", encoding="utf-8") as outf:
+        outf.write(contents)
+    return True
 
 
 def main(project_dir):
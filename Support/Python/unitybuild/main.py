@@ -62,6 +62,7 @@ from platform import node as platform_node  # Don't overwrite 'platform' local v
 
 import unitybuild.utils
 import unitybuild.push
+from unitybuild.buildcache import BuildCache
 from unitybuild.constants import (
     Error,
     UserError,
@@ -70,6 +71,10 @@ from unitybuild.constants import (
     InternalError,
 )
 from unitybuild.credentials import get_credential, TB_OCULUS_QUEST_APP_ID
+from unitybuild.generate_notice import create_notice_file
+from unitybuild.scheduler import run_matrix
+from unitybuild.timing import BuildTimer, print_report, read_history
+from unitybuild.unitylog import UnityLogAnalyzer
 from unitybuild.vcs import create as vcs_create
 
 VENDOR_NAME = "Icosa"
@@ -82,69 +87,97 @@ is_linux = sys.platform.startswith("linux")
 
 
 class LogTailer(threading.Thread):
-    """Copy interesting lines from Unity's logfile to stdout.
+    """Streams Unity's logfile, as it is written, to subscribers.
     Necessary because Unity's batchmode is completely silent on Windows.
 
+    Subscribers are called on the tailer's thread with each complete line,
+    without its line terminator; see subscribe(). On Linux the tailer sleeps
+    on inotify and wakes as soon as Unity writes; elsewhere it polls.
+
     When used in a "with" block, *logfile* is guaranteed to be closed
-    after the block exits."""
+    and fully consumed after the block exits."""
 
     POLL_TIME = 0.5
+    READ_SIZE = 1 << 20
 
-    def __init__(self, logfile, disabled=False):
+    def __init__(self, logfile):
         super().__init__()
         self.daemon = True
         self.logfile = logfile
-        # It's not very easy to have optional context managers in Python,
-        # so allow caller to pass an arg that makes this essentially a no-op
-        self.should_exit = disabled
+        self.should_exit = False
+        self.subscribers = []
+
+    def subscribe(self, on_line, on_close=None):
+        """on_line(line) is called for every line of the log.
+        on_close() is called once the whole log has been consumed."""
+        self.subscribers.append((on_line, on_close))
 
     def __enter__(self):
         self.start()
 
     def __exit__(self, *args):
-        # Joining the thread is the easiest and safest way to close the logfile
+        # Joining the thread is the easiest and safest way to close the logfile.
+        # Join in a loop so that Ctrl-C still works while the rest of the log
+        # is consumed.
         self.should_exit = True
         try:
-            self.join(self.POLL_TIME + 0.5)
+            while self.is_alive():
+                self.join(self.POLL_TIME)
         except RuntimeError:
             # This exception is expected if the thread hasn't been started yet.
             pass
         sys.stdout.write("%-79s\r" % "")  # clear line
         return False
 
+    def _publish(self, lines):
+        for on_line, _ in self.subscribers:
+            for line in lines:
+                on_line(line)
+
     def run(self):
+        watcher = unitybuild.utils.create_dir_watcher(
+            os.path.dirname(os.path.abspath(self.logfile))
+        )
+        try:
+            self._run(watcher)
+        finally:
+            watcher.close()
+
+    def _run(self, watcher):
         # Wait for file to be created
         while not os.access(self.logfile, os.R_OK):
             if self.should_exit:
                 return
-            time.sleep(self.POLL_TIME)
+            watcher.wait(self.POLL_TIME)
 
-        # All of BuildTiltBrush.CommandLine()'s output is prefixed with _btb_
-        munge_pat = re.compile("Updating (Assets/.*) - GUID")
-        progress_pat = re.compile("(_btb_ |DisplayProgressbar: )(.*)")
-        with open(self.logfile) as inf:
+        partial = ""
+        with open(self.logfile, encoding="utf-8", errors="replace", newline="") as inf:
             while True:
-                where = inf.tell()
-                line = inf.readline()
-                try:
-                    if not line:
-                        if self.should_exit:
-                            return
-                        time.sleep(self.POLL_TIME)
-                        inf.seek(where)
-                    elif progress_pat.match(line):
-                        print(
-                            "Unity> %-70s\r" % progress_pat.match(line).group(2)[-70:],
-                            end=" ",
-                        )
-                    elif munge_pat.match(line):
-                        print(
-                            "Munge> %-70s\r" % munge_pat.match(line).group(1)[-70:],
-                            end=" ",
-                        )
-                except IOError:
-                    # The "print" can raise IOError
-                    pass
+                # Check before reading, so the final read sees everything
+                exiting = self.should_exit
+                data = inf.read(self.READ_SIZE)
+                if data:
+                    lines = (partial + data).replace("\r", "").split("\n")
+                    partial = lines.pop()
+                    self._publish(lines)
+                elif exiting:
+                    if partial:
+                        self._publish([partial])
+                    for _, on_close in self.subscribers:
+                        if on_close is not None:
+                            on_close()
+                    return
+                else:
+                    watcher.wait(self.POLL_TIME)
+
+
+def print_progress(kind, text):
+    """Overwrites the current line of stdout with a progress message."""
+    try:
+        print("%s> %-70s\r" % (kind, text[-70:]), end=" ")
+    except IOError:
+        # The "print" can raise IOError
+        pass
 
 
 def get_unity_exe(version, lenient=True):
@@ -341,120 +374,6 @@ def get_project_unity_version(project_dir):
         return parse_version(m.group(1))
 
 
-def indent(prefix, text):
-    return "\n".join(prefix + line for line in text.split("\n"))
-
-
-def iter_compiler_output(log):
-    """Yields dicts containing the keys:
-    exitcode, compilationhadfailure, outfile, stdout, stderr"""
-    # Compile output looks like this:
-    # -----CompilerOutput:-stdout--exitcode: 1--compilationhadfailure: True--outfile: Temp/Assembly-CSharp-Editor.dll
-    # Compilation failed: 1 error(s), 0 warnings
-    # -----CompilerOutput:-stderr----------
-    # Assets/Editor/BuildTiltBrush.cs(33,7): error CS1519: <etc etc>
-    # -----EndCompilerOutput---------------
-    pat = re.compile(
-        r"""
-  ^-----CompilerOutput:-stdout(?P<metadata>.*?) \n
-  (?P<body>.*?) \n
-   -----EndCompilerOutput""",
-        re.DOTALL | re.MULTILINE | re.VERBOSE,
-    )
-    for m in pat.finditer(log):
-        dct = {}
-        for chunk in m.group("metadata").split("--"):
-            if chunk:
-                key, value = chunk.split(": ", 1)
-                dct[key] = value
-        dct["exitcode"] = int(dct["exitcode"])
-        dct["compilationhadfailure"] = dct["compilationhadfailure"] != "False"
-        body = m.group("body").strip().split("-----CompilerOutput:-stderr----------\n")
-        dct["stdout"] = body[0].strip()
-        dct["stderr"] = body[1].strip() if len(body) > 1 else ""
-        yield dct
-
-
-def check_compile_output(log):
-    """Raises BuildFailed if compile errors are found.
-    Spews to stderr if compile warnings are found."""
-    dcts = list(iter_compiler_output(log))
-    compiler_output = "\n".join(
-        stuff.strip() for dct in dcts for stuff in [dct["stderr"], dct["stdout"]]
-    )
-    if any(dct["compilationhadfailure"] for dct in dcts):
-        # Mono puts it in stderr; Roslyn puts it in stdout.
-        # But! Unity 2018 also gives us a good build report, so we might be able to
-        # get the compiler failures from the build report instead of this ugly parsing
-        # through Unity's log file.
-        raise BuildFailed("Compile\n%s" % indent("| ", compiler_output))
-    if compiler_output != "":
-        print("Compile warnings:\n%s" % indent("| ", compiler_output), file=sys.stderr)
-
-
-def search_backwards(text, start_point, limit, pattern):
-    """Search the range [limit, start_point] for instances of |pattern|.
-    Returns the one closest to |start_point|.
-    Returns |limit| if none are found."""
-    assert limit < start_point
-    matches = list(pattern.finditer(text[limit:start_point]))
-    if len(matches) == 0:
-        return limit
-    return limit + matches[-1].start(0)
-
-
-def analyze_unity_failure(exitcode, log):
-    """Raise BuildFailed with as much information about the failure as possible."""
-    # Build exceptions look like this:
-    # BuildFailedException: <<Build sanity checks failed:
-    # This is a dummy error>>
-    #   at BuildTiltBrush.DoBuild (BuildOptions options, BuildTarget target, System.String location, SdkMode vrSdk, Boolean isExperimental, System.String stamp) [0x0026a] in C:\src\tb\Assets\Editor\BuildTiltBrush.cs:430
-    #   at BuildTiltBrush.CommandLine () [0x001de] in C:\src\tb\Assets\Editor\BuildTiltBrush.cs:259
-
-    build_failed_pat = re.compile(
-        r"""BuildFailedException:\ <<(?P<description>.*?)>>
-      (?P<traceback> (\n\ \ at\ [^\n]+)* )""",
-        re.DOTALL | re.MULTILINE | re.VERBOSE,
-    )
-    m = build_failed_pat.search(log)
-    if m is not None:
-        raise BuildFailed(
-            "C# raised BuildFailedException\n%s\n| ---\n%s"
-            % (
-                indent("| ", m.group("traceback").strip()),
-                indent("| ", m.group("description").strip()),
-            )
-        )
-
-    internal_error_pat = re.compile(
-        r"^executeMethod method (?P<methodname>.*) threw exception\.", re.MULTILINE
-    )
-    m = internal_error_pat.search(log)
-    if m is not None:
-        exception_pat = re.compile(
-            r"^[A-Z][A-Za-z0-9]+(Exception|Error):", re.MULTILINE
-        )
-        start = search_backwards(log, m.start(0), m.start(0) - 1024, exception_pat)
-        end = m.end(0)
-        suspicious_portion = log[start:end]
-        raise BuildFailed("""Build script '%s' had an internal error.
-Suspect log portion:
-%s""" % (m.group("methodname"), indent("| ", suspicious_portion)))
-
-    # Check for BuildTiltBrush.Die()
-    btb_die_pat = re.compile(
-        r"_btb_ Abort <<(?P<description>.*?)>>", re.DOTALL | re.MULTILINE
-    )
-    m = btb_die_pat.search(log)
-    if m is not None:
-        raise BuildFailed("C# called Die %s '%s'" % (exitcode, m.group("description")))
-
-    if exitcode is None:
-        raise BuildFailed("Unity build seems to have been terminated prematurely")
-    raise BuildFailed("""Unity build failed with exit code %s but no errors seen
-This probably means the project is already open in Unity""" % exitcode)
-
-
 def get_end_user_version(project_dir):
     fn = os.path.join(project_dir, "Assets", "Scenes", "Main.unity")
     with open(fn) as inf:
@@ -495,6 +414,10 @@ def build(
     config,
     for_distribution,
     is_jenkins,
+    timer=None,
+    on_progress=None,
+    unity_exe=None,
+    echo=None,
 ):
     """Create a build of Tilt Brush.
     Pass:
@@ -509,6 +432,11 @@ def build(
       config - one of (Debug, Release)
       for_distribution - boolean. Enables android signing, version code bump, removal of pdb files.
       is_jenkins - boolean; used to customize stdout logging
+      timer - optional unitybuild.timing.BuildTimer; receives Unity-side phase times
+      on_progress - optional on_progress(kind, text) callback for Unity's progress;
+        by default progress is printed to stdout unless is_jenkins
+      unity_exe - optional Unity executable to use instead of searching for one
+      echo - optional echo(text) callback for messages; by default they are printed
     Returns:
       the actual output directory used
     """
@@ -527,12 +455,13 @@ def build(
             return "%s" % exe_base_name
         raise InternalError("Don't know executable name for %s" % platform)
 
+    show = echo or print
     try:
         unitybuild.utils.destroy(output_dir)
     except Exception as e:  # pylint: disable=broad-except
-        print("WARN: could not use %s: %s" % (output_dir, e))
+        show("WARN: could not use %s: %s" % (output_dir, e))
         output_dir = make_unused_directory_name(output_dir)
-        print("WARN: using %s intead" % output_dir)
+        show("WARN: using %s intead" % output_dir)
         unitybuild.utils.destroy(output_dir)
     os.makedirs(output_dir)
     logfile = os.path.join(output_dir, "build_log.txt")
@@ -540,7 +469,8 @@ def build(
     exe_name = os.path.join(output_dir, get_exe_name(platform, exe_base_name))
     cmd_env = os.environ.copy()
     cmdline = [
-        get_unity_exe(
+        unity_exe
+        or get_unity_exe(
             get_project_unity_version(project_dir), lenient=is_jenkins or is_linux
         ),
         "-logFile",
@@ -624,22 +554,33 @@ def build(
     proc = subprocess.Popen(cmdline, stdout=sys.stdout, stderr=sys.stderr, env=cmd_env)
     del cmd_env
 
+    # Watches the log as it is written, so a doomed build can be stopped early
+    failed = threading.Event()
+    if on_progress is None and not is_jenkins:
+        on_progress = print_progress
+    analyzer = UnityLogAnalyzer(on_progress=on_progress, on_failure=failed.set)
+    tailer = LogTailer(logfile)
+    tailer.subscribe(analyzer.feed_line, analyzer.close)
+    if timer is not None:
+        unity_timer = timer.unity_phase_timer()
+        tailer.subscribe(unity_timer.on_line, unity_timer.on_close)
     with unitybuild.utils.ensure_terminate(proc):
-        with LogTailer(logfile, disabled=is_jenkins):
+        with tailer:
             with open(os.path.join(output_dir, "build_stamp.txt"), "w") as outf:
                 outf.write(full_version)
 
-            # Use wait() instead of communicate() because Windows can't
+            # Use poll() instead of communicate() because Windows can't
             # interrupt the thread joins that communicate() uses.
-            proc.wait()
-
-    with open(logfile) as inf:
-        log = inf.read().replace("\r", "")
+            while proc.poll() is None:
+                if failed.wait(LogTailer.POLL_TIME):
+                    show("Build failure seen in log; stopping Unity")
+                    proc.terminate()
+                    proc.wait()
 
-    check_compile_output(log)
+    analyzer.check_compile_output(echo)
 
-    if proc.returncode != 0:
-        analyze_unity_failure(proc.returncode, log)
+    if proc.returncode != 0 or analyzer.failed:
+        analyzer.analyze_unity_failure(proc.returncode)
 
     # sanity-checking since we've been seeing bad Oculus builds
     if platform == "Windows":
@@ -679,54 +620,6 @@ def finalize_build(src_dir, dst_dir):
         return src_dir
 
 
-def create_notice_file(project_dir):
-    def iter_notice_files():
-        """Yields (library_name, notice_file_name) tuples."""
-        root = os.path.join(project_dir, "Assets/ThirdParty")
-        if not os.path.exists(root):
-            raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
-        for r, _, fs in os.walk(root):
-            for f in fs:
-                if f.lower() in (
-                    "notice",
-                    "notice.txt",
-                    "notice.tiltbrush",
-                    "notice.md",
-                ):
-                    yield (os.path.basename(r), os.path.join(r, f))
-        root = os.path.join(project_dir, "Assets/ThirdParty/NuGet/Packages")
-        if not os.path.exists(root):
-            raise BuildFailed("Cannot generate NOTICE: missing %s" % root)
-        for r, _, fs in os.walk(root):
-            for f in fs:
-                if f.lower() in ("notice", "notice.md", "notice.txt"):
-                    m = re.match(r"\D+", os.path.basename(r))
-                    if m:
-                        name = m.group(0).rstrip(".")
-                        if name[-2:] == ".v" or name[-2:] == ".V":
-                            name = name[:-2]
-                        yield (name, os.path.join(r, f))
-
-    tmpf = io.StringIO()
-    tmpf.write("""This file is automatically generated.
-This software makes use of third-party software with the following notices.
-""")
-    for library_name, notice_file in iter_notice_files():
-        tmpf.write("\n\n=== %s ===\n" % library_name)
-        with open(notice_file) as inf:
-            contents = inf.read()
-            if contents.startswith(str(codecs.BOM_UTF8)):
-                contents = contents[len(codecs.BOM_UTF8) :]
-        tmpf.write(contents)
-        tmpf.write("\n")
-
-    output_filename = os.path.join(
-        project_dir, "Support/ThirdParty/GeneratedThirdPartyNotices.txt"
-    )
-    with open(output_filename, "w") as outf:
-        outf.write(tmpf.getvalue())
-
-
 # ----------------------------------------------------------------------
 # Front-end
 # ----------------------------------------------------------------------
@@ -792,6 +685,38 @@ def parse_args(args):
         help="Build with continuous integration settings.",
     )
 
+    grp = parser.add_argument_group("Build matrix")
+    grp.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of builds to run at once. Each concurrent build runs in its own copy of the project, kept in Builds/Workspaces",
+    )
+    grp.add_argument(
+        "--unity-exe",
+        metavar="EXE",
+        help="Use this Unity executable instead of searching for the project's version (eg, a stub for testing)",
+    )
+
+    grp.add_argument(
+        "--no-build-cache",
+        action="store_true",
+        help="Always run Unity, even if an identical build is in Builds/BuildCache",
+    )
+
+    grp = parser.add_argument_group("Build timing")
+    grp.add_argument(
+        "--timing-history",
+        metavar="FILE",
+        help="JSON-lines file that per-phase build timings are appended to (default: build_timings.jsonl in the build directory)",
+    )
+    grp.add_argument(
+        "--timing-report",
+        action="store_true",
+        help="Print per-phase timing trends and regressions from the history, then exit",
+    )
+
     args = parser.parse_args(args)
     if not args.configs:
         args.configs = ["Release"]
@@ -813,6 +738,9 @@ def parse_args(args):
     if args.push:
         args.for_distribution = True
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     return args
 
 
@@ -898,107 +826,151 @@ def sanity_check_build(build_dir):
         raise BuildFailed("Cannot find any executables in %s" % build_dir)
 
 
-def main(
-    args=None,
-):  # pylint: disable=too-many-statements,too-many-branches,too-many-locals
-    unitybuild.utils.msys_control_c_workaround()
-
-    if sys.platform == "cygwin":
-        raise UserError("Running under cygwin python is not supported.")
-    args = parse_args(args)
-
-    if args.push:
-        num = len(args.platforms) * len(args.vrsdks) * len(args.configs)
-        if num != 1:
-            raise UserError("Must specify exactly one build to push")
-
-    vcs = vcs_create()
-    project_dir = find_project_dir()
-    print("Project dir:", os.path.normpath(project_dir))
-
-    if args.jenkins:
-        # Jenkins does not allow building outside of the source tree.
-        build_dir = os.path.normpath(os.path.join(project_dir, "Builds"))
-    else:
-        # Local build setup.
-        build_dir = os.path.normpath(os.path.join(project_dir, "..", "Builds"))
+def get_build_dirs(args, build_dir, platform, vrsdk, config):
+    """Returns (tmp_dir, output_dir) for one entry of the build matrix.
+    If the matrix has several platforms or configs, the names include the
+    entry's platform or config, so that no two entries share a directory."""
+    sdk = vrsdk
+    if sdk == "Oculus" and platform == "Android":
+        sdk = "OculusMobile"
+    if len(set(args.platforms)) > 1:
+        sdk = "%s_%s" % (sdk, platform)
+    dirname = "%s_%s_%s%s%s%s%s_FromCli" % (
+        sdk,
+        config if len(set(args.configs)) > 1 else "Release",
+        EXE_BASE_NAME,
+        "_Experimental" if args.experimental else "",
+        "_Il2cpp" if args.il2cpp else "",
+        "",  # GuiAutoProfile
+        "_signed" if args.for_distribution and platform != "Windows" else "",
+    )
 
-    # TODO(pld): maybe faster to call CommandLine() multiple times in the same
-    # Unity rather than to start up Unity multiple times. OTOH it requires faith
-    # in Unity's stability.
-    try:
-        tmp_dir = None
-        try:
-            revision = vcs.get_build_stamp(project_dir)
-        except LookupError as e:
-            print("WARN: no build stamp (%s). Continue?" % (e,))
-            if not input("(y/n) > ").strip().lower().startswith("y"):
-                raise UserError("Aborting: no stamp") from e
-            revision = "nostamp"
+    tmp_dir = os.path.join(build_dir, "tmp_" + dirname)
+    output_dir = os.path.join(build_dir, dirname)
+    return tmp_dir, output_dir
 
-        create_notice_file(project_dir)
 
-        # Generate ViverseViewer.bytes from source directory before building
-        from unitybuild.viverseviewer import generate_viverseviewer_bytes
+_version_code_lock = threading.Lock()
 
-        generate_viverseviewer_bytes(project_dir)
 
-        for platform, vrsdk, config in iter_builds(args):
-            stamp = revision + ("-exp" if args.experimental else "")
-            print(
-                "Building %s %s %s exp:%d signed:%d il2cpp:%d"
-                % (
-                    platform,
-                    vrsdk,
-                    config,
-                    args.experimental,
-                    args.for_distribution,
-                    args.il2cpp,
-                )
-            )
-
-            sdk = vrsdk
-            if sdk == "Oculus" and platform == "Android":
-                sdk = "OculusMobile"
-            dirname = "%s_%s_%s%s%s%s%s_FromCli" % (
-                sdk,
-                "Release",
-                EXE_BASE_NAME,
-                "_Experimental" if args.experimental else "",
-                "_Il2cpp" if args.il2cpp else "",
-                "",  # GuiAutoProfile
-                "_signed" if args.for_distribution and platform != "Windows" else "",
-            )
-
-            tmp_dir = os.path.join(build_dir, "tmp_" + dirname)
-            output_dir = os.path.join(build_dir, dirname)
+def build_entry(  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+    args,
+    project_dir,
+    build_dir,
+    revision,
+    history_file,
+    platform,
+    vrsdk,
+    config,
+    workspace_dir=None,
+    on_progress=None,
+    echo=None,
+    prompt=True,
+    cache=None,
+):
+    """Builds, finalizes and (optionally) pushes one entry of the build matrix.
+    Pass:
+      workspace_dir - if not None, a copy of project_dir to run Unity in
+      on_progress - passed to build()
+      echo - passed to build(), and used for this function's messages too
+      prompt - if False, never prompt for input
+      cache - optional unitybuild.buildcache.BuildCache to restore from and store to
+    Returns:
+      the output directory
+    """
+    show = echo or print
+    stamp = revision + ("-exp" if args.experimental else "")
+    show(
+        "Building %s %s %s exp:%d signed:%d il2cpp:%d"
+        % (
+            platform,
+            vrsdk,
+            config,
+            args.experimental,
+            args.for_distribution,
+            args.il2cpp,
+        )
+    )
 
-            if args.for_distribution and platform == "Android" and sys.stdin.isatty():
+    tmp_dir, output_dir = get_build_dirs(args, build_dir, platform, vrsdk, config)
+
+    with BuildTimer(
+        history_file,
+        stamp=stamp,
+        host=platform_node(),
+        platform=platform,
+        vrsdk=vrsdk,
+        config=config,
+        experimental=args.experimental,
+        il2cpp=args.il2cpp,
+    ) as timer:
+        with timer.phase("version_prompt"):
+            if (
+                prompt
+                and args.for_distribution
+                and platform == "Android"
+                and sys.stdin.isatty()
+            ):
                 try:
                     maybe_prompt_and_set_version_code(project_dir)
                 except Exception as e:  # pylint: disable=broad-except
                     print("Error prompting for version code: %s" % e)
 
-            tmp_dir = build(
-                stamp,
-                tmp_dir,
-                project_dir,
-                EXE_BASE_NAME,
-                experimental=args.experimental,
-                platform=platform,
-                il2cpp=args.il2cpp,
-                vrsdk=vrsdk,
-                config=config,
-                for_distribution=args.for_distribution,
-                is_jenkins=args.jenkins,
-            )
+        unity_exe = args.unity_exe or get_unity_exe(
+            get_project_unity_version(project_dir),
+            lenient=args.jenkins or is_linux,
+        )
+        flags = dict(
+            stamp=stamp,
+            platform=platform,
+            vrsdk=vrsdk,
+            config=config,
+            experimental=args.experimental,
+            il2cpp=args.il2cpp,
+            for_distribution=args.for_distribution,
+        )
+        cache_key = None
+        restored = False
+        if cache is not None:
+            with timer.phase("cache_restore"):
+                cache_key = cache.key(unity_exe, **flags)
+                restored = cache.restore(cache_key, tmp_dir)
+        if restored:
+            show("Build cache hit (%s); skipping Unity" % cache_key[:12])
+        else:
+            with timer.phase("build"):
+                tmp_dir = build(
+                    stamp,
+                    tmp_dir,
+                    workspace_dir or project_dir,
+                    EXE_BASE_NAME,
+                    experimental=args.experimental,
+                    platform=platform,
+                    il2cpp=args.il2cpp,
+                    vrsdk=vrsdk,
+                    config=config,
+                    for_distribution=args.for_distribution,
+                    is_jenkins=args.jenkins,
+                    timer=timer,
+                    on_progress=on_progress,
+                    unity_exe=unity_exe,
+                    echo=echo,
+                )
+            if cache_key is not None:
+                with timer.phase("cache_store"):
+                    cache.store(cache_key, tmp_dir, **flags)
+        with timer.phase("finalize_build"):
             output_dir = finalize_build(tmp_dir, output_dir)
+        with timer.phase("sanity_check_build"):
             sanity_check_build(output_dir)
 
-            if args.for_distribution and platform == "Android":
+        if args.for_distribution and platform == "Android":
+            with _version_code_lock:
                 set_android_version_code(project_dir, "increment")
 
-            if args.for_distribution and vrsdk == "Oculus":
+        if args.for_distribution and vrsdk == "Oculus" and not args.push:
+            # When pushing, this is done as the build is staged; see unitybuild.staging
+            with timer.phase("strip_pdbs"):
                 # .pdb files violate VRC.PC.Security.3 and ovr-platform-utils rejects the submission
                 to_remove = []
                 for r, _, fs in os.walk(output_dir):
@@ -1006,28 +978,25 @@ def main(
                         if f.endswith(".pdb"):
                             to_remove.append(os.path.join(r, f))
                 if to_remove:
-                    print(
+                    show(
                         "Removing from submission:\n%s"
                         % ("\n".join(os.path.relpath(f, output_dir) for f in to_remove))
                     )
                     list(map(os.unlink, to_remove))
 
-            if platform == "iOS":
-                # TODO: for iOS, invoke xcode to create ipa.  E.g.:
-                # $ cd tmp_dir/TiltBrush
-                # $ xcodebuild -scheme Unity-iPhone archive -archivePath ARCHIVE_DIR
-                # $ xcodebuild -exportArchive -exportFormat ipa -archivePath ARCHIVE_DIR -exportPath IPA
-                print(
-                    "iOS build must be completed from Xcode (%s)"
-                    % (
-                        os.path.join(
-                            output_dir, EXE_BASE_NAME, "Unity-iPhone.xcodeproj"
-                        )
-                    )
-                )
-                continue
+        if platform == "iOS":
+            # TODO: for iOS, invoke xcode to create ipa.  E.g.:
+            # $ cd tmp_dir/TiltBrush
+            # $ xcodebuild -scheme Unity-iPhone archive -archivePath ARCHIVE_DIR
+            # $ xcodebuild -exportArchive -exportFormat ipa -archivePath ARCHIVE_DIR -exportPath IPA
+            show(
+                "iOS build must be completed from Xcode (%s)"
+                % (os.path.join(output_dir, EXE_BASE_NAME, "Unity-iPhone.xcodeproj"))
+            )
+            return output_dir
 
-            if args.push:
+        if args.push:
+            with timer.phase("push"):
                 with open(os.path.join(output_dir, "build_stamp.txt")) as inf:
                     embedded_stamp = inf.read().strip()
                 description = "%s %s | %s@%s" % (
@@ -1067,6 +1036,134 @@ def main(
                     unitybuild.push.push_open_brush_to_oculus(
                         output_dir, release_channel, description
                     )
+    return output_dir
+
+
+def main(
+    args=None,
+):  # pylint: disable=too-many-statements,too-many-branches,too-many-locals
+    unitybuild.utils.msys_control_c_workaround()
+
+    if sys.platform == "cygwin":
+        raise UserError("Running under cygwin python is not supported.")
+    args = parse_args(args)
+
+    if args.push:
+        num = len(args.platforms) * len(args.vrsdks) * len(args.configs)
+        if num != 1:
+            raise UserError("Must specify exactly one build to push")
+
+    vcs = vcs_create()
+    project_dir = find_project_dir()
+    print("Project dir:", os.path.normpath(project_dir))
+
+    if args.jenkins:
+        # Jenkins does not allow building outside of the source tree.
+        build_dir = os.path.normpath(os.path.join(project_dir, "Builds"))
+    else:
+        # Local build setup.
+        build_dir = os.path.normpath(os.path.join(project_dir, "..", "Builds"))
+
+    history_file = args.timing_history or os.path.join(build_dir, "build_timings.jsonl")
+    if args.timing_report:
+        try:
+            records = read_history(history_file)
+        except IOError as e:
+            raise UserError("No build timings: %s" % (e,)) from e
+        regressions = print_report(records)
+        sys.exit(1 if regressions else 0)
+
+    # TODO(pld): maybe faster to call CommandLine() multiple times in the same
+    # Unity rather than to start up Unity multiple times. OTOH it requires faith
+    # in Unity's stability.
+    try:
+        tmp_dir = None
+        try:
+            revision = vcs.get_build_stamp(project_dir)
+        except LookupError as e:
+            print("WARN: no build stamp (%s). Continue?" % (e,))
+            if not input("(y/n) > ").strip().lower().startswith("y"):
+                raise UserError("Aborting: no stamp") from e
+            revision = "nostamp"
+
+        # Hash the tree before the generated files below are written
+        cache = None
+        if not args.no_build_cache:
+            try:
+                cache = BuildCache(
+                    os.path.join(build_dir, "BuildCache"),
+                    vcs.get_tree_hash(project_dir),
+                    project_dir,
+                )
+            except LookupError as e:
+                print("Build cache disabled: %s" % (e,))
+
+        create_notice_file(project_dir)
+
+        # Generate ViverseViewer.bytes from source directory before building
+        from unitybuild.viverseviewer import generate_viverseviewer_bytes
+
+        generate_viverseviewer_bytes(project_dir)
+
+        entries = list(iter_builds(args))
+        if args.jobs > 1 and len(entries) > 1:
+            if (
+                args.for_distribution
+                and "Android" in args.platforms
+                and sys.stdin.isatty()
+            ):
+                try:
+                    maybe_prompt_and_set_version_code(project_dir)
+                except Exception as e:  # pylint: disable=broad-except
+                    print("Error prompting for version code: %s" % e)
+
+            def build_in_workspace(entry, workspace_dir, on_progress, echo):
+                platform, vrsdk, config = entry
+                entry_tmp_dir, _ = get_build_dirs(
+                    args, build_dir, platform, vrsdk, config
+                )
+                try:
+                    return build_entry(
+                        args,
+                        project_dir,
+                        build_dir,
+                        revision,
+                        history_file,
+                        platform,
+                        vrsdk,
+                        config,
+                        workspace_dir=workspace_dir,
+                        on_progress=on_progress,
+                        echo=echo,
+                        prompt=False,
+                        cache=cache,
+                    )
+                except Error as e:
+                    raise BuildFailed(
+                        "%s\nSee %s" % (e, os.path.join(entry_tmp_dir, "build_log.txt"))
+                    ) from e
+
+            run_matrix(
+                entries,
+                build_in_workspace,
+                project_dir,
+                os.path.join(build_dir, "Workspaces"),
+                args.jobs,
+            )
+        else:
+            for platform, vrsdk, config in entries:
+                tmp_dir, _ = get_build_dirs(args, build_dir, platform, vrsdk, config)
+                build_entry(
+                    args,
+                    project_dir,
+                    build_dir,
+                    revision,
+                    history_file,
+                    platform,
+                    vrsdk,
+                    config,
+                    cache=cache,
+                )
     except BadVersionCode as e:
         if isinstance(e, BadVersionCode):
             set_android_version_code(project_dir, e.desired_version_code)
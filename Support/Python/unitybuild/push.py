@@ -19,14 +19,18 @@
 #   https://dashboard.oculus.com/tools/cli
 
 import argparse
+import asyncio
+import codecs
 import glob
 import os
 import re
 import sys
 import subprocess
-from subprocess import Popen, PIPE, STDOUT
+import time
+from subprocess import Popen
 
 from unitybuild.constants import UserError, BuildFailed, BadVersionCode
+from unitybuild import staging
 from unitybuild.credentials import (
     get_credential,
     TB_OCULUS_RIFT_APP_ID,
@@ -92,6 +96,42 @@ def get_tmp_steam_dir():
     return ret
 
 
+def get_tmp_push_dir():
+    # Return a persistent directory for staged content and the manifests of
+    # previous pushes. Must be on the same volume as the builds, so staging can
+    # use hard links.
+    ret = os.path.join(get_support_dir(), "tmp_push")
+    if not os.path.isdir(ret):
+        os.makedirs(ret)
+    return ret
+
+
+def stage_for_push(source_dir, target, exclusions):
+    """Stages source_dir for upload and reports what changed since the last
+    successful push to target (a name like "steam-beta").
+    Returns (stage_dir, commit), where commit() should be called once the push
+    succeeds."""
+    tmp_push_dir = get_tmp_push_dir()
+    stage_dir = os.path.join(tmp_push_dir, target)
+    manifest_file = os.path.join(tmp_push_dir, target + ".manifest.json")
+
+    manifest, excluded = staging.stage_build(source_dir, stage_dir, exclusions)
+    if excluded:
+        print("Removing from submission:\n%s" % "\n".join(excluded))
+    previous = staging.load_manifest(manifest_file)
+    if previous is None:
+        print("No previous push to %s; all content is new" % target)
+    print(
+        "Changes since last push to %s: %s"
+        % (target, staging.ManifestDiff(previous, manifest).report())
+    )
+
+    def commit():
+        staging.save_manifest(manifest_file, manifest)
+
+    return stage_dir, commit
+
+
 def get_build_stamp(directory):
     filename = os.path.join(directory, "build_stamp.txt")
     try:
@@ -158,11 +198,14 @@ def push_open_brush_to_steam(source_dir, description, steam_user, steam_branch=N
 
     support_dir = get_support_dir()
     tmp_steam_dir = get_tmp_steam_dir()
+    stage_dir, commit = stage_for_push(
+        source_dir, "steam-%s" % (steam_branch or "default"), staging.STEAM_EXCLUSIONS
+    )
 
     variables = {
         "DESC": description,
         "TMP_STEAM": tmp_steam_dir,
-        "CONTENT_ROOT": os.path.abspath(source_dir).replace("\\", "/"),
+        "CONTENT_ROOT": os.path.abspath(stage_dir).replace("\\", "/"),
         "STEAM_BRANCH": "" if steam_branch is None else steam_branch,
     }
     # This file has no variables that need expanding, but steamcmd.exe
@@ -181,12 +224,20 @@ def push_open_brush_to_steam(source_dir, description, steam_user, steam_branch=N
 
     print("Pushing %s to Steam" % (variables["CONTENT_ROOT"],))
     steamcmd("+login", steam_user, "+run_app_build", app_vdf, "+quit")
+    commit()
 
 
 # ----------------------------------------------------------------------
 # Oculus support
 # ----------------------------------------------------------------------
 
+# Overridable, so a fake uploader can be substituted for testing
+OVR_PLATFORM_UTIL = os.environ.get("OVR_PLATFORM_UTIL", "ovr-platform-util")
+UPLOADER_READ_SIZE = 64 << 10
+# Kill the uploader if it is silent for this many seconds
+UPLOADER_STALL_TIMEOUT = 15 * 60
+LINE_PAT = re.compile(r"[^\r\n]*[\r\n]+")
+
 OCULUS_RIFT_REDISTS = [
     "1675031999409058",  # Visual C++ 2013
     "1183534128364060",  # Visual C++ 2015
@@ -210,36 +261,108 @@ def get_oculus_openbrush_exe(directory):
     raise BuildFailed("Ambiguous launch executable: %s" % (files,))
 
 
-def unbuffered_reads(inf):
-    """Yields unbuffered reads from file, until eof."""
-    while True:
-        data = inf.read(1)
-        if data == "":
-            break
-        yield data
+class UploaderOutput:
+    """Parses the output of ovr-platform-util a line at a time, as it arrives.
+    on_progress(percent, bytes_per_sec) is called whenever the upload reports
+    progress; bytes_per_sec is None unless total_bytes (the size of the upload)
+    is known."""
+
+    PROGRESS_PAT = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+
+    def __init__(self, total_bytes=None, on_progress=None, echo=True):
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.echo = echo
+        self.saw_output = False
+        self.bad_secret = False
+        self.desired_version_code = None
+        self.percent = None
+        self.start = time.perf_counter()
 
+    def feed_line(self, line):
+        """Raises BuildFailed if the upload should be abandoned."""
+        if line.strip():
+            self.saw_output = True
+        if self.echo:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        # The request will be retried indefinitely, so stall it out
+        if "error occurred. The request will be retried." in line:
+            print()
+            self.bad_secret = True
+            raise BuildFailed("Your App Secret might be incorrect. Try again.")
+        m = re.search(
+            r"higher version code has previously been uploaded .code: (?P<code>\d+)",
+            line,
+        )
+        if m is not None:
+            self.desired_version_code = int(m.group("code")) + 1
 
-def group_into_lines(iterable):
-    """Yields complete lines (lines terminated with \\r and/or \\n)."""
-    current = []
-    terminator = re.compile(r"^([^\r\n]*[\r\n]+)(.*)$", re.MULTILINE)
-    for data in iterable:
-        # Deal with any line terminators in the data
-        # print "IN %r" % data
-        while True:
-            m = terminator.match(data)
-            if m is None:
-                break
+        # Example error text:
+        # * An APK has already been uploaded with version code 59. Please update the application manifest's version code to 64 or higher and try again.
+        m = re.search(r"version code to (?P<code>\d+) or higher and try again", line)
+        if m is not None:
+            self.desired_version_code = int(m.group("code"))
 
-            eol, data = m.groups()
-            # print " match %r %r" % (eol, data)
-            current.append(eol)
-            yield "".join(current)
-            current = []
+        m = self.PROGRESS_PAT.search(line)
+        if m is not None:
+            self.percent = min(float(m.group(1)), 100.0)
+            if self.on_progress is not None:
+                bytes_per_sec = None
+                elapsed = time.perf_counter() - self.start
+                if self.total_bytes is not None and elapsed > 0:
+                    bytes_per_sec = self.total_bytes * self.percent / 100 / elapsed
+                self.on_progress(self.percent, bytes_per_sec)
+
+
+async def _stream_lines(stream, on_line, stall_timeout):
+    """Reads stream in large chunks, passing each complete line (terminated
+    with \\r and/or \\n, terminator included) to on_line. Raises
+    asyncio.TimeoutError if a read takes longer than stall_timeout seconds."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    while True:
+        data = await asyncio.wait_for(stream.read(UPLOADER_READ_SIZE), stall_timeout)
+        text = pending + decoder.decode(data, final=not data)
+        pos = 0
+        for m in LINE_PAT.finditer(text):
+            on_line(m.group(0))
+            pos = m.end()
+        pending = text[pos:]
+        if not data:
+            break
+    if pending:
+        on_line(pending)
 
-        current.append(data)
 
-    yield "".join(current)
+async def run_uploader(args, on_line, stall_timeout=UPLOADER_STALL_TIMEOUT):
+    """Runs args, passing each line of its combined stdout and stderr to on_line.
+    The process is killed if on_line raises, or if it produces no output for
+    stall_timeout seconds. Returns the process's exit code."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+    except FileNotFoundError as e:
+        raise BuildFailed(
+            "You don't seem to have ovr-platform-util installed.\nDownload it at https://dashboard.oculus.com/tools/cli"
+        ) from e
+    try:
+        await _stream_lines(proc.stdout, on_line, stall_timeout)
+    except asyncio.TimeoutError as e:
+        proc.kill()
+        await proc.wait()
+        raise BuildFailed(
+            "%s stalled: no output for %g seconds" % (args[0], stall_timeout)
+        ) from e
+    except BaseException:
+        proc.kill()
+        await proc.wait()
+        raise
+    return await proc.wait()
 
 
 def get_oculus_build_type(build_path):
@@ -260,7 +383,11 @@ def get_secret(env_var_name, credential_name):
 
 
 def push_open_brush_to_oculus(
-    build_path, release_channel, release_notes
+    build_path,
+    release_channel,
+    release_notes,
+    on_progress=None,
+    stall_timeout=UPLOADER_STALL_TIMEOUT,
 ):  # pylint: disable=too-many-statements,too-many-branches,too-many-locals
     assert os.path.isabs(build_path)
     assert os.path.exists(build_path)
@@ -270,10 +397,15 @@ def push_open_brush_to_oculus(
 
     # TEMP: yucky code to figure out if rift or quest
     build_type = get_oculus_build_type(build_path)
+    build_path, commit = stage_for_push(
+        build_path,
+        "oculus-%s-%s" % (build_type, release_channel),
+        staging.OCULUS_EXCLUSIONS,
+    )
     if build_type == "rift":
         app_id = TB_OCULUS_RIFT_APP_ID
         args = [
-            "ovr-platform-util",
+            OVR_PLATFORM_UTIL,
             "upload-rift-build",
             "--app_id",
             app_id,
@@ -294,15 +426,21 @@ def push_open_brush_to_oculus(
             "--firewall_exceptions",
             "true",
         ]
+        total_bytes = sum(
+            os.path.getsize(os.path.join(r, f))
+            for r, _, fs in os.walk(build_path)
+            for f in fs
+        )
     elif build_type == "quest":
         apks = glob.glob(build_path + "/*.apk")
         if len(apks) != 1:
             raise BuildFailed("No or too many APKs in %s: %s" % (build_path, apks))
         apk = apks[0]
+        total_bytes = os.path.getsize(apk)
         # This requires a recent build of ovr-platform-util
         app_id = TB_OCULUS_QUEST_APP_ID
         args = [
-            "ovr-platform-util",
+            OVR_PLATFORM_UTIL,
             "upload-quest-build",
             "--app_id",
             app_id,
@@ -321,53 +459,25 @@ def push_open_brush_to_oculus(
     else:
         raise BuildFailed("Internal error: %s" % build_type)
 
+    output = UploaderOutput(total_bytes, on_progress)
     try:
-        proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        proc.stdin.close()
-    except OSError as e:
-        # Probably "cannot find the file specified"
-        if "cannot find the file" in str(e):
-            raise BuildFailed(
-                "You don't seem to have ovr-platform-util installed.\nDownload it at https://dashboard.oculus.com/tools/cli"
-            ) from e
-        raise
-    except subprocess.CalledProcessError as e:
-        raise BuildFailed("ovr-platform-util failed: %s" % e) from e
-
-    saw_output = False
-    desired_version_code = None
-    for line in group_into_lines(unbuffered_reads(proc.stdout)):
-        if line.strip():
-            saw_output = True
-        sys.stdout.write(line)
-        # The request will be retried indefinitely, so stall it out
-        if "error occurred. The request will be retried." in line:
-            print()
-            get_credential(app_id).delete_secret()
+        returncode = asyncio.run(run_uploader(args, output.feed_line, stall_timeout))
+    except BuildFailed:
+        if output.bad_secret:
             # Maybe the secret changed; ask user to re-enter it
-            raise BuildFailed("Your App Secret might be incorrect. Try again.")
-        m = re.search(
-            r"higher version code has previously been uploaded .code: (?P<code>\d+)",
-            line,
-        )
-        if m is not None:
-            desired_version_code = int(m.group("code")) + 1
-
-        # Example error text:
-        # * An APK has already been uploaded with version code 59. Please update the application manifest's version code to 64 or higher and try again.
-        m = re.search(r"version code to (?P<code>\d+) or higher and try again", line)
-        if m is not None:
-            desired_version_code = int(m.group("code"))
+            get_credential(app_id).delete_secret()
+        raise
 
-    if proc.wait() != 0:
-        message = "ovr-platform-util failed with code %s" % proc.wait()
-        if desired_version_code is not None:
-            raise BadVersionCode(message, desired_version_code)
+    if returncode != 0:
+        message = "ovr-platform-util failed with code %s" % returncode
+        if output.desired_version_code is not None:
+            raise BadVersionCode(message, output.desired_version_code)
         raise BuildFailed(message)
-    if not saw_output:
+    if not output.saw_output:
         raise BuildFailed(
             "ovr-platform-util seemed to do nothing.\nYou probably need a newer version.\nDownload it at https://dashboard.oculus.com/tools/cli"
         )
+    commit()
 
 
 # ----------------------------------------------------------------------
@@ -12,92 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import os
 import re
-import pickle
-import io
 import sys
 
-# FIXME: where does this come from?
-import networkx as nx  # pylint: disable=import-error
+import numpy as np  # pylint: disable=import-error
 
 import unitybuild.tb_refgraph as tb
+from unitybuild.assetscan import scan_project
+from unitybuild.csrgraph import CsrGraph, NoPath
 
 ROOT_GUID = "00001111222233334444555566667777"
-
-META_GUID_PAT = re.compile(r"^guid: ([a-f0-9]{32})\s*$", re.M)
-CONTAINS_NO_GUIDS = """
-  fbx obj dae wav txt pdf
-  tga png psd tif jpg jpeg
-  shader cginc cs cpp c h
-  dll so jar""".split()
-
-
-def _get_guid_from_meta(meta_filename):
-    with open(meta_filename) as inf:
-        contents = inf.read()
-    m = META_GUID_PAT.search(contents)
-    if m is None:
-        raise LookupError("No guid in %s" % (meta_filename,))
-    return m.group(1)
-
-
-# 0000000000000000e000000000000000 and 0000000000000000f000000000000000
-# are some sort of hardcoded guid?
-def _iter_guid_names(project):
-    """Find all file guids and their corresponding filename (without the ".meta")
-    Yields (guid, filename)"""
-    chop = len(project) + 1
-    for r, _, fs in os.walk(os.path.join(project, "Assets")):
-        for f in fs:
-            if f.endswith(".meta"):
-                fullf = os.path.join(r, f)
-                guid = _get_guid_from_meta(fullf)
-                name = fullf[chop:-5].replace("\\", "/")
-                yield guid, name
-    yield ("0000000000000000e000000000000000", "?Unity hardcoded 0e?")
-    yield ("0000000000000000f000000000000000", "?Unity hardcoded 0f?")
-
-
-def _iter_refs(project):
-    """Yields (src_guid, dst_guid)"""
-    ignore_pat = "|".join(CONTAINS_NO_GUIDS)
-    ignore_pat = re.compile(r"(%s)$" % ignore_pat, re.I)
-    guid_pat = re.compile(r"(?<!Hash: )\b([a-f0-9]{32})\b")
-
-    for r, _, fs in os.walk(os.path.join(project, "Assets")):
-        for f in fs:
-            if not f.endswith(".meta"):
-                continue
-            meta_fullf = os.path.join(r, f)
-            data_fullf = os.path.join(r, f[:-5])
-            src_guid = _get_guid_from_meta(meta_fullf)
-            if not os.path.isfile(data_fullf):
-                continue
-
-            # Look in .meta file. It will contain its own guid, but sometimes
-            # it contains others (eg, MonoBehaviour may have default asset references)
-            with open(meta_fullf) as mf:
-                for m in guid_pat.finditer(mf.read()):
-                    dst_guid = m.group(1)
-                    if dst_guid != src_guid:
-                        yield (src_guid, dst_guid)
-
-            with open(meta_fullf) as mf:
-                if not ignore_pat.search(data_fullf):
-                    for m in guid_pat.finditer(mf.read()):
-                        dst_guid = m.group(1)
-                        yield (src_guid, dst_guid)
+# Assets that can be used without any guid reference to them: scripts are
+# referenced from code, and Resources/ and StreamingAssets/ are loaded by path.
+# Being unreachable in the graph says nothing about whether these are used.
+NOT_TRACKED_BY_GUID_PAT = re.compile(
+    r"\.(cs|asmdef)$|/Resources/|/StreamingAssets/", re.I
+)
+
+
+def _make_name_to_guid(guid_to_name):
+    name_to_guid = {}
+    # For convenience, also add lowercased-versions
+    # (but this is incorrect on case-sensitive filesystems)
+    for g, n in guid_to_name.items():
+        name_to_guid[n.lower()] = g
+    # True capitalization takes precedence
+    for g, n in guid_to_name.items():
+        name_to_guid[n] = g
+    return name_to_guid
 
 
 class ReferenceGraph:  # pylint: disable=too-few-public-methods
-    # .g             networkx.DiGraph
+    # .g             unitybuild.csrgraph.CsrGraph
     # .guid_to_name  dict
     # .name_to_guid  dict (keys are lowercased)
-    PICKLE = "Support/refgraph.pickle"
+    STORE = "Library/refgraph.bin"
 
-    def __init__(self, project_dir, recreate=False):
+    def __init__(self, project_dir, recreate=False, jobs=None):
         self.project_dir = os.path.abspath(project_dir)
+        self.jobs = jobs
         loaded = False
         if not recreate:
             try:
@@ -112,85 +67,170 @@ class ReferenceGraph:  # pylint: disable=too-few-public-methods
         self._finish()
 
     def _load(self):
-        inf_name = os.path.join(self.project_dir, self.PICKLE)
-        with open(inf_name, "rb") as inf:
-            self.g = nx.read_gpickle(inf)
-            self.guid_to_name = pickle.load(inf)
+        self.g = CsrGraph.load(os.path.join(self.project_dir, self.STORE))
+        self.guid_to_name = {
+            guid: name for (guid, name) in zip(self.g.keys, self.g.names) if name
+        }
 
     def _recreate(self):
         print("Recreating refgraph. Please wait...")
         sys.stdout.flush()
-        self.g = nx.DiGraph()
 
         # This part of the graph is all guid -> guid
-        self.guid_to_name = dict(_iter_guid_names(self.project_dir))
-        self.g.add_nodes_from(iter(self.guid_to_name.keys()))
-        self.g.add_edges_from(_iter_refs(self.project_dir))
+        scan = scan_project(self.project_dir, jobs=self.jobs)
+        self.guid_to_name = dict(scan.iter_guid_names())
+        edges = list(scan.iter_refs())
 
-        self._recreate_tb_stuff()
+        edges.extend(self._recreate_tb_stuff(scan))
 
-    def _recreate_tb_stuff(self):
+        # Add synthetic guid to use as a root node
+        self.guid_to_name[ROOT_GUID] = "ROOT"
+        edges.extend(self._iter_root_edges())
+
+        self.g = CsrGraph.from_edges(self.guid_to_name, edges)
+
+    def _recreate_tb_stuff(self, scan):
         """Tilt Brush specific refgraph stuff
-        Adds references from .unity and .cs files to GlobalCommands enum entries.
+        Returns references from .unity and .cs files to GlobalCommands enum entries.
         Also creates a dummy .cs file that can be used to find references to GlobalCommands
         enums from within Visual Studio and Rider"""
         name_to_guid = dict((n, g) for (g, n) in list(self.guid_to_name.items()))
+        to_name = tb.get_command_lookup(self.project_dir)
 
-        for command in tb.iter_command_nodes(self.project_dir):
-            self.g.add_node(command)
+        for command in tb.iter_command_nodes(to_name):
             self.guid_to_name[command] = command
 
-        command_edges = list(tb.iter_command_edges(self.project_dir))
+        edges = []
+        command_edges = list(tb.iter_command_edges(scan, to_name))
         for file_name, command in command_edges:
             try:
                 file_guid = name_to_guid[file_name]
             except KeyError:
                 print("Couldn't find %s" % file_name)
             else:
-                self.g.add_edge(file_guid, command)
+                edges.append((file_guid, command))
 
         tb.create_dummy_cs(self.project_dir, command_edges)
+        return edges
 
-    def _save(self):
-        tmpf = io.StringIO()
-        nx.write_gpickle(self.g, tmpf, -1)
-        pickle.dump(self.guid_to_name, tmpf, -1)
-        outf_name = os.path.join(self.project_dir, self.PICKLE)
-        with open(outf_name, "wb") as outf:
-            outf.write(tmpf.getvalue())
-
-    def _finish(self):
-        """Perform post-load initialization"""
-        # Add synthetic guid to use as a root node
-        self.guid_to_name[ROOT_GUID] = "ROOT"
-
-        self.name_to_guid = {}
-        # For convenience, also add lowercased-versions
-        # (but this is incorrect on case-sensitive filesystems)
-        for g, n in self.guid_to_name.items():
-            self.name_to_guid[n.lower()] = g
-        # True capitalization takes precedence
-        for g, n in self.guid_to_name.items():
-            self.name_to_guid[n] = g
-
+    def _iter_root_edges(self):
+        """Yields edges from the root node to everything that should be
+        considered used."""
         # TILT BRUSH SPECIFIC:
         # The one dynamic choice is "what .unity do you load at startup?"
         # Also link environments to the root, because not all builds include all the envs,
         # but we want to mark all of them as roots.
-        n2g = self.name_to_guid
+        n2g = _make_name_to_guid(self.guid_to_name)
         for node_name in [
             "Assets/Scenes/Main.unity",  # Tilt Brush
             "Assets/TiltBrush/Resources/TiltBrushToolkitSettings.asset",  # Tilt Brush Toolkit
         ]:
             if node_name in n2g:
-                self.g.add_edge(n2g["ROOT"], n2g[node_name])
+                yield n2g["ROOT"], n2g[node_name]
 
         prefab_pat = re.compile(
             r"^Assets/Resources/EnvironmentPrefabs/.*prefab|^Assets/Scenes", re.I
         )
         for n in n2g:  # pylint: disable=consider-using-dict-items
             if prefab_pat.search(n):
-                self.g.add_edge(n2g["ROOT"], n2g[n])
+                yield n2g["ROOT"], n2g[n]
+
+    def _save(self):
+        filename = os.path.join(self.project_dir, self.STORE)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.g.save(filename)
+
+    def _finish(self):
+        """Perform post-load initialization"""
+        self.name_to_guid = _make_name_to_guid(self.guid_to_name)
+
+
+class Reachability:
+    """Whole-graph reachability from ROOT, computed with one BFS.
+    .dist     int32 array; BFS depth from ROOT per node id, -1 if unreachable
+    .parent   int32 array; parent in a shortest-path tree from ROOT
+    .idom     int32 array; immediate dominator, -1 if unreachable (lazy)
+    .sizes    int64 array; on-disk size of each node's asset, 0 if none (lazy)"""
+
+    def __init__(self, rg):
+        self.rg = rg
+        self.root = rg.g.key_to_id[ROOT_GUID]
+        self.dist, self.parent = rg.g.bfs(self.root)
+
+    @functools.cached_property
+    def idom(self):
+        return self.rg.g.immediate_dominators(self.root)
+
+    @functools.cached_property
+    def sizes(self):
+        sizes = np.zeros(len(self.rg.g), np.int64)
+        for i, name in enumerate(self.rg.g.names):
+            if name and not name.startswith(("?", "GlobalCommands.")):
+                try:
+                    sizes[i] = os.stat(os.path.join(self.rg.project_dir, name)).st_size
+                except OSError:
+                    pass
+        return sizes
+
+    def _id(self, guid):
+        return self.rg.g.key_to_id[guid]
+
+    def is_reachable(self, guid):
+        return self.dist[self._id(guid)] >= 0
+
+    def shortest_path(self, guid):
+        """Returns the guids from ROOT to guid, inclusive.
+        Raises NoPath if guid is unreachable."""
+        i = self._id(guid)
+        if self.dist[i] < 0:
+            raise NoPath("No path to %s" % guid)
+        path = [i]
+        while path[-1] != self.root:
+            path.append(int(self.parent[path[-1]]))
+        path.reverse()
+        return [self.rg.g.keys[j] for j in path]
+
+    def dominators(self, guid):
+        """Returns the guids that every path from ROOT to guid goes through,
+        nearest first, ending with ROOT. Removing references to any of them
+        would make guid unreachable."""
+        i = self._id(guid)
+        if self.idom[i] < 0:
+            raise NoPath("No path to %s" % guid)
+        ret = []
+        while i != self.root:
+            i = int(self.idom[i])
+            ret.append(self.rg.g.keys[i])
+        return ret
+
+    def retained_sizes(self):
+        """Returns an int64 array: for each reachable node, the total on-disk
+        size of the assets that would become unreachable without it."""
+        retained = np.where(self.idom >= 0, self.sizes, 0)
+        # A node's immediate dominator is always nearer to ROOT than it is,
+        # so accumulating from the deepest nodes up visits children first.
+        for i in np.argsort(-self.dist, kind="stable").tolist():
+            if self.dist[i] <= 0:
+                break
+            retained[self.idom[i]] += retained[i]
+        return retained
+
+    def iter_unreachable_assets(self, ignore_pat=None):
+        """Yields (size, name) for every asset file that cannot be reached
+        from ROOT, largest first. Names matching ignore_pat are skipped."""
+        g = self.rg.g
+        found = []
+        for i in np.flatnonzero(self.dist < 0).tolist():
+            name = g.names[i]
+            if not name or name.startswith(("?", "GlobalCommands.")):
+                continue
+            if ignore_pat is not None and ignore_pat.search(name):
+                continue
+            if not os.path.isfile(os.path.join(self.rg.project_dir, name)):
+                continue
+            found.append((int(self.sizes[i]), name))
+        found.sort(key=lambda pair: (-pair[0], pair[1]))
+        return iter(found)
 
 
 if __name__ == "__main__":
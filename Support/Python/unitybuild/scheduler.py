@@ -0,0 +1,136 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs several entries of the build matrix at once.
+
+Each concurrently-running build gets a workspace slot (see
+unitybuild.workspace); slots are reused by later builds so their Library/
+directories stay warm."""
+
+import concurrent.futures
+import os
+import queue
+import sys
+import threading
+
+from unitybuild.constants import BuildFailed, Error
+from unitybuild.workspace import sync_workspace
+
+
+class StatusBoard:
+    """Combined, single-line progress display for several builds.
+    All output while it is running should go through it, so that it isn't
+    mixed up with the progress line. Methods may be called from any thread."""
+
+    REFRESH_TIME = 0.5
+
+    def __init__(self, width=79):
+        self.width = width
+        self.status = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        self._write("")
+        return False
+
+    def update(self, key, text):
+        with self.lock:
+            self.status[key] = text
+
+    def message(self, key, text):
+        """Prints text above the progress line, each line prefixed with key."""
+        with self.lock:
+            self._write("".join("[%s] %s\n" % (key, line) for line in text.split("\n")))
+
+    def finish(self, key, message):
+        """Removes key from the display and prints message on a line of its own."""
+        with self.lock:
+            self.status.pop(key, None)
+            self._write(message + "\n")
+
+    def _write(self, text):
+        try:
+            sys.stdout.write("%-*s\r%s" % (self.width, "", text))
+            sys.stdout.flush()
+        except IOError:
+            pass
+
+    def _run(self):
+        while not self.done.wait(self.REFRESH_TIME):
+            with self.lock:
+                line = " | ".join(
+                    "%s: %s" % (key, text[-30:]) for key, text in self.status.items()
+                )
+                self._write(line[: self.width] + "\r")
+
+
+def run_matrix(entries, build_entry, project_dir, workspace_root, jobs):
+    """Runs build_entry for every entry, up to *jobs* at a time.
+    entries - list of (platform, vrsdk, config)
+    build_entry(entry, workspace_dir, on_progress, echo) - does one build and
+      returns its output directory. Runs on a worker thread. on_progress(kind, text)
+      updates the status display, and echo(text) prints a message; build_entry
+      must not print to stdout itself.
+    Returns a list of output directories, in the same order as entries.
+    Raises BuildFailed after all builds finish if any of them failed."""
+    slots = queue.Queue()
+    for i in range(jobs):
+        slots.put(os.path.join(workspace_root, "Workspace%d" % i))
+
+    def run_one(entry, board):
+        key = "/".join(entry)
+        slot = slots.get()
+        try:
+            board.update(key, "syncing workspace")
+            sync_workspace(project_dir, slot)
+            output_dir = build_entry(
+                entry,
+                slot,
+                lambda kind, text: board.update(key, text),
+                lambda text: board.message(key, text),
+            )
+        except Exception as e:
+            board.finish(key, "FAILED %s: %s" % (key, str(e).split("\n")[0]))
+            raise
+        finally:
+            slots.put(slot)
+        board.finish(key, "Built %s -> %s" % (key, output_dir))
+        return output_dir
+
+    with StatusBoard() as board:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(run_one, entry, board) for entry in entries]
+            concurrent.futures.wait(futures)
+
+    failures = []
+    for entry, future in zip(entries, futures):
+        e = future.exception()
+        if e is not None:
+            if not isinstance(e, Error):
+                raise e
+            failures.append("%s: %s" % (" ".join(entry), e))
+    if failures:
+        raise BuildFailed(
+            "%d of %d builds failed:\n%s"
+            % (len(failures), len(entries), "\n".join(failures))
+        )
+    return [future.result() for future in futures]
@@ -0,0 +1,169 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prepares a build directory for upload to a store.
+
+In a single pass over the build, stage_build() applies the store's exclusions,
+hard-links what's left into a staging directory, and computes a manifest of
+per-file sizes and BLAKE2 chunk hashes. Comparing the manifest with that of
+the previous push shows exactly what content changed, and by how much.
+
+Manifests are json:
+  {"chunk_size": 4194304,
+   "files": {"relative/path": {"size": 1234, "chunks": ["<hex digest>", ...]}}}"""
+
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+
+CHUNK_SIZE = 4 << 20
+
+# Excluded from every push: Unity says not to ship these
+COMMON_EXCLUSIONS = ("*_DoNotShip", "*_BackUpThisFolder_ButDontShipItWithYourGame")
+# Keep in sync with FileExclusion in Support/steam/main_depot.*.vdf.j2
+STEAM_EXCLUSIONS = COMMON_EXCLUSIONS + ("*.pdb", "build_log.txt")
+# .pdb files violate VRC.PC.Security.3 and ovr-platform-utils rejects the submission
+OCULUS_EXCLUSIONS = COMMON_EXCLUSIONS + ("*.pdb",)
+
+
+def _is_excluded(name, exclusions):
+    return any(fnmatch.fnmatch(name, pat) for pat in exclusions)
+
+
+def _hash_file(fullf):
+    """Returns the manifest entry for a file."""
+    chunks = []
+    size = 0
+    with open(fullf, "rb") as inf:
+        while True:
+            data = inf.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            chunks.append(hashlib.blake2b(data, digest_size=16).hexdigest())
+    return {"size": size, "chunks": chunks}
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def stage_build(build_dir, stage_dir, exclusions, jobs=None):
+    """Recreates stage_dir as a hard-linked copy of build_dir, minus any files
+    or directories whose names match a pattern in exclusions.
+    Returns (manifest, excluded), where excluded is a list of relative paths."""
+    if os.path.exists(stage_dir):
+        shutil.rmtree(stage_dir)
+    os.makedirs(stage_dir)
+
+    included = []
+    excluded = []
+    for r, ds, fs in os.walk(build_dir):
+        rel = os.path.relpath(r, build_dir)
+        for d in list(ds):
+            if _is_excluded(d, exclusions):
+                excluded.append(os.path.normpath(os.path.join(rel, d)))
+                ds.remove(d)
+            else:
+                os.makedirs(os.path.join(stage_dir, rel, d))
+        for f in fs:
+            relf = os.path.normpath(os.path.join(rel, f))
+            if _is_excluded(f, exclusions):
+                excluded.append(relf)
+            else:
+                included.append(relf)
+                _link_or_copy(os.path.join(r, f), os.path.join(stage_dir, relf))
+
+    # hashlib releases the GIL, so threads hash in parallel
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        entries = pool.map(_hash_file, [os.path.join(stage_dir, f) for f in included])
+        files = {f.replace("\\", "/"): entry for f, entry in zip(included, entries)}
+    return {"chunk_size": CHUNK_SIZE, "files": files}, sorted(excluded)
+
+
+def load_manifest(filename):
+    """Returns the manifest in filename, or None if there isn't one."""
+    try:
+        with open(filename) as inf:
+            manifest = json.load(inf)
+    except (IOError, ValueError):
+        return None
+    if manifest.get("chunk_size") != CHUNK_SIZE:
+        return None
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    tmpf = filename + "_part"
+    with open(tmpf, "w") as outf:
+        json.dump(manifest, outf, sort_keys=True)
+    os.replace(tmpf, filename)
+
+
+class ManifestDiff:  # pylint: disable=too-few-public-methods
+    """Differences between two manifests.
+    .added, .removed, .changed  sorted lists of relative paths
+    .changed_bytes   bytes in new chunks: all of an added file, and the
+                     changed chunks of a changed file
+    .total_bytes     size of the new build"""
+
+    def __init__(self, old, new):
+        old_files = old["files"] if old is not None else {}
+        new_files = new["files"]
+        self.added = sorted(set(new_files) - set(old_files))
+        self.removed = sorted(set(old_files) - set(new_files))
+        self.changed = []
+        self.changed_bytes = 0
+        self.total_bytes = sum(entry["size"] for entry in new_files.values())
+        for name in self.added:
+            self.changed_bytes += new_files[name]["size"]
+        for name in sorted(set(new_files) & set(old_files)):
+            old_entry, new_entry = old_files[name], new_files[name]
+            if old_entry == new_entry:
+                continue
+            self.changed.append(name)
+            for i, chunk in enumerate(new_entry["chunks"]):
+                if i >= len(old_entry["chunks"]) or old_entry["chunks"][i] != chunk:
+                    self.changed_bytes += min(
+                        CHUNK_SIZE, new_entry["size"] - i * CHUNK_SIZE
+                    )
+
+    def report(self, max_files=20):
+        """Returns a human-readable summary."""
+        lines = [
+            "%d added, %d removed, %d changed; %.1f of %.1f MB changed"
+            % (
+                len(self.added),
+                len(self.removed),
+                len(self.changed),
+                self.changed_bytes / 1e6,
+                self.total_bytes / 1e6,
+            )
+        ]
+        for prefix, names in (
+            ("+", self.added),
+            ("-", self.removed),
+            ("M", self.changed),
+        ):
+            for name in names[:max_files]:
+                lines.append("  %s %s" % (prefix, name))
+            if len(names) > max_files:
+                lines.append("  %s ... and %d more" % (prefix, len(names) - max_files))
+        return "\n".join(lines)
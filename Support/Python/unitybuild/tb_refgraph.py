@@ -19,82 +19,80 @@ import os
 import re
 from collections import defaultdict
 
+COMMANDS_ENUM_FILE = "Assets/Scripts/SketchControlsScript.cs"
+DUMMY_CS_FILE = "Assets/Editor/DummyCommandRefs.cs"
 
-def _get_command_lookup(project_dir):
-    # Returns a dict that maps stuff to a GlobalCommand name
-    txt = open(
-        os.path.join(project_dir, "Assets/Scripts/SketchControlsScript.cs")
-    ).read()
-    pat = re.compile(r"public enum GlobalCommands[^}]+}")
-    vals = pat.search(txt).group(0).split("\n")[1:-1]
-    vals = [v.split(",")[0].strip() for v in vals]
-    vals = [v for v in vals if not v.startswith("//")]
-    for v in vals:
-        assert re.match(r"^[a-zA-Z_]+$", v), "Doesn't look like an enum name: %r" % (v,)
-    to_index = {}
-    to_name = {}
-    for i, v in enumerate(vals):
-        for key in (v, v.lower(), i, str(i)):
-            to_index[key] = i
-            to_name[key] = v
-    return to_name  # , to_index
-
-
-def _iter_prefab_and_scene(project_dir):
-    pat = re.compile(r".*\.(unity|prefab)$")
-    for r, _, fs in os.walk(os.path.join(project_dir, "Assets")):
-        for f in fs:
-            if pat.match(f):
-                yield os.path.join(r, f)
-
+# Serialized references in .prefab and .unity files are enum values
+YAML_COMMAND_PAT = re.compile(rb"m_(?:Delayed)?Command: (\d+)")
+# References in .cs files are enum names
+CS_COMMAND_PAT = re.compile(rb"GlobalCommands\.([A-Za-z0-9_]+)")
 
-def _iter_cs(project_dir):
-    for r, _, fs in os.walk(os.path.join(project_dir, "Assets")):
-        for f in fs:
-            if f.endswith(".cs"):
-                yield os.path.join(r, f)
 
-
-def iter_command_nodes(project_dir):
-    """Yields strings like 'GlobalCommands.ToggleWatermark'"""
-    to_name = _get_command_lookup(project_dir)
-    for name in set(to_name.values()):
+def get_command_lookup(project_dir):
+    """Returns a dict that maps GlobalCommands values to names."""
+    with open(os.path.join(project_dir, COMMANDS_ENUM_FILE)) as inf:
+        txt = inf.read()
+    body = re.search(r"public enum GlobalCommands\s*{([^}]+)}", txt).group(1)
+    body = re.sub(r"//[^\n]*|/\*.*?\*/", "", body, flags=re.S)
+    to_name = {}
+    value = -1
+    for entry in body.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        m = re.match(r"^([a-zA-Z_][a-zA-Z0-9_]*)\s*(?:=\s*(-?\d+))?$", entry)
+        assert m, "Doesn't look like an enum entry: %r" % (entry,)
+        value = int(m.group(2)) if m.group(2) is not None else value + 1
+        to_name[value] = m.group(1)
+    return to_name
+
+
+def may_contain_command_refs(filename):
+    return filename.endswith((".unity", ".prefab", ".cs")) and not filename.endswith(
+        os.path.basename(DUMMY_CS_FILE)
+    )
+
+
+def find_command_refs(filename, data):
+    """Returns the GlobalCommands referenced by a file's contents, as a sorted
+    tuple: of enum values (ints) for .unity and .prefab files, or of enum
+    names (strs) for .cs files. data is bytes or an mmap."""
+    if not may_contain_command_refs(filename):
+        return ()
+    if filename.endswith(".cs"):
+        refs = {m.group(1).decode("ascii") for m in CS_COMMAND_PAT.finditer(data)}
+    else:
+        refs = {int(m.group(1)) for m in YAML_COMMAND_PAT.finditer(data)}
+    return tuple(sorted(refs))
+
+
+def iter_command_nodes(to_name):
+    """Yields strings like 'GlobalCommands.ToggleWatermark'
+    to_name is the result of get_command_lookup()."""
+    for name in sorted(set(to_name.values())):
         yield "GlobalCommands." + name
 
 
-def iter_command_edges(project_dir):
-    """Yields tuples like ('Assets/Prefabs/MyPrefab.prefab', 'GlobalCommands.ShowTos')"""
-    to_name = _get_command_lookup(project_dir)
-
-    def command_to_node_name(command):
-        # Returns a canonical node name as it appears in the graph
-        return "GlobalCommands." + to_name[command]
-
-    def file_to_node_name(filename):
-        # Returns a canonical node name as it appears in the graph
-        # Relative to the project root, forward slashes, etc
-        return os.path.relpath(filename, project_dir).replace("\\", "/")
-
-    # Find references in .prefab, .unity files
-    yaml_pat = re.compile(r"m_(Delayed)?Command: (?P<cmd>\d+)")
-    for path in _iter_prefab_and_scene(project_dir):
-        for match in yaml_pat.finditer(open(path).read()):
-            yield file_to_node_name(path), command_to_node_name(match.group("cmd"))
-
-    # Find references in .cs files
-    cs_pat = re.compile(r"GlobalCommands\.[A-Za-z0-9_]+")
-    for path in _iter_cs(project_dir):
-        if path.endswith("DummyCommandRefs.cs"):
-            continue
-        for match in cs_pat.finditer(open(path).read()):
-            yield file_to_node_name(path), match.group(0)
+def iter_command_edges(scan, to_name):
+    """Yields tuples like ('Assets/Prefabs/MyPrefab.prefab', 'GlobalCommands.ShowTos')
+    scan is a unitybuild.assetscan.AssetScan; to_name is the result of
+    get_command_lookup()."""
+    for file_name, refs in sorted(scan.iter_command_refs()):
+        for ref in refs:
+            if isinstance(ref, str):
+                yield file_name, "GlobalCommands." + ref
+            elif ref in to_name:
+                yield file_name, "GlobalCommands." + to_name[ref]
+            else:
+                print("%s: unknown GlobalCommands value %d" % (file_name, ref))
 
 
 def create_dummy_cs(project_dir, command_edges):
+    """Writes DummyCommandRefs.cs, if its contents would change."""
     file_to_commands = defaultdict(set)
     for src, dst in command_edges:
         if src.endswith(".cs"):
-            break
+            continue
         file_to_commands[src].add(dst)
     file_to_commands = [
         (k, sorted(file_to_commands[k])) for k in sorted(file_to_commands.keys())
@@ -105,14 +103,12 @@ def create_dummy_cs(project_dir, command_edges):
         func_name = os.path.splitext(file_name)[0][7:]
         func_name = func_name.replace("/", "_").replace(".", "_")
         return (
-            "  public static void %s() {\n" % func_name
-            + "\n".join("    Use(%s);" % c for c in commands)
-            + "\n  }\n"
+            "        public static void %s()\n        {\n" % func_name
+            + "\n".join("            Use(%s);" % c for c in commands)
+            + "\n        }\n"
         )
 
-    cs_name = os.path.join(project_dir, "Assets/Editor/DummyCommandRefs.cs")
-    with open(cs_name, "w") as outf:
-        outf.write("""// Copyright 2020 The Tilt Brush Authors
+    contents = """// Copyright 2020 The Tilt Brush Authors
 //
 // Licensed under the Apache License, Version 2.0 (the "License");
 // you may not use this file except in compliance with the License.
@@ -127,18 +123,37 @@ def create_dummy_cs(project_dir, command_edges):
 // limitations under the License.
 
 using GlobalCommands = TiltBrush.SketchControlsScript.GlobalCommands;
-namespace TiltBrush {
-/// Auto-generated by Support/bin/analyze_refgraph.py --recreate
-/// The purpose of this file is to make it easier to find GlobalCommand references
-/// which come from serialized data.
-public static class DummyCommandRefs {
-  static void Use(GlobalCommands c) { UnityEngine.Debug.Log(c.ToString()); }
-
-%s}
-}""" % "\n".join([as_func(fc) for fc in file_to_commands]))
+namespace TiltBrush
+{
+    /// Auto-generated by Support/bin/analyze_refgraph.py --recreate
+    /// The purpose of this file is to make it easier to find GlobalCommand references
+    /// which come from serialized data.
+    public static class DummyCommandRefs
+    {
+        static void Use(GlobalCommands c) { UnityEngine.Debug.Log(c.ToString()); }
+
+%s    }
+}
+""" % "\n".join([as_func(fc) for fc in file_to_commands])
+
+    cs_name = os.path.join(project_dir, DUMMY_CS_FILE)
+    try:
+        with open(cs_name, newline="") as inf:
+            if inf.read() == contents:
+                return
+    except IOError:
+        pass
+    with open(cs_name, "w", newline="") as outf:
+        outf.write(contents)
 
 
 if __name__ == "__main__":
     # This is also done as part of analyze_refgraph.py --recreate
+    from unitybuild.assetscan import scan_project
+
     test_project_dir = "c:/src/tb"
-    create_dummy_cs(test_project_dir, iter_command_edges(test_project_dir))
+    test_to_name = get_command_lookup(test_project_dir)
+    create_dummy_cs(
+        test_project_dir,
+        iter_command_edges(scan_project(test_project_dir), test_to_name),
+    )
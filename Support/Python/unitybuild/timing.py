@@ -0,0 +1,206 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-phase build timing, a JSON-lines history of it, and trend reports.
+
+Each line of the history file is one build of one (platform, vrsdk, config):
+  {"time": "2020-01-01T12:00:00", "stamp": ..., "host": ..., "platform": ...,
+   "vrsdk": ..., "config": ..., "success": true, "total": 1234.5,
+   "phases": {"build": 1200.0, ...}, "unity_phases": {"BuildTiltBrush: Start": 900.1, ...}}
+Phase times are in seconds."""
+
+import contextlib
+import datetime
+import json
+import os
+import re
+import statistics
+import time
+
+# Unity-side phases begin at lines like these
+UNITY_PHASE_PREFIXES = ("_btb_ ", "DisplayProgressbar: ")
+# "BuildTiltBrush: Start target:Android mode:..." -> "BuildTiltBrush: Start"
+UNITY_PHASE_ARGS_PAT = re.compile(r"\s+\S+:.*$")
+UNITY_STARTUP = "(startup)"
+
+
+class UnityPhaseTimer:
+    """Log subscriber that times the phases of a Unity build.
+    A phase starts at each _btb_ or DisplayProgressbar line and ends at the
+    next one, or at the end of the log. Time before the first one is
+    attributed to UNITY_STARTUP. Use with LogTailer.subscribe()."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = [(UNITY_STARTUP, self.start)]
+        self.end = None
+
+    def on_line(self, line):
+        for prefix in UNITY_PHASE_PREFIXES:
+            if line.startswith(prefix):
+                name = UNITY_PHASE_ARGS_PAT.sub("", line[len(prefix) :].strip())
+                if name and name != self.marks[-1][0]:
+                    self.marks.append((name, time.perf_counter()))
+                return
+
+    def on_close(self):
+        self.end = time.perf_counter()
+
+    def durations(self):
+        """Returns dict mapping phase name -> total seconds spent in it."""
+        end = self.end if self.end is not None else time.perf_counter()
+        ret = {}
+        for (name, t0), (_, t1) in zip(self.marks, self.marks[1:] + [(None, end)]):
+            ret[name] = ret.get(name, 0) + (t1 - t0)
+        return ret
+
+
+class BuildTimer:
+    """Times the phases of one build of one matrix entry.
+
+    Usage:
+      with BuildTimer(history_file, platform=..., vrsdk=..., config=...) as timer:
+        with timer.phase("build"):
+          ...
+    On leaving the outer block, the build is recorded as a success unless the
+    block raised, and the record is appended to history_file (if not None)."""
+
+    def __init__(self, history_file=None, **info):
+        self.history_file = history_file
+        self.info = info
+        self.phases = {}
+        self.unity = None
+        self.success = False
+        self._start = time.perf_counter()
+        self._time = datetime.datetime.now().isoformat(timespec="seconds")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.success = exc_type is None
+        if self.history_file is not None:
+            try:
+                self.append_to(self.history_file)
+            except IOError as e:
+                print("WARN: could not write build timings: %s" % (e,))
+        return False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent in the block to phase *name*,
+        even if the block raises."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + (time.perf_counter() - t0)
+
+    def unity_phase_timer(self):
+        """Returns a new UnityPhaseTimer whose results go into this record."""
+        self.unity = UnityPhaseTimer()
+        return self.unity
+
+    def as_record(self):
+        record = {"time": self._time}
+        record.update(self.info)
+        record["success"] = self.success
+        record["total"] = round(time.perf_counter() - self._start, 3)
+        record["phases"] = {k: round(v, 3) for k, v in self.phases.items()}
+        if self.unity is not None:
+            record["unity_phases"] = {
+                k: round(v, 3) for k, v in self.unity.durations().items()
+            }
+        return record
+
+    def append_to(self, history_file):
+        """Appends this build's record to history_file, as one line of JSON."""
+        dirname = os.path.dirname(history_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(history_file, "a") as outf:
+            outf.write(json.dumps(self.as_record(), sort_keys=True) + "\n")
+
+
+def read_history(history_file):
+    """Returns the records in history_file, oldest first.
+    Lines that do not parse are skipped."""
+    records = []
+    with open(history_file) as inf:
+        for line in inf:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def _record_key(record):
+    return "%s %s %s" % (
+        record.get("platform"),
+        record.get("vrsdk"),
+        record.get("config"),
+    )
+
+
+def iter_phase_trends(records, window=10, include_failures=False):
+    """Groups records by (platform, vrsdk, config) and compares each phase of the
+    latest build against the median of the *window* builds before it.
+    Yields (group, phase, latest, median, num_samples); median is None if there
+    are no earlier samples. Unity-side phases are prefixed with "unity/"."""
+    groups = {}
+    for record in records:
+        if record.get("success") or include_failures:
+            groups.setdefault(_record_key(record), []).append(record)
+
+    def phases_of(record):
+        ret = {"total": record["total"]}
+        ret.update(record.get("phases", {}))
+        ret.update(("unity/" + k, v) for k, v in record.get("unity_phases", {}).items())
+        return ret
+
+    for group in sorted(groups):
+        history = [phases_of(r) for r in groups[group]]
+        latest = history[-1]
+        earlier = history[-1 - window : -1]
+        for phase, value in latest.items():
+            samples = [h[phase] for h in earlier if phase in h]
+            median = statistics.median(samples) if samples else None
+            yield group, phase, value, median, len(samples)
+
+
+def print_report(records, window=10, threshold=0.2, min_seconds=5.0):
+    """Prints per-phase trends. A phase is flagged as a regression if it is both
+    *threshold* (a fraction) and *min_seconds* slower than its recent median."""
+    current = None
+    regressions = 0
+    for group, phase, value, median, count in iter_phase_trends(records, window):
+        if group != current:
+            current = group
+            print("\n%s" % group)
+            print("  %-40s %10s %10s %8s" % ("phase", "latest", "median", "change"))
+        if median is None:
+            print("  %-40s %10.1f %10s %8s" % (phase[:40], value, "-", "-"))
+            continue
+        delta = value - median
+        change = delta / median if median else 0.0
+        flag = ""
+        if delta >= min_seconds and change >= threshold:
+            flag = "  REGRESSION (n=%d)" % count
+            regressions += 1
+        print(
+            "  %-40s %10.1f %10.1f %+7.0f%%%s"
+            % (phase[:40], value, median, change * 100, flag)
+        )
+    return regressions
@@ -0,0 +1,325 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental parser for Unity's build log.
+
+The log is fed in one line at a time as Unity writes it, so failures are
+noticed as soon as they appear and the log is never held in memory."""
+
+import collections
+import re
+import sys
+
+from unitybuild.constants import BuildFailed
+
+# All of BuildTiltBrush.CommandLine()'s output is prefixed with _btb_
+PROGRESS_PAT = re.compile("(_btb_ |DisplayProgressbar: )(.*)")
+MUNGE_PAT = re.compile("Updating (Assets/.*) - GUID")
+
+# Compile output looks like this:
+# -----CompilerOutput:-stdout--exitcode: 1--compilationhadfailure: True--outfile: Temp/Assembly-CSharp-Editor.dll
+# Compilation failed: 1 error(s), 0 warnings
+# -----CompilerOutput:-stderr----------
+# Assets/Editor/BuildTiltBrush.cs(33,7): error CS1519: <etc etc>
+# -----EndCompilerOutput---------------
+COMPILER_START_PAT = re.compile(r"^-----CompilerOutput:-stdout(?P<metadata>.*)$")
+COMPILER_STDERR = "-----CompilerOutput:-stderr----------"
+COMPILER_END = "-----EndCompilerOutput"
+
+# Build exceptions look like this:
+# BuildFailedException: <<Build sanity checks failed:
+# This is a dummy error>>
+#   at BuildTiltBrush.DoBuild (BuildOptions options, BuildTarget target, System.String location, SdkMode vrSdk, Boolean isExperimental, System.String stamp) [0x0026a] in C:\src\tb\Assets\Editor\BuildTiltBrush.cs:430
+#   at BuildTiltBrush.CommandLine () [0x001de] in C:\src\tb\Assets\Editor\BuildTiltBrush.cs:259
+BUILD_FAILED_START = "BuildFailedException: <<"
+TRACEBACK_PREFIX = "  at "
+
+INTERNAL_ERROR_PAT = re.compile(
+    r"^executeMethod method (?P<methodname>.*) threw exception\."
+)
+EXCEPTION_PAT = re.compile(r"^[A-Z][A-Za-z0-9]+(Exception|Error):", re.MULTILINE)
+# How much log to keep around for an internal error
+INTERNAL_ERROR_CONTEXT = 1024
+
+# Check for BuildTiltBrush.Die()
+BTB_DIE_START = "_btb_ Abort <<"
+
+# Parser states
+NORMAL = "normal"
+COMPILER_STDOUT = "compiler_stdout"
+COMPILER_STDERR_STATE = "compiler_stderr"
+BUILD_FAILED_DESCRIPTION = "build_failed_description"
+BUILD_FAILED_TRACEBACK = "build_failed_traceback"
+BTB_DIE_DESCRIPTION = "btb_die_description"
+
+
+def indent(prefix, text):
+    return "\n".join(prefix + line for line in text.split("\n"))
+
+
+def search_backwards(text, start_point, limit, pattern):
+    """Search the range [limit, start_point] for instances of |pattern|.
+    Returns the one closest to |start_point|.
+    Returns |limit| if none are found."""
+    assert limit < start_point
+    matches = list(pattern.finditer(text[limit:start_point]))
+    if len(matches) == 0:
+        return limit
+    return limit + matches[-1].start(0)
+
+
+def _parse_compiler_metadata(metadata):
+    dct = {}
+    for chunk in metadata.split("--"):
+        if chunk:
+            key, value = chunk.split(": ", 1)
+            dct[key] = value
+    dct["exitcode"] = int(dct["exitcode"])
+    dct["compilationhadfailure"] = dct["compilationhadfailure"] != "False"
+    return dct
+
+
+class UnityLogAnalyzer:
+    """Line-at-a-time state machine over a Unity log.
+    .compiler_output   list of dicts with the keys:
+                       exitcode, compilationhadfailure, outfile, stdout, stderr
+    .build_failed      (description, traceback) of the first BuildFailedException
+    .internal_error    (methodname, suspicious log portion) of the first one seen
+    .btb_die           description passed to the first BuildTiltBrush.Die()
+    .failed            True once anything that dooms the build has been seen
+
+    on_progress(kind, text) is called for progress lines; kind is "Unity" or
+    "Munge". on_failure() is called the first time .failed becomes True."""
+
+    def __init__(self, on_progress=None, on_failure=None):
+        self.on_progress = on_progress
+        self.on_failure = on_failure
+        self.compiler_output = []
+        self.build_failed = None
+        self.internal_error = None
+        self.btb_die = None
+        self.failed = False
+        self._state = NORMAL
+        self._block = None
+        self._lines = []
+        self._partial = ""
+        # Recent lines, for internal error context
+        self._recent = collections.deque()
+        self._recent_len = 0
+
+    # ------------------------------------------------------------------
+    # Input
+    # ------------------------------------------------------------------
+
+    def feed(self, text):
+        """Consumes a chunk of log text, which need not end on a line boundary."""
+        text = self._partial + text.replace("\r", "")
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+
+    def close(self):
+        """Call at end of log. Finishes any partial line or block."""
+        if self._partial:
+            self.feed_line(self._partial)
+            self._partial = ""
+        if self._state == BUILD_FAILED_TRACEBACK:
+            self._finish_build_failed()
+        self._state = NORMAL
+
+    def feed_line(self, line):
+        """Consumes one line of the log, without its line terminator."""
+        if self.on_progress is not None:
+            m = PROGRESS_PAT.match(line)
+            if m is not None:
+                self.on_progress("Unity", m.group(2))
+            else:
+                m = MUNGE_PAT.match(line)
+                if m is not None:
+                    self.on_progress("Munge", m.group(1))
+
+        if self._state == NORMAL:
+            self._feed_normal(line)
+        elif self._state == COMPILER_STDOUT:
+            if line == COMPILER_STDERR:
+                self._state = COMPILER_STDERR_STATE
+                self._block["stdout"] = "\n".join(self._lines).strip()
+                self._lines = []
+            elif line.startswith(COMPILER_END):
+                self._block["stdout"] = "\n".join(self._lines).strip()
+                self._lines = []
+                self._finish_compiler_output()
+            else:
+                self._lines.append(line)
+        elif self._state == COMPILER_STDERR_STATE:
+            if line.startswith(COMPILER_END):
+                self._finish_compiler_output()
+            else:
+                self._lines.append(line)
+        elif self._state == BUILD_FAILED_DESCRIPTION:
+            self._feed_description(line, BUILD_FAILED_TRACEBACK)
+        elif self._state == BUILD_FAILED_TRACEBACK:
+            if line.startswith(TRACEBACK_PREFIX):
+                self._lines.append(line)
+            else:
+                self._finish_build_failed()
+                self._feed_normal(line)
+        elif self._state == BTB_DIE_DESCRIPTION:
+            self._feed_description(line, None)
+
+        self._remember(line)
+
+    # ------------------------------------------------------------------
+    # States
+    # ------------------------------------------------------------------
+
+    def _feed_normal(self, line):
+        m = COMPILER_START_PAT.match(line)
+        if m is not None:
+            self._state = COMPILER_STDOUT
+            self._block = _parse_compiler_metadata(m.group("metadata"))
+            self._block["stderr"] = ""
+            self._lines = []
+            return
+
+        i = line.find(BUILD_FAILED_START)
+        if i >= 0:
+            self._block = None
+            self._lines = []
+            self._feed_description(
+                line[i + len(BUILD_FAILED_START) :], BUILD_FAILED_TRACEBACK
+            )
+            return
+
+        i = line.find(BTB_DIE_START)
+        if i >= 0:
+            self._block = None
+            self._lines = []
+            self._feed_description(line[i + len(BTB_DIE_START) :], None)
+            return
+
+        m = INTERNAL_ERROR_PAT.match(line)
+        if m is not None and self.internal_error is None:
+            recent = "".join(self._recent)
+            text = recent + line
+            limit = max(0, len(recent) - INTERNAL_ERROR_CONTEXT)
+            start = limit
+            if limit < len(recent):
+                start = search_backwards(text, len(recent), limit, EXCEPTION_PAT)
+            self.internal_error = (m.group("methodname"), text[start:])
+            self._set_failed()
+
+    def _feed_description(self, text, next_state):
+        """Accumulates a <<description>>. next_state is BUILD_FAILED_TRACEBACK
+        for a BuildFailedException, or None for BuildTiltBrush.Die()."""
+        i = text.find(">>")
+        if i < 0:
+            self._lines.append(text)
+            self._state = (
+                BUILD_FAILED_DESCRIPTION if next_state else BTB_DIE_DESCRIPTION
+            )
+            return
+        self._lines.append(text[:i])
+        description = "\n".join(self._lines)
+        self._lines = []
+        if next_state == BUILD_FAILED_TRACEBACK:
+            self._block = description
+            self._state = BUILD_FAILED_TRACEBACK
+        else:
+            if self.btb_die is None:
+                self.btb_die = description
+            self._state = NORMAL
+            self._set_failed()
+
+    def _finish_compiler_output(self):
+        self._block["stderr"] = "\n".join(self._lines).strip()
+        self.compiler_output.append(self._block)
+        failed = self._block["compilationhadfailure"]
+        self._block = None
+        self._lines = []
+        self._state = NORMAL
+        if failed:
+            self._set_failed()
+
+    def _finish_build_failed(self):
+        if self.build_failed is None:
+            self.build_failed = (self._block, "\n".join(self._lines))
+        self._block = None
+        self._lines = []
+        self._state = NORMAL
+        self._set_failed()
+
+    def _remember(self, line):
+        line += "\n"
+        self._recent.append(line)
+        self._recent_len += len(line)
+        while self._recent_len - len(self._recent[0]) >= INTERNAL_ERROR_CONTEXT:
+            self._recent_len -= len(self._recent.popleft())
+
+    def _set_failed(self):
+        if not self.failed:
+            self.failed = True
+            if self.on_failure is not None:
+                self.on_failure()
+
+    # ------------------------------------------------------------------
+    # Results
+    # ------------------------------------------------------------------
+
+    def check_compile_output(self, echo=None):
+        """Raises BuildFailed if compile errors are found.
+        Spews to stderr (or to echo(text), if passed) if compile warnings are found."""
+        dcts = self.compiler_output
+        compiler_output = "\n".join(
+            stuff.strip() for dct in dcts for stuff in [dct["stderr"], dct["stdout"]]
+        )
+        if any(dct["compilationhadfailure"] for dct in dcts):
+            # Mono puts it in stderr; Roslyn puts it in stdout.
+            # But! Unity 2018 also gives us a good build report, so we might be able to
+            # get the compiler failures from the build report instead of this ugly parsing
+            # through Unity's log file.
+            raise BuildFailed("Compile\n%s" % indent("| ", compiler_output))
+        if compiler_output != "":
+            warnings = "Compile warnings:\n%s" % indent("| ", compiler_output)
+            if echo is None:
+                print(warnings, file=sys.stderr)
+            else:
+                echo(warnings)
+
+    def analyze_unity_failure(self, exitcode):
+        """Raise BuildFailed with as much information about the failure as possible."""
+        if self.build_failed is not None:
+            description, traceback = self.build_failed
+            raise BuildFailed(
+                "C# raised BuildFailedException\n%s\n| ---\n%s"
+                % (
+                    indent("| ", traceback.strip()),
+                    indent("| ", description.strip()),
+                )
+            )
+
+        if self.internal_error is not None:
+            methodname, suspicious_portion = self.internal_error
+            raise BuildFailed("""Build script '%s' had an internal error.
+Suspect log portion:
+%s""" % (methodname, indent("| ", suspicious_portion)))
+
+        if self.btb_die is not None:
+            raise BuildFailed("C# called Die %s '%s'" % (exitcode, self.btb_die))
+
+        if exitcode is None:
+            raise BuildFailed("Unity build seems to have been terminated prematurely")
+        raise BuildFailed("""Unity build failed with exit code %s but no errors seen
+This probably means the project is already open in Unity""" % exitcode)
@@ -16,12 +16,16 @@
 
 import _thread
 import contextlib
+import ctypes
+import ctypes.util
 import json
 import os
 import platform
+import select
 import stat
 import threading
 import subprocess
+import time
 from unitybuild.constants import InternalError
 
 if platform.system() == "Windows":
@@ -30,7 +34,6 @@ if platform.system() == "Windows":
 
 if os.getenv("MSYSTEM"):
     import msvcrt  # pylint: disable=import-error
-    import ctypes
     from ctypes.wintypes import HANDLE, DWORD
     from _subprocess import (  # pylint: disable=import-error
         WaitForSingleObject,
@@ -52,6 +55,75 @@ def ensure_terminate(proc):
             print("WARN: Could not kill process: %s" % (e,))
 
 
+class PollingDirWatcher:
+    """Portable fallback for InotifyDirWatcher: wait() just sleeps."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyDirWatcher:
+    """Wakes up when a file in *directory* is created or written to.
+    Linux only; raises OSError if inotify is not available."""
+
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, directory):
+        self.directory = directory
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("No libc")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("No inotify")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed", directory)
+
+    def wait(self, timeout):
+        """Returns True if something changed, False on timeout."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # We don't care which file changed or how; just drain the events
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_dir_watcher(directory):
+    """Returns an object with wait(timeout) and close() methods; wait() returns
+    early when a file in *directory* changes, if the platform supports it."""
+    if platform.system() == "Linux":
+        try:
+            return InotifyDirWatcher(directory)
+        except OSError:
+            pass
+    return PollingDirWatcher(directory)
+
+
 def destroy(file_or_dir):
     """Ensure that *file_or_dir* does not exist in the filesystem,
     deleting it if necessary."""
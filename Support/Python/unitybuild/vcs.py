@@ -12,12 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import functools
 import os
 import re
 import subprocess
+import sys
 
 from unitybuild.constants import UserError
 
+# Untracked files that the build itself writes into Assets/. They are derived
+# from tracked files, so they don't make the tree hash stale.
+GENERATED_ASSETS = frozenset(
+    [
+        "Assets/Resources/ViverseViewer.bytes",
+        "Assets/Resources/ViverseViewer.bytes.meta",
+    ]
+)
+
 
 def _plural(noun, num):
     if num == 1:
@@ -54,10 +66,65 @@ def git(cmd, cwd=None):
     return str(stdout)
 
 
+def git_many(cmds, cwd=None):
+    """Runs several independent git commands concurrently.
+    Returns a list with, for each command, either its stdout or the
+    CalledProcessError it raised."""
+
+    def run(cmd):
+        try:
+            return git(cmd, cwd=cwd)
+        except subprocess.CalledProcessError as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(len(cmds)) as pool:
+        return list(pool.map(run, cmds))
+
+
+@functools.lru_cache(maxsize=None)
+def _status_options():
+    """Returns "-c" options that make git status faster, where supported."""
+    options = ["-c", "core.untrackedCache=true"]
+    # The builtin fsmonitor daemon only exists on these platforms.
+    # Don't override an existing fsmonitor hook.
+    if sys.platform in ("win32", "darwin"):
+        version, configured = git_many(["version", "config core.fsmonitor"])
+        m = re.search(r"(\d+)\.(\d+)", version if isinstance(version, str) else "")
+        if m is not None and (int(m.group(1)), int(m.group(2))) >= (2, 37):
+            if not isinstance(configured, str):
+                options += ["-c", "core.fsmonitor=true"]
+    return options
+
+
+def _iter_status_v2(output):
+    """Parses "git status --porcelain=v2 -z" output.
+    Yields (xy, filename), where xy is "??" for untracked files and is otherwise
+    the two-character change code, eg ".M"."""
+    records = iter(output.split("\0"))
+    for record in records:
+        kind = record[:1]
+        if kind == "?":
+            yield "??", record[2:]
+        elif kind == "1":
+            yield record[2:4], record.split(" ", 8)[8]
+        elif kind == "2":
+            yield record[2:4], record.split(" ", 9)[9]
+            next(records)  # original path of a rename or copy
+        elif kind == "u":
+            yield record[2:4], record.split(" ", 10)[10]
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
 def create():
     """Returns a VCS instance."""
     try:
-        git("status")
+        git("rev-parse --git-dir")
     except subprocess.CalledProcessError:
         return NullVcs()
     return GitVcs()
@@ -74,6 +141,11 @@ class VcsBase:  # pylint: disable=too-few-public-methods
         Build stamp is currently a p4 changelist number, eg '@1234'"""
         raise NotImplementedError()
 
+    def get_tree_hash(self, input_directory):
+        """Returns a hash of the version-controlled build inputs.
+        Raises LookupError if this is not possible."""
+        raise NotImplementedError()
+
 
 class NullVcs(VcsBase):  # pylint: disable=too-few-public-methods
     """VCS implementation that does nothing"""
@@ -81,65 +153,118 @@ class NullVcs(VcsBase):  # pylint: disable=too-few-public-methods
     def get_build_stamp(self, input_directory):
         raise LookupError("Not using version control")
 
+    def get_tree_hash(self, input_directory):
+        raise LookupError("Not using version control")
+
 
 class GitVcs(VcsBase):  # pylint: disable=too-few-public-methods
-    """VCS implementation that uses git (without p4)"""
+    """VCS implementation that uses git (without p4)
+
+    Query results are memoized per (HEAD, index mtime), so asking for the stamp
+    and tree hash repeatedly costs a single cheap git call after the first time.
+    Working-tree edits that don't touch the index are not noticed until HEAD
+    or the index next changes."""
 
     def __init__(self):
         super().__init__()
         try:
-            git("status")
+            git("rev-parse --git-dir")
         except subprocess.CalledProcessError as e:
             raise UserError("Not in a git client") from e
+        self._memo = {}
 
-    @staticmethod
-    def _get_local_branch():
-        ref = git("rev-parse --symbolic-full-name HEAD")
-        m = re.match(r"refs/heads/(.*)", ref)
-        if m is None:
-            raise LookupError("Not on a branch")
-        return m.group(1)
+    def _snapshot(self, input_directory):
+        """Returns (memo dict for the current state of the repo, tree hash)."""
+        try:
+            head, tree, index = git(
+                ["rev-parse", "HEAD", "HEAD^{tree}", "--git-path", "index"],
+                cwd=input_directory,
+            ).split("\n")[:3]
+        except subprocess.CalledProcessError as e:
+            raise LookupError("Can't find HEAD: %s" % (e.output,)) from e
+        index = os.path.join(input_directory, index)
+        key = (os.path.realpath(input_directory), head, _mtime(index))
+        memo = self._memo.setdefault(key, {"key": key, "index": index})
+        return memo, tree
 
-    def _get_gob_branch(self):
+    @staticmethod
+    def _get_gob_branch(input_directory):
         """Returns the name of the branch on GoB that the current branch is tracking,
         as well as the local name of the tracking branch.
         eg, ("master", "refs/remotes/origin/master")
         Raises LookupError on failure, eg if not on a branch, or remote is not GoB."""
-        branch = self._get_local_branch()
-        try:
-            remote = git("config branch.%s.remote" % branch).strip()
-        except subprocess.CalledProcessError:
-            remote = ""
+        refs, config = git_many(
+            [
+                ["rev-parse", "--symbolic-full-name", "HEAD", "@{u}"],
+                ["config", "-z", "--get-regexp", r"^(branch|remote)\."],
+            ],
+            cwd=input_directory,
+        )
+        if not isinstance(refs, str):
+            # Either HEAD is detached or there is no upstream; distinguish for the user
+            try:
+                refs = git("rev-parse --symbolic-full-name HEAD", cwd=input_directory)
+            except subprocess.CalledProcessError:
+                refs = ""
+            if not refs.startswith("refs/heads/"):
+                raise LookupError("Not on a branch")
+            raise LookupError("Can't determine GoB branch: no remote")
+        ref, tracking = refs.split("\n")[:2]
+        m = re.match(r"refs/heads/(.*)", ref)
+        if m is None:
+            raise LookupError("Not on a branch")
+        branch = m.group(1)
+
+        values = {}
+        if isinstance(config, str):
+            for item in config.split("\0"):
+                name, _, value = item.partition("\n")
+                values[name] = value
+        remote = values.get("branch.%s.remote" % branch, "")
         if remote == "":
             raise LookupError("Can't determine GoB branch: no remote")
-        git("config remote.%s.url" % remote).strip()
-        remote_branch = git("config branch.%s.merge" % branch).strip()
+        remote_branch = values.get("branch.%s.merge" % branch, "")
         m = re.match("refs/heads/(.*)", remote_branch)
         if m is None:
             raise LookupError(
                 "Can't determine GoB name: %s looks funny" % remote_branch
             )
-
-        tracking = git("rev-parse --symbolic-full-name @{u}").strip()
         assert tracking != ""
         return m.group(1), tracking
 
-    def get_build_stamp(self, input_directory):  # pylint: disable=too-many-branches
-        """Stamp is of the form:
-          <sha>
-          <sha>+<local changes>
-        <sha> is a sha of the lastest GoB commit included in the current build.
-        <local changes> is a tiny description of any changes in the build that aren't on GoB.
-        """
-        try:
-            status = git("status --porcelain", cwd=input_directory)
-        except subprocess.CalledProcessError as e:
-            print("UNEXPECTED: %s\n%s" % (e, e.output))
-            print("In:", os.getcwd())
-            assert False
-        for match in re.finditer(r"^(.[MADR]|[MADR].) (.*)", status, re.MULTILINE):
+    def _get_status(self, input_directory, memo):
+        if "status" not in memo:
+            try:
+                status = git(
+                    _status_options() + ["status", "--porcelain=v2", "-z"],
+                    cwd=input_directory,
+                )
+            except subprocess.CalledProcessError as e:
+                print("UNEXPECTED: %s\n%s" % (e, e.output))
+                print("In:", os.getcwd())
+                assert False
+            memo["status"] = list(_iter_status_v2(status))
+            # git status may have refreshed the index; that doesn't invalidate anything
+            key = memo["key"][:2] + (_mtime(memo["index"]),)
+            self._memo[key] = memo
+        return memo["status"]
+
+    def _iter_modified_files(
+        self, input_directory, include_untracked_assets=False, memo=None
+    ):
+        """Yields modified files that could affect the build."""
+        if memo is None:
+            memo, _ = self._snapshot(input_directory)
+        for xy, filename in self._get_status(input_directory, memo):
+            if xy == "??":
+                if (
+                    include_untracked_assets
+                    and filename.startswith("Assets/")
+                    and filename not in GENERATED_ASSETS
+                ):
+                    yield filename
+                continue
             # Ignore changes in build script files
-            filename = match.group(2)
             if re.match(r"Support/(.*\.py|obfuscation_map\.txt)$", filename):
                 continue
             # For practicality, ignore changes to ProjectSettings too; allows Jon to re-build
@@ -148,24 +273,65 @@ class GitVcs(VcsBase):  # pylint: disable=too-few-public-methods
             # we only ignore changes to AndroidBundleVersionCode.
             if filename == "ProjectSettings/ProjectSettings.asset":
                 continue
+            yield filename
+
+    def get_tree_hash(self, input_directory):
+        """Returns the git tree hash of HEAD, which identifies the build inputs
+        as long as the working tree has no relevant changes. ProjectSettings
+        changes are allowed (see get_build_stamp), so callers should account
+        for them separately.
+        Raises LookupError if the working tree has other changes."""
+        memo, tree = self._snapshot(input_directory)
+        for filename in self._iter_modified_files(
+            input_directory, include_untracked_assets=True, memo=memo
+        ):
             raise LookupError("repo has modified files (%s)" % filename)
+        return tree
+
+    def get_build_stamp(self, input_directory):
+        """Stamp is of the form:
+          <sha>
+          <sha>+<local changes>
+        <sha> is a sha of the lastest GoB commit included in the current build.
+        <local changes> is a tiny description of any changes in the build that aren't on GoB.
+        """
+        memo, _ = self._snapshot(input_directory)
+        if "stamp" not in memo:
+            memo["stamp"] = self._compute_build_stamp(input_directory, memo)
+        return memo["stamp"]
+
+    def _compute_build_stamp(self, input_directory, memo):
+        # Independent queries run concurrently, in three rounds
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            gob_branch = pool.submit(self._get_gob_branch, input_directory)
+            for filename in self._iter_modified_files(input_directory, memo=memo):
+                raise LookupError("repo has modified files (%s)" % filename)
+            _, tracked_ref = gob_branch.result()
 
-        _, tracked_ref = self._get_gob_branch()
-        base = git("merge-base %s HEAD" % tracked_ref).strip()
+        # Since base is the merge-base, base..HEAD is the same as tracked_ref..HEAD
+        log = ["log", "--pretty=tformat:%h %s"]
+        base, ahead_commits, behind_commits = git_many(
+            [
+                ["merge-base", tracked_ref, "HEAD"],
+                log + ["%s..HEAD" % tracked_ref],
+                log + ["HEAD..%s" % tracked_ref],
+            ],
+            cwd=input_directory,
+        )
+        for result in (ahead_commits, behind_commits):
+            if not isinstance(result, str):
+                raise result
+        base = base.strip() if isinstance(base, str) else ""
         if base == "":
             raise LookupError("No common ancestor with %s" % tracked_ref)
-        base = git("rev-parse --short %s" % base).strip()
+        base = git("rev-parse --short %s" % base, cwd=input_directory).strip()
         # It's verbose and redundant (with our human-made version number) to put the
         # gob branch name in the stamp. The sha is all we really need.
         # gob_name = '%s-%s' % (tracked_name.replace('-', ''), base)
         gob_name = base
 
-        ahead_commits = git(["log", "--pretty=tformat:%h %s", "%s..HEAD" % base]).split(
-            "\n"
-        )[:-1]
-        behind_commits = git(
-            ["log", "--pretty=tformat:%h %s", "HEAD..%s" % tracked_ref]
-        ).split("\n")[:-1]
+        ahead_commits = ahead_commits.split("\n")[:-1]
+        behind_commits = behind_commits.split("\n")[:-1]
         if len(ahead_commits) == 0:
             if len(behind_commits) > 0:
                 # Still allow the build without a custom stamp, but warn that it's not head
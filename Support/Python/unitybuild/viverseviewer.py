@@ -16,16 +16,126 @@
 Utility to generate ViverseViewer.bytes from ViverseViewer source directory
 """
 
+import concurrent.futures
+import hashlib
 import os
+import struct
 import zipfile
+import zlib
+
+# Bump this if the archive layout changes, to force regeneration
+PACKAGER_VERSION = 1
+# Zip stores DOS times; use the earliest one so the output is reproducible
+ZIP_DOS_DATE = (1 << 5) | 1  # 1980-01-01
+ZIP_DOS_TIME = 0
+ZIP_VERSION = 20  # 2.0: deflate
+ZIP_CREATE_VERSION = (3 << 8) | ZIP_VERSION  # unix, so external attrs are modes
+ZIP_EXTERNAL_ATTR = 0o100644 << 16
+COMPRESS_LEVEL = 9
+
+
+def _iter_source_files(viewer_src):
+    """Yields (arcname, path) for every file under viewer_src, sorted by arcname."""
+    found = []
+    for dirpath, _, files in os.walk(viewer_src):
+        for file_name in files:
+            file_path = os.path.join(dirpath, file_name)
+            # Normalize to forward slashes for cross-platform compatibility
+            arcname = os.path.relpath(file_path, viewer_src).replace("\\", "/")
+            found.append((arcname, file_path))
+    return sorted(found)
+
+
+def _source_digest(sources):
+    """Returns a hex digest of the names and contents of sources."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(b"%d\0" % PACKAGER_VERSION)
+    for arcname, file_path in sources:
+        with open(file_path, "rb") as inf:
+            data = inf.read()
+        digest.update(b"%s\0%d\0" % (arcname.encode("utf-8"), len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _existing_digest(viewer_dest):
+    """Returns the source digest recorded in the archive comment, or None."""
+    try:
+        with zipfile.ZipFile(viewer_dest) as zipf:
+            return zipf.comment.decode("ascii")
+    except (OSError, zipfile.BadZipFile, UnicodeDecodeError):
+        return None
+
+
+def _compress_member(arcname, file_path):
+    """Returns (name, method, crc, size, data) for one archive member."""
+    with open(file_path, "rb") as inf:
+        raw = inf.read()
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(raw) + compressor.flush()
+    method = zipfile.ZIP_DEFLATED
+    if len(data) >= len(raw):
+        method, data = zipfile.ZIP_STORED, raw
+    return arcname.encode("utf-8"), method, zlib.crc32(raw), len(raw), data
+
+
+def _write_zip(outf, members, comment):
+    """Writes a zip archive of precompressed members, with fixed metadata."""
+    central = []
+    offset = 0
+    for name, method, crc, size, data in members:
+        fields = (ZIP_VERSION, 0x800, method, ZIP_DOS_TIME, ZIP_DOS_DATE)
+        fields += (crc, len(data), size, len(name))
+        header = struct.pack("<4s5H3L2H", b"PK\x03\x04", *fields, 0)
+        outf.write(header + name)
+        outf.write(data)
+        central.append(
+            struct.pack(
+                "<4s6H3L5H2L",
+                b"PK\x01\x02",
+                ZIP_CREATE_VERSION,
+                *fields,
+                0,
+                0,
+                0,
+                0,
+                ZIP_EXTERNAL_ATTR,
+                offset,
+            )
+            + name
+        )
+        offset += len(header) + len(name) + len(data)
+    directory = b"".join(central)
+    if offset + len(directory) > 0xFFFFFFFF or len(members) > 0xFFFF:
+        raise ValueError("Archive too large for zip without zip64")
+    outf.write(directory)
+    outf.write(
+        struct.pack(
+            "<4s4H2LH",
+            b"PK\x05\x06",
+            0,
+            0,
+            len(members),
+            len(members),
+            len(directory),
+            offset,
+            len(comment),
+        )
+        + comment
+    )
 
 
-def generate_viverseviewer_bytes(project_root):
+def generate_viverseviewer_bytes(project_root, jobs=None):
     """
     Zip ViverseViewer/ directory to Assets/Resources/ViverseViewer.bytes
 
+    The archive is reproducible: entries are sorted and carry fixed metadata.
+    The archive comment records a digest of the source tree, and the archive is
+    left alone if the digest still matches.
+
     Args:
         project_root: Path to project root directory
+        jobs: Number of compression threads (default: one per CPU)
 
     Raises:
         FileNotFoundError: If ViverseViewer source directory doesn't exist
@@ -47,30 +157,34 @@ def generate_viverseviewer_bytes(project_root):
     if not os.path.isdir(viewer_src):
         raise ValueError(f"ViverseViewer path is not a directory: {viewer_src}")
 
+    sources = _iter_source_files(viewer_src)
+    digest = _source_digest(sources)
+    if _existing_digest(viewer_dest) == digest:
+        print(f"{viewer_dest} is up to date")
+        return
+
     # Ensure Resources directory exists
     os.makedirs(os.path.dirname(viewer_dest), exist_ok=True)
 
     # Create zip
     print(f"Generating {viewer_dest} from {viewer_src}")
 
+    tmp_dest = viewer_dest + ".tmp"
     try:
-        with zipfile.ZipFile(viewer_dest, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for dirpath, _, files in os.walk(viewer_src):
-                for file_name in files:
-                    file_path = os.path.join(dirpath, file_name)
-                    # Get path relative to ViverseViewer/ directory
-                    arcname = os.path.relpath(file_path, viewer_src)
-                    # Normalize to forward slashes for cross-platform compatibility
-                    arcname = arcname.replace("\\", "/")
-                    zipf.write(file_path, arcname)
+        # zlib releases the GIL, so threads compress in parallel
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            members = list(pool.map(lambda src: _compress_member(*src), sources))
+        with open(tmp_dest, "wb") as outf:
+            _write_zip(outf, members, digest.encode("ascii"))
+        os.replace(tmp_dest, viewer_dest)
 
         file_size_mb = os.path.getsize(viewer_dest) / (1024 * 1024)
         print(f"Successfully generated ViverseViewer.bytes ({file_size_mb:.2f} MB)")
 
     except Exception as e:
         # Clean up partial file if creation failed
-        if os.path.exists(viewer_dest):
-            os.unlink(viewer_dest)
+        if os.path.exists(tmp_dest):
+            os.unlink(tmp_dest)
         raise Exception(f"Failed to generate ViverseViewer.bytes: {e}") from e
 
 
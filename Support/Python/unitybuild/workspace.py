@@ -0,0 +1,134 @@
+# Copyright 2020 The Tilt Brush Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cheap private copies of the Unity project, so that builds can run in parallel.
+
+Unity locks its project directory and keeps per-project state in Library/,
+so two Unity processes can't build from the same checkout. A workspace is a
+sibling tree that shares file data with the real project where the
+filesystem supports copy-on-write clones (FICLONE), and copies it otherwise:
+
+  Assets/, Support/, Packages/, ProjectSettings/
+                             cloned or copied; re-synced every time
+  Library/                   cloned once, then owned by the workspace, so it
+                             stays warm across runs
+
+Files are never hard-linked: Unity (eg AssetDatabase.SaveAssets()) and the
+build scripts rewrite some of these files in place, and through a hard link
+that would change the real project and every other workspace.
+
+Workspaces are synced incrementally; only files that changed in the real
+project are re-copied."""
+
+import os
+import shutil
+import sys
+
+# (directory, mode)
+#   copy  - clone or copy; re-synced every time
+#   seed  - clone or copy if missing, then left alone
+WORKSPACE_DIRS = (
+    ("Assets", "copy"),
+    ("Support", "copy"),
+    ("Packages", "copy"),
+    ("ProjectSettings", "copy"),
+    ("Library", "seed"),
+)
+
+# From <linux/fs.h>
+FICLONE = 0x40049409
+
+
+def _clone_or_copy(src, dst):
+    """Copies src to dst, sharing data blocks if the filesystem supports it."""
+    if sys.platform.startswith("linux"):
+        import fcntl  # pylint: disable=import-outside-toplevel
+
+        try:
+            with open(src, "rb") as inf, open(dst, "wb") as outf:
+                fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        _clone_or_copy(src, dst)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def mirror_tree(src, dst, link=False):
+    """Makes dst a mirror of src. Files are hard-linked if link is True, and
+    otherwise cloned or copied. Returns the number of files updated."""
+    updated = 0
+    for r, ds, fs in os.walk(src):
+        rel = os.path.relpath(r, src)
+        dst_r = os.path.normpath(os.path.join(dst, rel))
+        if not os.path.isdir(dst_r):
+            os.makedirs(dst_r)
+        wanted = set(ds) | set(fs)
+        for name in os.listdir(dst_r):
+            if name not in wanted:
+                _remove(os.path.join(dst_r, name))
+        for f in fs:
+            src_f = os.path.join(r, f)
+            dst_f = os.path.join(dst_r, f)
+            src_st = os.stat(src_f)
+            try:
+                dst_st = os.stat(dst_f)
+            except OSError:
+                dst_st = None
+            if dst_st is not None:
+                same_file = (src_st.st_ino, src_st.st_dev) == (
+                    dst_st.st_ino,
+                    dst_st.st_dev,
+                )
+                if link and same_file:
+                    continue
+                # A copy must not share the inode; older workspaces used hard links
+                if not same_file and (src_st.st_size, src_st.st_mtime_ns) == (
+                    dst_st.st_size,
+                    dst_st.st_mtime_ns,
+                ):
+                    continue
+                os.unlink(dst_f)
+            if link:
+                _link_or_copy(src_f, dst_f)
+            else:
+                _clone_or_copy(src_f, dst_f)
+            updated += 1
+    return updated
+
+
+def sync_workspace(project_dir, workspace_dir):
+    """Creates or updates a workspace for project_dir. Returns workspace_dir."""
+    for dirname, mode in WORKSPACE_DIRS:
+        src = os.path.join(project_dir, dirname)
+        dst = os.path.join(workspace_dir, dirname)
+        if not os.path.isdir(src):
+            continue
+        if mode == "copy" or not os.path.isdir(dst):
+            mirror_tree(src, dst)
+    return workspace_dir
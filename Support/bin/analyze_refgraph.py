@@ -19,14 +19,15 @@ import os
 import re
 import sys
 
-import networkx as nx  # pylint: disable=import-error
-
 # Add ../Python to sys.path
 sys.path.append(
     os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Python")
 )
 
 import unitybuild.refgraph  # noqa: E402 pylint: disable=import-error,wrong-import-position
+from unitybuild.csrgraph import (  # noqa: E402 pylint: disable=import-error,wrong-import-position
+    NoPath,
+)
 
 
 def find_project_dir(start=None):
@@ -60,6 +61,13 @@ def main(args):
         default=False,
         help="Recreate the cached graph and DummyCommandRefs.cs",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="Number of processes to use when scanning assets (default: one per cpu)",
+    )
     grp = parser.add_argument_group("Graph queries")
     grp.add_argument(
         "--shortest-path",
@@ -72,18 +80,88 @@ def main(args):
     grp.add_argument(
         "--successors", action="store_true", help="Show outgoing references from ASSET"
     )
+    grp.add_argument(
+        "--dominators",
+        action="store_true",
+        help="Show the assets that every path from Main.unity to ASSET goes through",
+    )
     grp.add_argument(
         "--all",
         action="store_true",
         help="If asset argument is ambiguous, show all matches",
     )
     grp.add_argument("asset", nargs="*", help="Asset(s) to examine")
+    grp = parser.add_argument_group("Whole-graph analysis")
+    grp.add_argument(
+        "--unused",
+        action="store_true",
+        help="List assets that are not reachable from Main.unity, largest first. "
+        "Only guid references are followed, so scripts and assets under Resources/ "
+        "or StreamingAssets/ (which are used from code or loaded by path) are left "
+        "out; see --include-untracked",
+    )
+    grp.add_argument(
+        "--include-untracked",
+        action="store_true",
+        help="With --unused, also list unreachable scripts and Resources/ or "
+        "StreamingAssets/ assets, in a separate section. Many of them are in use.",
+    )
+    grp.add_argument(
+        "--retained",
+        metavar="N",
+        type=int,
+        default=0,
+        help="List the N reachable assets that keep the most bytes reachable "
+        "(other than the root and the scenes and prefabs it references directly)",
+    )
     args = parser.parse_args(args)
-    if not (args.shortest_path or args.predecessors or args.successors):
-        args.shortest_path = True
-
-    rg = unitybuild.refgraph.ReferenceGraph(find_project_dir(), args.recreate)
-    root = rg.name_to_guid["ROOT"]
+    whole_graph = args.unused or args.retained > 0
+    if not (
+        args.shortest_path or args.predecessors or args.successors or args.dominators
+    ):
+        args.shortest_path = not whole_graph
+
+    rg = unitybuild.refgraph.ReferenceGraph(
+        find_project_dir(), args.recreate, jobs=args.jobs
+    )
+    # One BFS from the root answers every shortest-path query
+    reach = unitybuild.refgraph.Reachability(rg)
+
+    if args.unused:
+        # Editor assets never make it into a build
+        editor_pat = re.compile(r"/Editor/")
+        not_tracked = []
+        total = 0
+        print("=== Unreachable assets")
+        for size, name in reach.iter_unreachable_assets(editor_pat):
+            if unitybuild.refgraph.NOT_TRACKED_BY_GUID_PAT.search(name):
+                not_tracked.append((size, name))
+                continue
+            total += size
+            print("%10d %s" % (size, name))
+        print("%10d total" % total)
+        if args.include_untracked:
+            print(
+                "\n=== Unreachable by guid, but possibly used from code or loaded by path"
+            )
+            for size, name in not_tracked:
+                print("%10d %s" % (size, name))
+        else:
+            print(
+                "(%d scripts and Resources/ or StreamingAssets/ assets are not tracked "
+                "by guid and were left out; see --include-untracked)" % len(not_tracked)
+            )
+
+    if args.retained > 0:
+        retained = reach.retained_sizes()
+        # The root and its direct children (the scenes and environment prefabs)
+        # retain nearly everything, which says nothing
+        retained[reach.dist <= 1] = 0
+        print("=== Reachable assets, by bytes that only they keep reachable")
+        for i in retained.argsort()[::-1][: args.retained].tolist():
+            if retained[i] == 0:
+                break
+            print("%10d %s" % (retained[i], rg.g.names[i] or rg.g.keys[i]))
 
     def lookup_guids(asset):
         """Returns a list of guids"""
@@ -106,7 +184,7 @@ def main(args):
         return [rg.name_to_guid.get(p) for p in possibilities]
 
     def iter_desired_guids():
-        if len(args.asset) == 0 and not args.recreate:
+        if len(args.asset) == 0 and not (args.recreate or whole_graph):
             parser.error("Too few arguments")
         for asset in args.asset:
             try:
@@ -122,11 +200,19 @@ def main(args):
         if args.shortest_path:
             print("\n=== %s (shortest path)" % name)
             try:
-                path = nx.shortest_path(rg.g, source=root, target=guid)
+                path = reach.shortest_path(guid)
                 path.reverse()
                 for elt in path[:-1]:
                     print(" ", elt, rg.guid_to_name.get(elt, elt))
-            except nx.exception.NetworkXNoPath:
+            except (NoPath, KeyError):
+                print("  (no path)")
+
+        if args.dominators:
+            print("\n=== %s (dominators)" % name)
+            try:
+                for elt in reach.dominators(guid):
+                    print(" ", elt, rg.guid_to_name.get(elt, elt))
+            except (NoPath, KeyError):
                 print("  (no path)")
 
         if args.predecessors or args.successors:
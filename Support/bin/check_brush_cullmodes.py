@@ -20,7 +20,7 @@ geometry and also use double-sided (ie, non-culling) shaders.
 
 Also useful as sample code for working with the refgraph."""
 
-import collections
+import concurrent.futures
 import os
 import re
 import sys
@@ -34,87 +34,78 @@ import unitybuild.refgraph  # noqa: E402 pylint: disable=import-error,wrong-impo
 
 BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
 
+CULL_PAT = re.compile(r"cull\s+(\w+)", re.I | re.M)
+BACKFACES_PAT = re.compile(r"m_RenderBackfaces: (.)")
 
-def dfs_iter(graph, guid):
-    """graph: networkx.DiGraph
-    guid: node name"""
-    seen = set()
-    q = collections.deque()
-    q.append(guid)
-    while q:
-        elt = q.pop()
-        seen.add(elt)
-        yield elt
-        q.extend(succ for succ in graph.successors_iter(elt) if succ not in seen)
-
-
-def shaders_for_brush(rg, g_brush):
-    """rg: unitybuild.refgraph.ReferenceGraph
-    g_brush: node (brush guid)
-    yields nodes for shaders."""
-    for g in dfs_iter(rg.g, g_brush):
-        try:
-            n = rg.guid_to_name[g]
-        except KeyError:
-            continue
-        if n.lower().endswith(".shader"):
-            yield g
-
-
-def cullmodes_for_brush(rg, g_brush):
-    """rg: unitybuild.refgraph.ReferenceGraph
-    g_brush: node (brush guid)
-    Returns list of culling modes used by shaders for that brush."""
-    modes = set()
-    for g_shader in shaders_for_brush(rg, g_brush):
-        for mode in cullmodes_for_shader(rg.guid_to_name[g_shader]):
-            modes.add(mode)
-    return sorted(modes, key=lambda m: m.lower)
-
-
-def cullmodes_for_shader(shader, memo=None):
+
+def _read(name):
+    with open(os.path.join(BASE, name)) as f:
+        return f.read()
+
+
+def cullmodes_for_shader(shader):
     """shader: name of shader asset
     Returns list of culling modes used by the shader."""
-    # This is to replace a risky default value, but it looks like this needed a parameter from the caller, or, failing that, a global. FIXME
-    if memo is None:
-        memo = {}
-    try:
-        return memo[shader]
-    except KeyError:
-        pass
-    with open(os.path.join(BASE, shader)) as f:
-        txt = f.read()
-    culls = [m.group(1) for m in re.finditer(r"cull\s+(\w+)", txt, re.I | re.M)]
-    memo[shader] = culls
-    return culls
-
-
-def is_brush_doublesided(rg, g_brush):
-    """rg: unitybuild.refgraph.ReferenceGraph
-    g_brush: node (brush guid)
-    Returns True if brush generates doublesided geometry."""
-    filename = rg.guid_to_name[g_brush]
-    with open(os.path.join(BASE, filename)) as f:
-        txt = f.read()
-    return int(re.search(r"m_RenderBackfaces: (.)", txt).group(1))
+    return [m.group(1) for m in CULL_PAT.finditer(_read(shader))]
+
+
+def is_brush_doublesided(brush):
+    """brush: name of brush asset
+    Returns True if brush generates doublesided geometry; False if it does not,
+    or if the asset is not a brush descriptor."""
+    m = BACKFACES_PAT.search(_read(brush))
+    return m is not None and bool(int(m.group(1)))
+
+
+class CullAudit:
+    """Finds the shaders used by every brush, and their culling modes.
+    Reachability for all brushes is computed in a single pass over the
+    graph, and every shader and brush asset is read once, in parallel.
+    .brushes       sorted list of brush names
+    .shaders       dict mapping brush name -> sorted list of shader names
+    .cullmodes     dict mapping shader name -> list of culling modes
+    .doublesided   dict mapping brush name -> bool"""
+
+    def __init__(self, rg, jobs=None):
+        g = rg.g
+        brush_ids = [i for i, n in enumerate(g.names) if re.search(r"Brush.*asset$", n)]
+        shader_ids = [i for i, n in enumerate(g.names) if n.lower().endswith(".shader")]
+        masks = g.reachable_targets(shader_ids)
+
+        self.brushes = sorted(g.names[i] for i in brush_ids)
+        self.shaders = {}
+        for i in brush_ids:
+            mask = masks[i]
+            self.shaders[g.names[i]] = sorted(
+                g.names[s] for k, s in enumerate(shader_ids) if mask >> k & 1
+            )
+        used = sorted(set(s for ss in self.shaders.values() for s in ss))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            self.cullmodes = dict(zip(used, pool.map(cullmodes_for_shader, used)))
+            self.doublesided = dict(
+                zip(self.brushes, pool.map(is_brush_doublesided, self.brushes))
+            )
+
+    def cullmodes_for_brush(self, brush):
+        """Returns sorted list of culling modes used by shaders for brush."""
+        modes = set()
+        for shader in self.shaders[brush]:
+            modes.update(self.cullmodes[shader])
+        return sorted(modes, key=str.lower)
+
+    def iter_mismatches(self):
+        """Yields (brush, cullmodes) for each brush that generates double-sided
+        geometry but uses shaders that set a culling mode."""
+        for brush in self.brushes:
+            culls = self.cullmodes_for_brush(brush)
+            if len(culls) > 0 and self.doublesided[brush]:
+                yield brush, culls
 
 
 def main():
     rg = unitybuild.refgraph.ReferenceGraph(BASE)
-    g2n = rg.guid_to_name
-
-    def is_brush(guid):
-        try:
-            name = g2n[guid]
-        except KeyError:
-            return False
-        return re.search(r"Brush.*asset$", name) is not None
-
-    brushes = [node for node in rg.g.nodes_iter() if is_brush(node)]
-    for g_brush in sorted(brushes, key=g2n.get):
-        culls = cullmodes_for_brush(rg, g_brush)
-        if len(culls) > 0 and is_brush_doublesided(rg, g_brush):
-            print("Brush %s\n is double-sided but has cull %s" % (g2n[g_brush], culls))
+    for brush, culls in CullAudit(rg).iter_mismatches():
+        print("Brush %s\n is double-sided but has cull %s" % (brush, culls))
 
 
 if __name__ == "__main__":
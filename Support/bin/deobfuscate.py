@@ -14,17 +14,168 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import hashlib
 import itertools
 import os
+import pickle
 import re
+import sqlite3
 import sys
+import time
 import argparse
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from subprocess import Popen, PIPE
 
 # Common 11-letter words that shouldn't be interpreted as obfuscated symbols
 COMMON_WORDS_11 = set(["initializer"])
+# Bump this if parsing changes, to discard indexed maps
+INDEX_VERSION = 1
+
+OBFUSCATED_PAT = re.compile(r"\b[a-z]{11}\b")
+FRAME_PAT = re.compile(r"( (?P<name>[A-Za-z0-9_:.+`<>\[\]]+) ?(?P<args>\([^)]*\)))$")
+# Non-useful stuff like "(at <hexhexhex>:0)" and
+# "[0x00016] in <d2957de1c3fd4781a43d89572183136c>:0"
+IGNORE_PAT = re.compile(r" \(at <[a-f0-9]+>:\d+\)$")
+IGNORE_PAT2 = re.compile(r" \[0x[0-9a-f]+\] in <[a-f0-9]+>:\d+ *$")
+EXCEPTION_PAT = re.compile(r"^\t?(\d+\.\t)?(?P<exc>[A-Za-z0-9]+Exception:)")
+# TiltBrush.<RunInCompositor>d__38:MoveNext()
+# Google.Apis.Requests.ClientServiceRequest`1+<ExecuteUnparsedAsync>d__30[TResponse].MoveNext ()
+COROUTINE_PAT = re.compile(
+    r"(?P<class>[a-zA-Z0-9_.`]+)[+.]<(?P<coroutine>[^>]+)>d_+\d+(?:\[[^\]]+\])?[:.]MoveNext"
+)
+# TiltBrush.DriveAccess+<<InitializeDriveLinkAsync>g__InitializeAsync|30_0>d.MoveNext ()
+COROUTINE_PAT2 = re.compile(
+    r"(?P<class>[a-zA-Z0-9_.`]+)[+.]<(?P<coroutine><[^>]+>[^>]+)>d_*\d*[:.]MoveNext"
+)
+# TiltBrush.SketchControlsScript+<>c.<ExportCoroutine>b__307_0()
+LAMBDA_PAT = re.compile(
+    r"(?P<prefix>[a-zA-Z0-9_.]+)\+<>c\.<(?P<owner>[a-zA-Z0-9_]+)>b__(?P<id>[0-9_]+)"
+)
+
+# Frames that go into a crash signature
+SIGNATURE_FRAMES = 5
+SIGNATURE_VERSION = 1
+ARGLIST_PAT = re.compile(r" ?\([^)]*\)$")
+# Source locations, which move from build to build: " (at Assets/Scripts/Foo.cs:12)"
+LOCATION_PAT = re.compile(r" \(at [^)]*\)$")
+EXCEPTION_TYPE_PAT = re.compile(r"^(?:Rethrow as )?(?P<type>[A-Za-z0-9_.`+]+):")
+
+
+def _list_to_pat(lst):
+    """Returns a pattern that matches any of the items in lst"""
+    return "(?:" + "|".join([re.escape(i) for i in lst]) + ")"
+
+
+# Uninteresting stack frames that have to do with the C# async machinery.
+# Sometimes the stack dump has "  at " in it, sometimes not. I think it has to do with
+# whether you're running in editor or not?
+TASK_EXECUTE_PAT = re.compile(
+    r"^(?:  at )?"
+    + _list_to_pat(
+        [
+            "System.Threading.Tasks.Task`1[TResult].InnerInvoke",
+            "System.Threading.Tasks.Task.Execute",
+        ]
+    )
+)
+TASK_AWAIT_PAT = re.compile(
+    r"^(?:  at )?"
+    + _list_to_pat(
+        [
+            "System.Runtime.CompilerServices.TaskAwaiter.GetResult",
+            "System.Runtime.CompilerServices.TaskAwaiter`1[TResult].GetResult",
+            "System.Threading.Tasks.Task.Wait",
+        ]
+    )
+)
+TASK_THROW_PAT = re.compile(
+    r"^(?:  at )?"
+    + _list_to_pat(
+        [
+            "System.Threading.Tasks.Task.ThrowIfExceptional",
+            "System.Runtime.ExceptionServices.ExceptionDispatchInfo.Throw",
+            "System.Runtime.CompilerServices.TaskAwaiter.ThrowForNonSuccess",
+            "System.Runtime.CompilerServices.TaskAwaiter.HandleNonSuccessAndDebuggerNotification",
+            "System.Runtime.CompilerServices.TaskAwaiter.ValidateEnd",
+            "System.Runtime.CompilerServices.ConfiguredTaskAwaitable`1+ConfiguredTaskAwaiter[TResult].GetResult",
+            "System.Runtime.CompilerServices.AsyncMethodBuilderCore+<>c.<ThrowAsync>",
+            "System.Runtime.CompilerServices.AsyncMethodBuilderCore.ThrowAsync",
+            # '--- End of stack trace from previous location where exception was thrown ---',
+        ]
+    )
+)
+AWAIT_PAT = re.compile(
+    r"(<task exec>\n)*--- End of stack trace from previous location where exception was thrown ---\n(<task (throw|await)>\n)* ?"
+)
+
+
+def git_blob_sha(data):
+    """Returns the sha git would give a blob with contents data (bytes)."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class ObfuscationIndex:
+    """Persistent store of parsed obfuscation maps, keyed by git blob sha, so
+    each version of the map is only parsed once.
+    Each map is stored already merged across sections, with short forms of the
+    symbols precomputed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != INDEX_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS blobs;
+                DROP TABLE IF EXISTS symbols;
+                CREATE TABLE blobs (blob TEXT PRIMARY KEY, num_symbols INTEGER);
+                CREATE TABLE symbols (blob TEXT, ob TEXT, sym TEXT, short TEXT);
+                CREATE INDEX symbols_by_ob ON symbols (ob, blob);
+                PRAGMA user_version = %d;
+                """ % INDEX_VERSION)
+
+    def __getstate__(self):
+        # Connections can't be pickled, or shared with worker processes
+        return self.filename
+
+    def __setstate__(self, filename):
+        self.__init__(filename)
+
+    def num_symbols(self, blob):
+        """Returns the number of symbols in the indexed map, or None if the map
+        has not been indexed."""
+        row = self.db.execute(
+            "SELECT num_symbols FROM blobs WHERE blob = ?", (blob,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, blob, omap):
+        """Indexes the contents of an ObfuscationMap under blob."""
+        rows = set()
+        for _, section in sorted(omap.sections_by_name.items()):
+            for ob, syms in section.ob_to_syms.items():
+                rows.update(
+                    (blob, ob, sym, ObfuscationSection.shorten(sym)) for sym in syms
+                )
+        num_symbols = sum(len(s.sym_to_ob) for s in omap.sections_by_name.values())
+        with self.db:
+            self.db.execute("DELETE FROM symbols WHERE blob = ?", (blob,))
+            self.db.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?)", rows)
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?)", (blob, num_symbols)
+            )
+
+    def lookup(self, ob, blobs):
+        """Returns list of (symbol, short symbol) for ob in any of blobs."""
+        return self.db.execute(
+            "SELECT DISTINCT sym, short FROM symbols WHERE ob = ? AND blob IN (%s)"
+            % ",".join("?" * len(blobs)),
+            [ob] + list(blobs),
+        ).fetchall()
 
 
 class ObfuscationSection:
@@ -82,25 +233,89 @@ class ObfuscationSection:
 
 
 class ObfuscationMap:
-    def __init__(self):
+    def __init__(self, index=None):
+        """If index is an ObfuscationIndex, maps are parsed into it (if they
+        aren't there already) and looked up from it, rather than held in memory."""
         self.sections_by_name = {}
         # A dict that maps obfuscated symbol to a user-friendly, short symbol
         self.ob_to_syms = None
+        self.index = index
+        # Blob shas of the maps loaded through the index
+        self.blobs = []
+        # A dict that maps obfuscated symbol to its replacement in deobfuscated text
+        self.replacements = {}
 
     def is_empty(self):
-        return len(self.sections_by_name) == 0
+        return len(self.sections_by_name) == 0 and len(self.blobs) == 0
 
     def load_from_file(self, filename):
         """Additively loads entries from the given file.
         Returns True on success."""
         if os.path.exists(filename):
-            with open(filename) as f:
-                self._load_from_text(f.read())
+            with open(filename, "rb") as f:
+                data = f.read()
+            if self.index is None:
+                self._load_from_text(data)
+            else:
+                self._load_blob(git_blob_sha(data), lambda: data)
             return True
         return False
 
+    def _load_blob(self, blob, get_data):
+        """Loads the map with the given blob sha through the index, calling
+        get_data() for its contents only if it has not been indexed.
+        Returns the number of symbols in the map."""
+        num_symbols = self.index.num_symbols(blob)
+        if num_symbols is None:
+            parsed = ObfuscationMap()
+            parsed._load_from_text(get_data())  # pylint: disable=protected-access
+            self.index.add(blob, parsed)
+            num_symbols = self.index.num_symbols(blob)
+        if blob not in self.blobs:
+            self.blobs.append(blob)
+            self.replacements = {}
+        return num_symbols
+
+    def load_from_git_revs(self, git_objects):
+        """Additively load entries from several git objects.
+        With an index, resolves all of them with a single git call, and only
+        fetches the ones that haven't been indexed."""
+        if self.index is None:
+            for git_object in git_objects:
+                self.load_from_git_rev(git_object)
+            return
+        if not git_objects:
+            return
+        proc = Popen(
+            ["git", "cat-file", "--batch-check"], stdin=PIPE, stdout=PIPE, stderr=PIPE
+        )
+        stdout, _ = proc.communicate("".join(o + "\n" for o in git_objects).encode())
+        for git_object, line in zip(git_objects, stdout.decode().splitlines()):
+            fields = line.split()
+            if len(fields) != 3 or fields[1] != "blob":
+                print(
+                    "WARN: Couldn't load deobfuscation from '%s'\n%s"
+                    % (git_object, line),
+                    file=sys.stderr,
+                )
+                continue
+            n = self._load_blob(fields[0], lambda: self._cat_file(fields[0]))
+            if n > 0 and os.isatty(sys.stdout.fileno()):
+                print("Added %d symbols from '%s'" % (n, git_object))
+
+    @staticmethod
+    def _cat_file(git_object):
+        proc = Popen(["git", "cat-file", "-p", git_object], stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise LookupError("Couldn't read '%s'\n%s" % (git_object, stderr))
+        return stdout
+
     def load_from_git_rev(self, git_object):
         """Additively load entries from the given git object (eg HEAD:Assets/obfuscation_map.txt)"""
+        if self.index is not None:
+            self.load_from_git_revs([git_object])
+            return
         proc = Popen(["git", "cat-file", "-p", git_object], stdout=PIPE, stderr=PIPE)
         stdout, stderr = proc.communicate()
         if proc.returncode != 0:
@@ -131,6 +346,7 @@ class ObfuscationMap:
                     num_added += 1
         # Reset cache
         self.ob_to_syms = None
+        self.replacements = {}
         return num_added
 
     def _get_section(self, name):
@@ -148,49 +364,55 @@ class ObfuscationMap:
                 ob_to_syms[ob] |= syms
         self.ob_to_syms = dict(ob_to_syms)
 
-    def deobfuscate(self, text):
+    def _lookup(self, ob):
+        """Returns (symbols, short symbols) for ob. Raises KeyError if unknown."""
+        if self.index is not None:
+            rows = self.index.lookup(ob, self.blobs)
+            if not rows:
+                raise KeyError(ob)
+            return {sym for sym, _ in rows}, {short for _, short in rows}
         if self.ob_to_syms is None:
             self._create_ob_to_syms()
+        syms = self.ob_to_syms[ob]
+        return syms, {ObfuscationSection.shorten(s) for s in syms}
+
+    def _replacement(self, ob):
+        try:
+            syms, short_syms = self._lookup(ob)
+        except KeyError:
+            if ob in COMMON_WORDS_11:
+                return ob
+            return "<? %s ?>" % ob
+        if len(short_syms) == 1:
+            return short_syms.pop()
+        return "< " + " or ".join(sorted(syms)) + " >"
 
+    def deobfuscate(self, text):
         def lookup(match):
             ob = match.group(0)
             try:
-                syms = self.ob_to_syms[ob]
+                return self.replacements[ob]
             except KeyError:
-                if ob in COMMON_WORDS_11:
-                    return ob
-                return "<? %s ?>" % ob
-            short_syms = {ObfuscationSection.shorten(s) for s in syms}
-            if len(short_syms) == 1:
-                return short_syms.pop()
-            return "< " + " or ".join(sorted(syms)) + " >"
+                ret = self.replacements[ob] = self._replacement(ob)
+                return ret
 
-        pat = re.compile(r"\b[a-z]{11}\b")
-        return pat.sub(lookup, text)
+        return OBFUSCATED_PAT.sub(lookup, text)
 
 
 def get_client_root():
     proc = Popen(["git", "rev-parse", "--show-toplevel"], stdout=PIPE, stderr=PIPE)
     stdout, _ = proc.communicate()
     assert proc.returncode == 0, "Couldn't determine git client root"
-    return stdout.strip()
+    return stdout.decode().strip()
 
 
 def format_nicely(txt, verbose):
     lines = txt.split("\n")
     del txt
 
-    frame_pat = re.compile(
-        r"( (?P<name>[A-Za-z0-9_:.+`<>\[\]]+) ?(?P<args>\([^)]*\)))$"
-    )
-
     def remove_instruction_pointer(line):
-        ignore_pat = re.compile(r" \(at <[a-f0-9]+>:\d+\)$")
-        ignore_pat2 = re.compile(r" \[0x[0-9a-f]+\] in <[a-f0-9]+>:\d+ *$")
-        # Gets rid of non-useful stuff like "(at <hexhexhex>:0)" and
-        # "[0x00016] in <d2957de1c3fd4781a43d89572183136c>:0"
-        line = ignore_pat.sub("", line)
-        line = ignore_pat2.sub("", line)
+        line = IGNORE_PAT.sub("", line)
+        line = IGNORE_PAT2.sub("", line)
         return line
 
     lines = [remove_instruction_pointer(line) for line in lines]
@@ -198,16 +420,15 @@ def format_nicely(txt, verbose):
     # Exception lines have a stack frame stuck onto them; move those frames to the next line.
     # Also clean up tabs and other junk that comes in when you copy/paste from the analytics table.
     def move_trailing_stack_frame(line):
-        exception_pat = re.compile(r"^\t?(\d+\.\t)?(?P<exc>[A-Za-z0-9]+Exception:)")
         if line.startswith(" Rethrow as"):
             # Insert a newline before the stack frame
             line = line.replace(" Rethrow as", "\nRethrow as")
-            return frame_pat.sub(r"\n\1", line)
-        if exception_pat.match(line):
-            m = exception_pat.match(line)
+            return FRAME_PAT.sub(r"\n\1", line)
+        m = EXCEPTION_PAT.match(line)
+        if m:
             line = line[m.start("exc") :]
             # Insert a newline before the stack frame
-            return frame_pat.sub(r"\n\1", line)
+            return FRAME_PAT.sub(r"\n\1", line)
         return line
 
     lines = [move_trailing_stack_frame(line) for line in lines]
@@ -215,7 +436,7 @@ def format_nicely(txt, verbose):
     if not verbose:
 
         def remove_arglist(line):
-            m = frame_pat.match(line)
+            m = FRAME_PAT.match(line)
             if m is None:
                 return line
             name = m.group("name")
@@ -231,23 +452,12 @@ def format_nicely(txt, verbose):
         ]
 
         def demangle_coroutine(line):
-            # TiltBrush.<RunInCompositor>d__38:MoveNext()
-            # Google.Apis.Requests.ClientServiceRequest`1+<ExecuteUnparsedAsync>d__30[TResponse].MoveNext ()
             def repl(m):
                 return "[co] %(class)s.%(coroutine)s" % m.groupdict()
 
-            ret, n = re.subn(
-                r"(?P<class>[a-zA-Z0-9_.`]+)[+.]<(?P<coroutine>[^>]+)>d_+\d+(?:\[[^\]]+\])?[:.]MoveNext",
-                repl,
-                line,
-            )
+            ret, n = COROUTINE_PAT.subn(repl, line)
             if n == 0:
-                # TiltBrush.DriveAccess+<<InitializeDriveLinkAsync>g__InitializeAsync|30_0>d.MoveNext ()
-                ret, n = re.subn(
-                    r"(?P<class>[a-zA-Z0-9_.`]+)[+.]<(?P<coroutine><[^>]+>[^>]+)>d_*\d*[:.]MoveNext",
-                    repl,
-                    line,
-                )
+                ret, n = COROUTINE_PAT2.subn(repl, line)
             return ret
 
         lines = [demangle_coroutine(line) for line in lines]
@@ -255,15 +465,10 @@ def format_nicely(txt, verbose):
         lines = elide_async_frames(lines)
 
         def demangle_lambda(line):
-            # TiltBrush.SketchControlsScript+<>c.<ExportCoroutine>b__307_0()
             def repl(m):
                 return "%(prefix)s.%(owner)s.[lambda %(id)s]" % m.groupdict()
 
-            return re.sub(
-                r"(?P<prefix>[a-zA-Z0-9_.]+)\+<>c\.<(?P<owner>[a-zA-Z0-9_]+)>b__(?P<id>[0-9_]+)",
-                repl,
-                line,
-            )
+            return LAMBDA_PAT.sub(repl, line)
 
         lines = [demangle_lambda(line) for line in lines]
 
@@ -271,68 +476,223 @@ def format_nicely(txt, verbose):
 
 
 def elide_async_frames(lines):
-    def list_to_pat(lst):
-        """Returns a pattern that matches any of the items in lst"""
-        return "(?:" + "|".join([re.escape(i) for i in lst]) + ")"
-
     # Gets rid of uninteresting stack frames that have to do with the C# async machinery,
     # to show more clearly the frames that are awaiting each other.
-    # Sometimes the stack dump has "  at " in it, sometimes not. I think it has to do with
-    # whether you're running in editor or not?
-    task_execute_pat = re.compile(
-        r"^(?:  at )?"
-        + list_to_pat(
-            [
-                "System.Threading.Tasks.Task`1[TResult].InnerInvoke",
-                "System.Threading.Tasks.Task.Execute",
-            ]
-        )
-    )
-    task_await_pat = re.compile(
-        r"^(?:  at )?"
-        + list_to_pat(
-            [
-                "System.Runtime.CompilerServices.TaskAwaiter.GetResult",
-                "System.Runtime.CompilerServices.TaskAwaiter`1[TResult].GetResult",
-                "System.Threading.Tasks.Task.Wait",
-            ]
-        )
-    )
-    task_throw_pat = re.compile(
-        r"^(?:  at )?"
-        + list_to_pat(
-            [
-                "System.Threading.Tasks.Task.ThrowIfExceptional",
-                "System.Runtime.ExceptionServices.ExceptionDispatchInfo.Throw",
-                "System.Runtime.CompilerServices.TaskAwaiter.ThrowForNonSuccess",
-                "System.Runtime.CompilerServices.TaskAwaiter.HandleNonSuccessAndDebuggerNotification",
-                "System.Runtime.CompilerServices.TaskAwaiter.ValidateEnd",
-                "System.Runtime.CompilerServices.ConfiguredTaskAwaitable`1+ConfiguredTaskAwaiter[TResult].GetResult",
-                "System.Runtime.CompilerServices.AsyncMethodBuilderCore+<>c.<ThrowAsync>",
-                "System.Runtime.CompilerServices.AsyncMethodBuilderCore.ThrowAsync",
-                # '--- End of stack trace from previous location where exception was thrown ---',
-            ]
-        )
-    )
-
     def elide_frame(line):
-        if task_execute_pat.match(line):
+        if TASK_EXECUTE_PAT.match(line):
             return "<task exec>"
-        if task_throw_pat.match(line):
+        if TASK_THROW_PAT.match(line):
             return "<task throw>"
-        if task_await_pat.match(line):
+        if TASK_AWAIT_PAT.match(line):
             return "<task await>"
         return line
 
     txt = "\n".join([elide_frame(line) for line in lines])
-    txt = re.sub(
-        r"(<task exec>\n)*--- End of stack trace from previous location where exception was thrown ---\n(<task (throw|await)>\n)* ?",
-        "  [await]",
-        txt,
-    )
+    txt = AWAIT_PAT.sub("  [await]", txt)
     return txt.split("\n")
 
 
+def iter_input_files(inputs):
+    """Yields the files in inputs, expanding directories (recursively, in sorted order)."""
+    for path in inputs:
+        if os.path.isdir(path):
+            for r, ds, fs in os.walk(path):
+                ds.sort()
+                for f in sorted(fs):
+                    yield os.path.join(r, f)
+        else:
+            yield path
+
+
+def iter_stacks(lines):
+    """Splits lines into crash reports. A report ends at a blank line, or where
+    the next one starts with an exception line. Yields each report as text."""
+    stack = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            if stack:
+                yield "\n".join(stack)
+                stack = []
+            continue
+        if stack and EXCEPTION_PAT.match(line):
+            yield "\n".join(stack)
+            stack = []
+        stack.append(line)
+    if stack:
+        yield "\n".join(stack)
+
+
+# Set in each worker process by _init_worker
+_worker_map = None
+
+
+def _init_worker(pickled_map):
+    global _worker_map  # pylint: disable=global-statement
+    _worker_map = pickle.loads(pickled_map)
+
+
+def count_signatures(filename, verbose=False, omap=None):
+    """Returns a Counter mapping deobfuscated, formatted stack -> occurrences,
+    for the crash reports in filename. Identical reports are only processed once."""
+    if omap is None:
+        omap = _worker_map
+    with open(filename, encoding="ascii", errors="ignore") as inf:
+        raw = Counter(iter_stacks(inf))
+    signatures = Counter()
+    for stack, count in raw.items():
+        signatures[format_nicely(omap.deobfuscate(stack), verbose)] += count
+    return signatures
+
+
+def count_all_signatures(omap, filenames, verbose=False, jobs=None):
+    """Returns a Counter of stack signatures across all of filenames, processing
+    files in parallel."""
+    total = Counter()
+    # Pickled explicitly, so workers reopen the index rather than inherit a connection
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(pickle.dumps(omap),)
+    ) as pool:
+        for signatures in pool.map(
+            count_signatures, filenames, itertools.repeat(verbose)
+        ):
+            total.update(signatures)
+    return total
+
+
+def write_signature_report(signatures, outf):
+    """Writes stack signatures, most frequent first."""
+    num_stacks = sum(signatures.values())
+    outf.write(
+        "%d crash reports, %d distinct signatures\n" % (num_stacks, len(signatures))
+    )
+    # Ties are broken by the text, so the report is stable
+    for stack, count in sorted(signatures.items(), key=lambda kv: (-kv[1], kv[0])):
+        outf.write(
+            "\n=== %d (%.1f%%) ===\n%s\n" % (count, 100.0 * count / num_stacks, stack)
+        )
+
+
+def crash_signature(stack, num_frames=SIGNATURE_FRAMES):
+    """Returns (signature, title) for a stack as returned by format_nicely().
+    The signature hashes the exception types and the top num_frames frames,
+    without argument lists, instruction pointers or source locations, so reports
+    of the same crash from different builds or with different messages share it.
+
+    Both stack formats are understood; frames are indented in .NET's
+      NullReferenceException: Object reference not set to an instance of an object
+        at TiltBrush.SketchControlsScript.Update () [0x00016] in <d2957de1...>:0
+    but not in Unity's
+      NullReferenceException: Object reference not set to an instance of an object
+      TiltBrush.SketchControlsScript.Update () (at <d2957de1...>:0)
+    so a line is only taken as an exception header if it looks like one."""
+    exceptions = []
+    frames = []
+    for line in stack.split("\n"):
+        if not line.strip() or line.startswith("<task") or line.startswith("---"):
+            continue
+        m = EXCEPTION_TYPE_PAT.match(line)
+        if m and (
+            line.startswith("Rethrow as ") or m.group("type").endswith("Exception")
+        ):
+            exceptions.append(m.group("type"))
+            continue
+        if len(frames) >= num_frames:
+            continue
+        frame = IGNORE_PAT2.sub("", IGNORE_PAT.sub("", line)).strip()
+        frame = LOCATION_PAT.sub("", frame)
+        if frame.startswith("[await]"):
+            frame = frame[len("[await]") :].strip()
+        if frame.startswith("at "):
+            frame = frame[len("at ") :]
+        frames.append(ARGLIST_PAT.sub("", frame))
+    key = "\n".join([",".join(exceptions)] + frames)
+    signature = hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+    title = "%s at %s" % (
+        exceptions[0] if exceptions else "?",
+        frames[0] if frames else "?",
+    )
+    return signature, title
+
+
+class SignatureIndex:
+    """On-disk record of the crash signatures seen in each build.
+    Observations are only ever appended; queries aggregate them."""
+
+    def __init__(self, filename):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version == 0:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS signatures (
+                    signature TEXT PRIMARY KEY, title TEXT, stack TEXT);
+                CREATE TABLE IF NOT EXISTS observations (
+                    signature TEXT, build TEXT, count INTEGER, seen REAL);
+                CREATE INDEX IF NOT EXISTS observations_by_build
+                    ON observations (build, signature);
+                PRAGMA user_version = %d;
+                """ % SIGNATURE_VERSION)
+        elif version != SIGNATURE_VERSION:
+            raise ValueError(
+                "%s has signature version %d, not %d"
+                % (filename, version, SIGNATURE_VERSION)
+            )
+
+    def record(self, stacks, build, seen=None):
+        """Records a Counter of formatted stack -> occurrences seen in build.
+        Returns a Counter of signature -> occurrences."""
+        if seen is None:
+            seen = time.time()
+        counts = Counter()
+        examples = {}
+        for stack, count in stacks.items():
+            signature, title = crash_signature(stack)
+            counts[signature] += count
+            examples.setdefault(signature, (title, stack))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO signatures VALUES (?, ?, ?)",
+                [(sig, title, stack) for sig, (title, stack) in examples.items()],
+            )
+            self.db.executemany(
+                "INSERT INTO observations VALUES (?, ?, ?, ?)",
+                [(sig, build, count, seen) for sig, count in counts.items()],
+            )
+        return counts
+
+    def top(self, build=None, limit=20):
+        """Returns list of (signature, title, count, first_seen, last_seen) for the
+        most frequent signatures in build (or in all builds if None)."""
+        where, params = ("", []) if build is None else ("WHERE o.build = ?", [build])
+        return self.db.execute(
+            "SELECT o.signature, s.title, SUM(o.count), MIN(o.seen), MAX(o.seen) "
+            "FROM observations o JOIN signatures s ON s.signature = o.signature "
+            "%s GROUP BY o.signature ORDER BY SUM(o.count) DESC, o.signature "
+            "LIMIT ?" % where,
+            params + [limit],
+        ).fetchall()
+
+    def stack(self, signature):
+        """Returns an example stack for signature, or None."""
+        row = self.db.execute(
+            "SELECT stack FROM signatures WHERE signature = ?", (signature,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+
+def write_top_report(rows, outf):
+    def fmt(t):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(t))
+
+    for signature, title, count, first_seen, last_seen in rows:
+        outf.write(
+            "%8d  %s  %s .. %s  %s\n"
+            % (count, signature, fmt(first_seen), fmt(last_seen), title)
+        )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -361,16 +721,98 @@ def main():
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Do not elide any information"
     )
+    parser.add_argument(
+        "--index",
+        default="Library/obfuscation_index.sqlite",
+        help="Path of the parsed-map index relative to client root (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Parse all maps from scratch instead of using the index",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="Files or directories of crash reports to process in bulk, producing "
+        "a report of distinct crash signatures. If none, reads a stack from stdin.",
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write the signature report here instead of stdout"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes for bulk mode (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--signatures",
+        metavar="FILE",
+        help="Crash signature history, required by --record, --top and --show. "
+        "It can't be regenerated, so keep it somewhere safe: not in Library/, "
+        "which is routinely deleted, nor in the client.",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="BUILD",
+        help="In bulk mode, add the crash signatures to the index under this build stamp",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        metavar="N",
+        help="Print the N most frequent crash signatures in the index and exit",
+    )
+    parser.add_argument(
+        "--build",
+        help="With --top, only count crashes from this build stamp",
+    )
+    parser.add_argument(
+        "--show",
+        metavar="SIGNATURE",
+        help="Print an example stack for a crash signature and exit",
+    )
     args = parser.parse_args()
+    # Resolve inputs before changing directory
+    inputs = [os.path.abspath(p) for p in args.inputs]
+    output = os.path.abspath(args.output) if args.output else None
+    signatures_file = None
+    if args.record is not None or args.top is not None or args.show is not None:
+        if args.signatures is None:
+            parser.error("--record, --top and --show need --signatures FILE")
+        signatures_file = os.path.abspath(args.signatures)
 
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
-    map_file = os.path.join(get_client_root(), args.map_file)
-    omap = ObfuscationMap()
+    client_root = get_client_root()
+    if args.top is not None or args.show is not None:
+        sig_index = SignatureIndex(signatures_file)
+        if args.top is not None:
+            write_top_report(sig_index.top(args.build, args.top), sys.stdout)
+        if args.show is not None:
+            stack = sig_index.stack(args.show)
+            if stack is None:
+                parser.error("Unknown signature %s" % args.show)
+            print(stack)
+        return
+    if args.record is not None and not inputs:
+        parser.error("--record needs files or directories of crash reports")
+
+    map_file = os.path.join(client_root, args.map_file)
+    index = None
+    if not args.no_index:
+        index = ObfuscationIndex(os.path.join(client_root, args.index))
+    omap = ObfuscationMap(index)
     omap.load_from_file(map_file)
     # Assumes that the remote is called "origin", but that's typically the case
     args.releases = ["origin/release/" + s for s in args.releases]
-    for branch in itertools.chain(args.releases, args.branches):
-        omap.load_from_git_rev("%s:%s" % (branch, args.map_file))
+    omap.load_from_git_revs(
+        [
+            "%s:%s" % (branch, args.map_file)
+            for branch in itertools.chain(args.releases, args.branches)
+        ]
+    )
     sys.stdout.flush()
 
     if omap.is_empty():
@@ -378,9 +820,27 @@ def main():
             "No symbols loaded. Do you need to pass '--release' or '--branch'?"
         )
 
+    if inputs:
+        signatures = count_all_signatures(
+            omap, list(iter_input_files(inputs)), args.verbose, args.jobs
+        )
+        if args.record is not None:
+            counts = SignatureIndex(signatures_file).record(signatures, args.record)
+            print(
+                "Recorded %d crash reports in %d signatures for %s"
+                % (sum(counts.values()), len(counts), args.record),
+                file=sys.stderr,
+            )
+        if output is None:
+            write_signature_report(signatures, sys.stdout)
+        else:
+            with open(output, "w") as outf:
+                write_signature_report(signatures, outf)
+        return
+
     if os.isatty(sys.stdout.fileno()):
         print("Paste text and hit Control-Z or Control-D")
-    txt = sys.stdin.read().decode("ascii", "ignore")
+    txt = sys.stdin.read().encode("ascii", "ignore").decode("ascii")
     txt = omap.deobfuscate(txt)
     txt = format_nicely(txt, args.verbose)
     print(txt)
@@ -26,17 +26,25 @@ Inputs:
   Support/exportManifest.json.
 Outputs:
   Support/TiltBrush.com/shaders/brushes/*.glsl
+
+Generation is incremental. Parsed include files are cached by (path, mtime),
+and the includes and defines that went into each output are recorded in a
+state file; an output is regenerated only if one of those changed, and is
+rewritten only if its contents (compared by hash) changed.
 """
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import os
 import platform
 import re
-import stat
-import shutil
 from subprocess import Popen, PIPE
 
+# Bump this if generation changes, to force regeneration
+STATE_VERSION = 1
+
 # Fill this out to help copy shaders from previous versions of brushes
 UPDATED_GUIDS_BY_NAME = {
     # 'OilPaint': ('c515dad7-4393-4681-81ad-162ef052241b', 'f72ec0e7-a844-4e38-82e3-140c44772699'),
@@ -47,72 +55,104 @@ UPDATED_GUIDS_BY_NAME = {
 # ---------------------------------------------------------------------------
 
 
-def destroy(file_or_dir):
-    """Ensure that *file_or_dir* does not exist in the filesystem,
-    deleting it if necessary."""
-    if os.path.isfile(file_or_dir):
-        os.chmod(file_or_dir, stat.S_IWRITE)
-        os.unlink(file_or_dir)
-    elif os.path.isdir(file_or_dir):
-        for r, ds, fs in os.walk(file_or_dir, topdown=False):
-            for f in fs:
-                os.chmod(os.path.join(r, f), stat.S_IWRITE)
-                os.unlink(os.path.join(r, f))
-            for d in ds:
-                os.rmdir(os.path.join(r, d))
-        os.rmdir(file_or_dir)
-    if os.path.exists(file_or_dir):
-        raise Exception("Temp build location '%s' is not empty" % file_or_dir)
-
-
 class PreprocessException(Exception):
     """Exception raised by preprocess_lite() and preprocess()"""
 
 
-def preprocess_lite(input_file, defines, include_dirs):
-    """Returns contents of input_file with #includes expanded.
-    defines is a dict of #defines.
-    include_dirs is a list of directories.
-    Raises PreprocessException on error."""
-    include_pat = re.compile(
-        r'^[ \t]*#[ \t]*include[ \t]+([<"])(.*)[">].*$\n?', re.MULTILINE
-    )
+INCLUDE_PAT = re.compile(
+    r'^[ \t]*#[ \t]*include[ \t]+([<"])(.*)[">].*$\n?', re.MULTILINE
+)
 
-    def expand_include(include, current_file, is_quote):
-        """Given the body of an #include, returns replacement text."""
+
+def file_stamp(filename):
+    """Returns [mtime_ns, size] of filename, or None if it does not exist."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class IncludeCache:
+    """Expands #includes, caching each file's parsed form by (path, mtime) and
+    each file's full expansion for the lifetime of the cache.
+    Safe to use from several threads."""
+
+    def __init__(self, include_dirs):
+        self.include_dirs = include_dirs
+        # path -> (stamp, list of text strings and (body, is_quote) includes)
+        self._parsed = {}
+        # path -> (text, frozenset of all files it depends on, including itself)
+        self._expanded = {}
+
+    def _parse(self, filename):
+        stamp = file_stamp(filename)
+        cached = self._parsed.get(filename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(filename, "r") as inf:
+            text = inf.read()
+        if not text.endswith("\n"):
+            text += "\n"
+        # uncomment for debugging
+        # text = '// %s\n%s' % (filename, text)
+        chunks = []
+        pos = 0
+        for match in INCLUDE_PAT.finditer(text):
+            chunks.append(text[pos : match.start()])
+            chunks.append((match.group(2), match.group(1) == '"'))
+            pos = match.end()
+        chunks.append(text[pos:])
+        self._parsed[filename] = (stamp, chunks)
+        return chunks
+
+    def _resolve(self, include, current_file, is_quote):
         # https://gcc.gnu.org/onlinedocs/cpp/Include-Syntax.html
         if is_quote:
-            search_path = [os.path.dirname(current_file)] + include_dirs
+            search_path = [os.path.dirname(current_file)] + self.include_dirs
         else:
-            search_path = include_dirs
-
+            search_path = self.include_dirs
         for include_dir in search_path:
-            candidate = os.path.join(include_dir, include)
+            candidate = os.path.normpath(os.path.join(include_dir, include))
             if os.path.exists(candidate):
-                with open(candidate, "r") as inf:
-                    candidate_text = inf.read()
-                    if not candidate_text.endswith("\n"):
-                        candidate_text += "\n"
-                    # uncomment for debugging
-                    # candidate_text = '// %s\n%s' % (candidate, candidate_text)
-
-                def expand_include_match(match):
-                    char, body = match.groups()
-                    # This has a pylint warning which I don't know how to fix, but I suspect that candidate isn't updated
-                    return expand_include(
-                        body,
-                        candidate,  # pylint: disable=cell-var-from-loop
-                        char == '"',
-                    )
-
-                return include_pat.sub(expand_include_match, candidate_text)
+                return candidate
+        raise PreprocessException(
+            "%s : fatal error: Cannot open include file: '%s'" % (current_file, include)
+        )
+
+    def expand(self, filename, _stack=()):
+        """Returns (text, deps): the contents of filename with #includes
+        expanded, and the set of files that went into it.
+        Raises PreprocessException on error."""
+        filename = os.path.normpath(filename)
+        cached = self._expanded.get(filename)
+        if cached is not None:
+            return cached
+        if filename in _stack:
             raise PreprocessException(
-                "%s : fatal error: Cannot open include file: '%s'"
-                % (current_file, include)
+                "%s : fatal error: recursive #include" % (filename,)
             )
-
-    contents = expand_include(input_file, input_file, True)
-    # inject defines
+        parts = []
+        deps = {filename}
+        for chunk in self._parse(filename):
+            if isinstance(chunk, str):
+                parts.append(chunk)
+            else:
+                include = self._resolve(chunk[0], filename, chunk[1])
+                text, include_deps = self.expand(include, _stack + (filename,))
+                parts.append(text)
+                deps |= include_deps
+        result = ("".join(parts), frozenset(deps))
+        self._expanded[filename] = result
+        return result
+
+
+def inject_defines(contents, defines):
+    """Prepends #defines for those of defines which are mentioned in contents."""
     defines = [
         "#define %s %s\n" % (k, v)
         for (k, v) in sorted(defines.items())
@@ -121,6 +161,18 @@ def preprocess_lite(input_file, defines, include_dirs):
     return "".join(defines) + contents
 
 
+def preprocess_lite(input_file, defines, include_dirs, cache=None):
+    """Returns contents of input_file with #includes expanded.
+    defines is a dict of #defines.
+    include_dirs is a list of directories.
+    cache is an optional IncludeCache for include_dirs.
+    Raises PreprocessException on error."""
+    if cache is None:
+        cache = IncludeCache(include_dirs)
+    contents, _ = cache.expand(input_file)
+    return inject_defines(contents, defines)
+
+
 # Currently unused
 def preprocess(input_file, defines, include_dirs):
     """Returns C preprocessed contents of input_file.
@@ -208,6 +260,7 @@ class Generator:
         self.template_dir = include_dirs[0]
         assert os.path.exists(os.path.join(self.template_dir, "VertDefault.glsl"))
         self.output_shaders = set()
+        self.includes = IncludeCache(include_dirs)
         self.brush_manifest_file = brush_manifest_file
         with open(self.brush_manifest_file) as inf:
             self.brush_manifest = json.load(inf)
@@ -238,11 +291,32 @@ class Generator:
         # Unity Standard Diffuse + Specular.
         return "FragStandard.glsl"
 
-    def generate(self, out_root):
-        """Generate output for all brushes in the manifest."""
-        brushes = self.brush_manifest["brushes"]
-        for _, brush in brushes.items():
-            self.generate_brush(brush, out_root)
+    def generate(self, out_root, state=None, jobs=None):
+        """Generate output for all brushes in the manifest.
+        state is a dict from a previous run (see load_state); outputs whose
+        inputs are unchanged according to it are skipped. It is updated in place.
+        Returns (number of outputs that were up to date, number of outputs)."""
+        if state is None:
+            state = {}
+        # Auto-creating inputs touches shared files, so do it serially
+        shaders = []
+        for _, brush in self.brush_manifest["brushes"].items():
+            shaders.extend(self.prepare_brush(brush, out_root))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            results = list(
+                pool.map(
+                    lambda shader: self.generate_shader(out_root, state, *shader),
+                    shaders,
+                )
+            )
+        up_to_date = 0
+        for key, entry, change in results:
+            state[key] = entry
+            if change is None:
+                up_to_date += 1
+            else:
+                print(change, os.path.join(out_root, key))
+        return up_to_date, len(results)
 
     def copy_from_prev_brush(self, brush, out_dir):
         """Copies vert and frag shaders from brush's predecessor, if possible."""
@@ -276,9 +350,10 @@ class Generator:
         maybe_copy("vertexShader")
         maybe_copy("fragmentShader")
 
-    def generate_brush(self, brush, out_root):
-        """Generate output for a single brush in the manifest.
-        Pass the manifest entry."""
+    def prepare_brush(self, brush, out_root):
+        """Makes sure the inputs for a single brush exist.
+        Pass the manifest entry.
+        Returns a list of (input_file, output_file, defines)."""
         # name = brush["name"]
         # version = brush["shaderVersion"]
         # guid = brush["guid"]
@@ -299,7 +374,6 @@ class Generator:
             print("Auto-creating %s" % os.path.basename(vert_input))
             with open(vert_input, "w") as f:
                 f.write('#include "VertDefault.glsl"\n')
-        self.preprocess(vert_input, vert_output, defines, self.include_dirs)
 
         # Fragment shader
 
@@ -309,60 +383,65 @@ class Generator:
             print("Auto-creating %s" % os.path.basename(frag_input))
             with open(frag_input, "w") as f:
                 f.write('#include "%s"\n' % self.get_frag_template(brush))
-        self.preprocess(frag_input, frag_output, defines, self.include_dirs)
 
-    @staticmethod
-    def preprocess(input_file, output_file, defines, include_dirs):
-        """Wrapper around global preprocess that does some massaging of
-        the input and output."""
-        output_data = preprocess_lite(input_file, defines, include_dirs)
-        try:
-            os.makedirs(os.path.dirname(output_file))
-        except OSError:
-            pass
-        with open(output_file, "w") as outf:
-            outf.write(output_data)
-
-
-def finalize_dir(tmp_dir, out_dir):
-    """Move files from tmp_dir to out_dir.
-    Print output for changed, new, or removed files.
-    Avoids touching timestamp if file not changed."""
-    # Could handle this case, but it's unexpepcted
-    assert not os.path.isfile(out_dir), "Unexpected: %s is a file" % out_dir
+        return [(vert_input, vert_output, defines), (frag_input, frag_output, defines)]
+
+    def generate_shader(
+        self, out_root, state, input_file, output_file, defines
+    ):  # pylint: disable=too-many-arguments
+        """Preprocesses input_file to output_file, unless state says it is up to date.
+        Returns (key, new state entry, change), where change is "+" for a new
+        file, "~" for a changed one, and None if the file was not touched."""
+        key = os.path.relpath(output_file, out_root).replace("\\", "/")
+        output_stamp = file_stamp(output_file)
+        entry = state.get(key)
+        if entry is not None and entry["output"][:2] == output_stamp:
+            old_digest = entry["output"][2]
+            if entry["defines"] == defines and all(
+                file_stamp(dep) == dep_stamp for dep, dep_stamp in entry["inputs"]
+            ):
+                return key, entry, None
+        elif output_stamp is not None:
+            with open(output_file, "r") as inf:
+                old_digest = text_digest(inf.read())
+        else:
+            old_digest = None
+
+        contents, deps = self.includes.expand(input_file)
+        output_data = inject_defines(contents, defines)
+        digest = text_digest(output_data)
+        change = None
+        if digest != old_digest:
+            change = "+" if output_stamp is None else "~"
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, "w") as outf:
+                outf.write(output_data)
+        entry = {
+            "defines": defines,
+            "inputs": [[dep, file_stamp(dep)] for dep in sorted(deps)],
+            "output": file_stamp(output_file) + [digest],
+        }
+        return key, entry, change
+
+
+def load_state(filename):
+    """Returns the state saved by a previous run, or an empty dict."""
     try:
-        os.makedirs(out_dir)
-    except OSError:
-        pass
+        with open(filename) as inf:
+            state = json.load(inf)
+    except (IOError, ValueError):
+        return {}
+    if state.get("version") != STATE_VERSION:
+        return {}
+    return state["outputs"]
 
-    tmp_files = set(os.listdir(tmp_dir))
-    out_files = set(os.listdir(out_dir))
-
-    for filename in tmp_files:
-        tmp_file = os.path.join(tmp_dir, filename)
-        out_file = os.path.join(out_dir, filename)
-        if os.path.isdir(tmp_file):
-            finalize_dir(tmp_file, out_file)
-        elif os.path.isdir(out_file):
-            assert False, "Unexpected: %s is a dir" % out_file
-        elif filename not in out_files:
-            shutil.copyfile(tmp_file, out_file)
-            print("+", out_file)
-        else:
-            with open(tmp_file, "rb") as tmp:
-                with open(out_file, "rb") as out:
-                    if tmp.read() != out.read():
-                        shutil.copyfile(tmp_file, out_file)
-                        print("~", out_file)
-
-    # Cannot remove unwanted files (yet); output directory contains input files also
-    if False:  # pylint: disable=using-constant-test
-        for filename in out_files - tmp_files:
-            out_file = os.path.join(out_dir, filename)
-            if not os.path.isfile(out_file):
-                continue
-            print("-", out_file)
-            destroy(out_file)
+
+def save_state(filename, state):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpf = filename + "_part"
+    with open(tmpf, "w") as outf:
+        json.dump({"version": STATE_VERSION, "outputs": state}, outf, sort_keys=True)
+    os.replace(tmpf, filename)
 
 
 def main():
@@ -376,6 +455,16 @@ def main():
     parser.add_argument(
         "export_root", nargs="?", default=None, help="Output root directory (optional)"
     )
+    parser.add_argument(
+        "--force", action="store_true", help="Regenerate everything, even if up to date"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker threads (default: automatic)",
+    )
     args = parser.parse_args()
 
     project_root = os.path.normpath(
@@ -388,16 +477,24 @@ def main():
             project_root, "Support/TiltBrush.com/shaders/brushes"
         )
 
-    tmp_dir = os.path.join(project_root, "Temp/tmp_gltf")
+    # Output paths in the state are relative, so keep one state per export root
+    state_file = os.path.join(
+        project_root,
+        "Library",
+        "GltfExportShaders-%s.json"
+        % text_digest(os.path.abspath(args.export_root))[:8],
+    )
     input_dir = os.path.join(project_root, "Support/GlTFShaders/Generators")
     include_dirs = [os.path.join(project_root, "Support/GlTFShaders/include")]
 
     gen = Generator(input_dir, include_dirs, args.brush_manifest)
-    destroy(tmp_dir)
-    gen.generate(tmp_dir)
+    state = {} if args.force else load_state(state_file)
     print("Writing to %s" % os.path.normpath(args.export_root))
-    finalize_dir(tmp_dir, args.export_root)
-    destroy(tmp_dir)
+    try:
+        up_to_date, total = gen.generate(args.export_root, state, args.jobs)
+    finally:
+        save_state(state_file, state)
+    print("%d of %d shaders up to date" % (up_to_date, total))
 
 
 if __name__ == "__main__":
@@ -20,74 +20,191 @@ Copies + downsamples brush textures.
 Blurs bump maps.
 Input is a .json file generated by SyncExportMaterials.
 
+Requests are processed in parallel. Outputs are recorded in a manifest, and a
+request is skipped if its source, size, bump-ness and destination format are
+unchanged and its output is still there.
+
 """
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import os
 import sys
+import time
+
+# Add ../Python to sys.path
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Python")
+)
 
 try:
     import PIL
     import PIL.Image
     import PIL.ImageFilter
 
+    from tbdata.downsample import MipChain  # pylint: disable=import-error
 except ImportError as e:
     print(e)
-    print("You need to 'pip install pillow' to run this script")
+    print("You need to 'pip install pillow numpy' to run this script")
     sys.exit(1)
 
 
 MEG = 1024.0 * 1024.0
 BLUR_RADIUS_TEXELS = 1.0
+# Bump this if processing changes, to force re-export
+MANIFEST_VERSION = 2
 
 
-def process_request(request):
-    """Process a single downsample-and-copy request"""
-    im = PIL.Image.open(request["source"])
+def process_requests(requests):
+    """Process downsample-and-copy requests that share a source and isBump.
+    The source is decoded, and its mip chain built, only once.
+    Returns a list of (input_bytes, output_bytes), one per request"""
+    source = requests[0]["source"]
+    im = PIL.Image.open(source)
     if "P" in im.mode:
-        assert False, f"Unexpected: png with indexed color: {request['source']}"
+        assert False, f"Unexpected: png with indexed color: {source}"
         # Un-palettize
         im = im.convert()
+    im.load()
 
-    # Don't upsample! Only downsample
-    desired_width = int(request["desiredWidth"])
-    assert desired_width == request["desiredWidth"]
-    desired_height = int(request["desiredHeight"])
-    assert desired_height == request["desiredHeight"]
-
-    assert im.width >= desired_width
-    assert im.height >= desired_height
+    if requests[0]["isBump"]:
+        im = im.filter(PIL.ImageFilter.GaussianBlur(radius=BLUR_RADIUS_TEXELS))
 
     bpp = {"RGBA": 4, "RGB": 3, "L": 1}[im.mode]
-    request["input_bytes"] = im.width * im.height * bpp
-    request["output_bytes"] = desired_width * desired_height * bpp
+    chain = None
+    results = []
+    for request in requests:
+        # Don't upsample! Only downsample
+        desired_width = int(request["desiredWidth"])
+        assert desired_width == request["desiredWidth"]
+        desired_height = int(request["desiredHeight"])
+        assert desired_height == request["desiredHeight"]
 
-    if request["isBump"]:
-        im = im.filter(PIL.ImageFilter.GaussianBlur(radius=BLUR_RADIUS_TEXELS))
+        assert im.width >= desired_width
+        assert im.height >= desired_height
+
+        desired_size = (desired_width, desired_height)
+        if im.size == desired_size:
+            out = im
+        else:
+            if chain is None:
+                chain = MipChain(im)
+            out = chain.get_image(desired_size)
+
+        outdir = os.path.dirname(request["destination"])
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
 
-    desired_size = (desired_width, desired_height)
-    if im.size != desired_size:
-        im = im.resize(desired_size, resample=PIL.Image.BILINEAR)
+        # If the image is a jpeg then strip off the alpha channel
+        if (
+            request["destination"].endswith(".jpg")
+            or request["destination"].endswith(".jpeg")
+        ) and out.mode == "RGBA":
+            out = out.convert("RGB")
 
-    outdir = os.path.dirname(request["destination"])
-    if not os.path.isdir(outdir):
-        os.makedirs(outdir)
+        # Catch OSError and re-raise with a more informative message
+        try:
+            out.save(request["destination"])
+        except OSError as ex:
+            raise OSError(
+                f"Error saving {request['destination']}: {ex.strerror} (code {ex.errno})"
+            ) from ex
+        results.append(
+            (im.width * im.height * bpp, desired_width * desired_height * bpp)
+        )
+    return results
 
-    # If the image is a jpeg then strip off the alpha channel
-    if (
-        request["destination"].endswith(".jpg")
-        or request["destination"].endswith(".jpeg")
-    ) and im.mode == "RGBA":
-        im = im.convert("RGB")
 
-    # Catch OSError and re-raise with a more informative message
+def get_request_key(request):
+    """Returns a json-able value that changes if the output of request would."""
+    with open(request["source"], "rb") as inf:
+        source_hash = hashlib.blake2b(inf.read(), digest_size=16).hexdigest()
+    return [
+        MANIFEST_VERSION,
+        source_hash,
+        request["desiredWidth"],
+        request["desiredHeight"],
+        bool(request["isBump"]),
+        os.path.splitext(request["destination"])[1].lower(),
+    ]
+
+
+def _output_stat(destination):
+    try:
+        st = os.stat(destination)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_manifest(filename):
+    """Returns dict mapping destination -> {key, output, input_bytes, output_bytes}"""
     try:
-        im.save(request["destination"])
-    except OSError as ex:
-        raise OSError(
-            f"Error saving {request['destination']}: {ex.strerror} (code {ex.errno})"
-        ) from ex
+        with open(filename) as inf:
+            return json.load(inf)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(filename, manifest):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpf = filename + "_part"
+    with open(tmpf, "w") as outf:
+        json.dump(manifest, outf, indent=1, sort_keys=True)
+    os.replace(tmpf, filename)
+
+
+def export_textures(requests, manifest, jobs=None):
+    """Processes requests that are not up to date in manifest, using a process
+    pool. Updates manifest in place.
+    Returns (input_bytes, output_bytes, processed_input_bytes, num_skipped);
+    the totals include skipped requests."""
+    totals = [0, 0]
+    processed_input_bytes = 0
+    pending = []
+    for request in requests:
+        key = get_request_key(request)
+        entry = manifest.get(request["destination"])
+        if (
+            entry is not None
+            and entry["key"] == key
+            and entry["output"] == _output_stat(request["destination"])
+        ):
+            totals[0] += entry["input_bytes"]
+            totals[1] += entry["output_bytes"]
+        else:
+            pending.append((request, key))
+
+    # Requests with the same source and bump-ness share their decode and mip chain
+    groups = {}
+    for request, key in pending:
+        groups.setdefault((request["source"], bool(request["isBump"])), []).append(
+            (request, key)
+        )
+    if groups:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            results = pool.map(
+                process_requests,
+                [[request for request, _ in group] for group in groups.values()],
+            )
+            for group, group_results in zip(groups.values(), results):
+                for (request, key), (input_bytes, output_bytes) in zip(
+                    group, group_results
+                ):
+                    manifest[request["destination"]] = {
+                        "key": key,
+                        "output": _output_stat(request["destination"]),
+                        "input_bytes": input_bytes,
+                        "output_bytes": output_bytes,
+                    }
+                    totals[0] += input_bytes
+                    totals[1] += output_bytes
+                    processed_input_bytes += input_bytes
+    return totals[0], totals[1], processed_input_bytes, len(requests) - len(pending)
 
 
 def main():
@@ -102,6 +219,21 @@ def main():
         default=None,
         help="Path to a json containing export requests",
     )
+    parser.add_argument(
+        "--manifest",
+        default=os.path.join(project_root, "Library", "GltfExportTextures.json"),
+        help="Record of previous exports, used to skip unchanged ones (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Export everything, even if up to date"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
     args = parser.parse_args()
     if args.requests is None:
         args.requests = os.path.join(project_root, "Temp", "ExportRequests.json")
@@ -109,13 +241,26 @@ def main():
     with open(args.requests) as inf:
         requests = json.load(inf)
 
-    for request in requests["exports"]:
-        process_request(request)
+    manifest = {} if args.force else load_manifest(args.manifest)
+    start = time.perf_counter()
+    try:
+        input_bytes, output_bytes, processed_bytes, skipped = export_textures(
+            requests["exports"], manifest, args.jobs
+        )
+    finally:
+        # Keep whatever did get exported, even on failure
+        save_manifest(args.manifest, manifest)
+    elapsed = time.perf_counter() - start
 
-    input_bytes = sum(r["input_bytes"] for r in requests["exports"])
-    output_bytes = sum(r["output_bytes"] for r in requests["exports"])
     print(
-        "Input: %.2f MiB   Output: %.2f MiB" % (input_bytes / MEG, output_bytes / MEG)
+        "Input: %.2f MiB   Output: %.2f MiB   Throughput: %.2f MiB/s   (%d of %d up to date)"
+        % (
+            input_bytes / MEG,
+            output_bytes / MEG,
+            processed_bytes / MEG / elapsed if elapsed > 0 else 0,
+            skipped,
+            len(requests["exports"]),
+        )
     )
 
 
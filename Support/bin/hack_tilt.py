@@ -15,15 +15,17 @@
 # limitations under the License.
 
 import argparse
+import os
+import sys
 
-try:
-    from tiltbrush.tilt import Tilt
-except ImportError:
-    print(
-        "You need the Tilt Brush Toolkit (https://github.com/googlevr/tilt-brush-toolkit)"
-    )
-    print("and then put its Python directory in your PYTHONPATH.")
-    raise
+# Add ../Python to sys.path
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Python")
+)
+
+from tbdata.tilt import (  # noqa: E402 pylint: disable=import-error,wrong-import-position
+    Tilt,
+)
 
 
 def main():
@@ -44,15 +46,9 @@ def main():
         print("=== %s ===" % filename)
 
         if args.desired_min_y is not None:
-            min_y = min(
-                cp.position[1]
-                for stroke in sketch.strokes
-                for cp in stroke.controlpoints
-            )
+            min_y = float(sketch.position[:, 1].min())
             delta = args.desired_min_y - min_y
-            for stroke in sketch.strokes:
-                for cp in stroke.controlpoints:
-                    cp.position[1] += delta
+            sketch.position[:, 1] += delta
 
             print(filename)
             print("Moved by %.3f" % delta)
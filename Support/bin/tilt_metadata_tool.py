@@ -15,21 +15,23 @@
 # limitations under the License.
 
 import argparse
+import concurrent.futures
+import os
 import sys
 import pprint
 
-try:
-    from tiltbrush.tilt import Tilt
-except ImportError:
-    print(
-        "You need the Tilt Brush Toolkit (https://github.com/googlevr/tilt-brush-toolkit)"
-    )
-    print("and then put its Python directory in your PYTHONPATH.")
-    sys.exit(1)
+# Add ../Python to sys.path
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Python")
+)
+
+from tbdata.tilt import (  # noqa: E402 pylint: disable=import-error,wrong-import-position
+    Tilt,
+)
 
 
 def as_unicode(txt):
-    if isinstance(txt, str):
+    if isinstance(txt, bytes):
         try:
             txt = txt.decode("utf-8")
         except UnicodeDecodeError:
@@ -49,15 +51,29 @@ def main(args=None):
         help="Set author (may be passed multiple times)",
         default=None,
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="Number of files to process in parallel (default: a few per CPU)",
+    )
     parser.add_argument("files", nargs="+", type=str, help="File to examine")
     args = parser.parse_args(args)
 
-    for filename in args.files:
-        print("-- %s -- " % filename)
+    def process(filename):
+        # Only metadata.json is read. When writing, the other members of the
+        # archive are copied through without recompression.
         sketch = Tilt(filename)
+        if args.author is None:
+            return sketch.metadata
         with sketch.mutable_metadata() as meta:
-            if args.author is not None:
-                meta["Authors"] = args.author
+            meta["Authors"] = args.author
+        return meta
+
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+        for filename, meta in zip(args.files, pool.map(process, args.files)):
+            print("-- %s -- " % filename)
             if args.list:
                 pprint.pprint(meta)
 